@@ -1,14 +1,23 @@
 import logging
 import os
 import re
+import subprocess
+import tarfile
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from pathlib import Path
 
 from . import helpers
+from . import member_index
 from . import splitter
+from . import stages as stages_executor
+from . import streaming
+from .chunk_hashes import create_chunk_hash_files
 from .constants import COMPRESSED_ARCHIVE_SUFFIX, ENCRYPTED_ARCHIVE_SUFFIX, \
-    DEFAULT_COMPRESSION_LEVEL
-from .encryption import encrypt_list_of_archives
+    DEFAULT_COMPRESSION_LEVEL, DEFAULT_HASH_ALGORITHM, STREAM_CHUNK_BYTE_SIZE
+from .encryption import encrypt_list_of_archives, encrypt_archive, get_stream_encryption_command
+from .hash_cache import HashCache
 
 
 def encrypt_existing_archive(archive_path, encryption_keys, destination_dir=None, remove_unencrypted=False, force=False, threads=1):
@@ -32,7 +41,7 @@ def encrypt_existing_archive(archive_path, encryption_keys, destination_dir=None
     encrypt_list_of_archives([archive_path], encryption_keys, remove_unencrypted, destination_dir, threads=threads)
 
 
-def create_archive(source_path, destination_path, threads=None, encryption_keys=None, compression=DEFAULT_COMPRESSION_LEVEL, splitting=None, remove_unencrypted=False, force=False, work_dir=None):
+def create_archive(source_path, destination_path, threads=None, encryption_keys=None, compression=DEFAULT_COMPRESSION_LEVEL, splitting=None, remove_unencrypted=False, force=False, work_dir=None, single_pass=False, pipeline=False, hash_cache_path=None, hash_algorithm=DEFAULT_HASH_ALGORITHM, max_files_per_part=None, balanced_parts=False, split_compression=None, io_workers=None, chunk_hashes=False):
     # Argparse already checks if arguments are present, so only argument format needs to be validated
     helpers.terminate_if_path_nonexistent(source_path)
 
@@ -47,18 +56,30 @@ def create_archive(source_path, destination_path, threads=None, encryption_keys=
         threads = 1
 
     if splitting:
-        create_split_archive(source_path, destination_path, source_name, int(splitting), threads, encryption_keys, compression, remove_unencrypted, work_dir, force)
+        create_split_archive(source_path, destination_path, source_name, int(splitting), threads, encryption_keys, compression, remove_unencrypted, work_dir, force, single_pass, pipeline, hash_cache_path, hash_algorithm, max_files_per_part, balanced_parts, split_compression, io_workers)
+    elif pipeline:
+        helpers.handle_destination_directory_creation(destination_path, force)
+
+        logging.info(f"Create archive in {destination_path} using a pipeline of tar, plzip{' and gpg' if encryption_keys else ''}...")
+        create_archive_pipeline(source_path, destination_path, source_name, None, work_dir, threads, compression,
+                                encryption_keys, remove_unencrypted, hash_algorithm)
     else:
         # Create destination folder if nonexistent or overwrite if --force option used
         helpers.handle_destination_directory_creation(destination_path, force)
 
-        logging.info("Create and write hash list...")
-        create_file_listing_hash(source_path, destination_path, source_name, max_workers=threads)
-
-        logging.info(f"Create tar archive in {destination_path}...")
-        create_tar_archive(source_path, destination_path, source_name, work_dir)
-        logging.info(f"Generating hash for tar archive {destination_path}...")
-        create_and_write_archive_hash(destination_path, source_name)
+        if single_pass:
+            logging.info(f"Create tar archive and hash list in {destination_path} in a single pass...")
+            create_tar_archive_and_listing_hash(source_path, destination_path, source_name, work_dir=work_dir,
+                                                hash_algorithm=hash_algorithm)
+        else:
+            logging.info("Create and write hash list...")
+            create_file_listing_hash(source_path, destination_path, source_name, max_workers=threads,
+                                     hash_cache_path=hash_cache_path, hash_algorithm=hash_algorithm)
+
+            logging.info(f"Create tar archive in {destination_path}...")
+            create_tar_archive(source_path, destination_path, source_name, work_dir)
+            logging.info(f"Generating hash for tar archive {destination_path}...")
+            create_and_write_archive_hash(destination_path, source_name)
         logging.info(f"Generating archive listing for tar archive {destination_path}...")
         create_archive_listing(destination_path, source_name)
 
@@ -71,45 +92,107 @@ def create_archive(source_path, destination_path, threads=None, encryption_keys=
             archive_list = [destination_path.joinpath(source_name + COMPRESSED_ARCHIVE_SUFFIX)]
             encrypt_list_of_archives(archive_list, encryption_keys, remove_unencrypted, threads=threads)
 
+    if chunk_hashes:
+        create_chunk_hash_files(destination_path, workers=threads)
+
     logging.info(f"Archive created: {helpers.get_absolute_path_string(destination_path)}")
 
 
-def create_split_archive(source_path, destination_path, source_name, splitting, threads, encryption_keys, compression, remove_unencrypted, work_dir=None, force=False):
+def create_split_archive(source_path, destination_path, source_name, splitting, threads, encryption_keys, compression, remove_unencrypted, work_dir=None, force=False, single_pass=False, pipeline=False, hash_cache_path=None, hash_algorithm=DEFAULT_HASH_ALGORITHM, max_files_per_part=None, balanced_parts=False, split_compression=None, io_workers=None):
     logging.info("Start creation of split archive")
 
     if not threads:
         threads = 1
 
-    create_filelist_and_hashs(source_path, destination_path, splitting, threads, force)
+    if pipeline:
+        create_split_archive_pipeline(source_path, destination_path, splitting, work_dir, threads, compression,
+                                      encryption_keys, remove_unencrypted, force, hash_algorithm, max_files_per_part,
+                                      balanced_parts, split_compression)
+        return
+
+    if single_pass:
+        part_names, split_archives = _split_into_parts(source_path, destination_path, splitting, force,
+                                                       max_files_per_part, balanced_parts, split_compression)
+        archive_lists = dict(zip(part_names, split_archives))
+
+        def create_tar(part):
+            _process_part_single_pass(source_path, destination_path, work_dir, part, archive_lists[part], hash_algorithm)
+    else:
+        create_filelist_and_hashs(source_path, destination_path, splitting, threads, force, hash_cache_path,
+                                  hash_algorithm, max_files_per_part, balanced_parts, split_compression)
+        part_names = get_part_names(source_name, destination_path)
+
+        def create_tar(part):
+            _process_part(source_path, destination_path, work_dir, part)
 
-    create_tar_archives_and_listings(source_path, destination_path, work_dir, workers=threads)
+    create_parts_in_stages(destination_path, part_names, create_tar, threads, io_workers, compression, encryption_keys,
+                           remove_unencrypted)
 
-    compress_and_hash(destination_path, threads, compression)
+
+def create_parts_in_stages(destination_path, part_names, create_tar, threads, io_workers, compression,
+                           encryption_keys=None, remove_unencrypted=False):
+    """
+    Archives, compresses, hashes and encrypts parts as a pipeline: a part enters the next stage as soon as
+    it is done with the previous one, s.t. the I/O bound and the CPU bound stages of different parts overlap.
+
+    :param create_tar: function creating the tar archive, its hash and its listing for a part name
+    :param threads: thread budget shared by the concurrent compression jobs
+    :param io_workers: maximum number of concurrent I/O bound stages, defaults to the thread budget, which is how
+        many tar archives have been created at the same time before the stages overlapped
+    """
+    job_threads = helpers.get_lzip_job_threads(threads, len(part_names))
+    io_workers = io_workers or threads
+
+    stages = [("tar", create_tar, stages_executor.IO),
+              ("compress", _get_compression_function(destination_path, job_threads, compression), stages_executor.CPU),
+              ("hash", lambda part: create_and_write_compressed_archive_hash(destination_path, part), stages_executor.IO)]
 
     if encryption_keys:
-        do_encryption(destination_path, encryption_keys, threads)
+        def encrypt(part):
+            archive_path = destination_path / f"{part}{COMPRESSED_ARCHIVE_SUFFIX}"
+            encrypt_archive(archive_path, helpers.add_suffix_to_path(archive_path, ".gpg"), encryption_keys,
+                            remove_unencrypted)
+
+        def hash_encrypted(part):
+            helpers.create_and_write_file_hash(destination_path / f"{part}{ENCRYPTED_ARCHIVE_SUFFIX}",
+                                               get_hash_algorithm_of_listing(destination_path, part))
+
+        stages += [("encrypt", encrypt, stages_executor.CPU), ("hash encrypted", hash_encrypted, stages_executor.IO)]
 
+    logging.info(f"Processing {len(part_names)} parts in stages {', '.join(name for name, _, _ in stages)} "
+                 f"using {len(job_threads)} CPU workers and {io_workers} I/O workers.")
+    stages_executor.run_stages(part_names, stages, {stages_executor.IO: io_workers, stages_executor.CPU: len(job_threads)})
 
-def create_filelist_and_hashs(source_path, destination_path, split_size, threads, force=False):
+
+def create_filelist_and_hashs(source_path, destination_path, split_size, threads, force=False, hash_cache_path=None,
+                              hash_algorithm=DEFAULT_HASH_ALGORITHM, max_files_per_part=None, balanced_parts=False,
+                              split_compression=None):
     helpers.handle_destination_directory_creation(destination_path, force)
 
     if split_size:
-        logging.info(f"Using a split size of {split_size} bytes ({split_size/1024**3:.3f}GB).")
+        _log_split_size(split_size, split_compression)
 
         nr_parts = create_file_listing_hash_split_archives(source_path, destination_path,
-                                                split_size, threads)
+                                                split_size, threads, hash_cache_path, hash_algorithm,
+                                                max_files_per_part, balanced_parts, split_compression)
 
         with open(destination_path / f"{source_path.name}.parts.txt", "w") as f:
             f.write(f"{nr_parts}\n")
     else:
         create_file_listing_hash(source_path, destination_path,
                                  source_path.name, archive_list=None,
-                                 max_workers=threads)
+                                 max_workers=threads, hash_cache_path=hash_cache_path,
+                                 hash_algorithm=hash_algorithm)
 
 
-def create_file_listing_hash_split_archives(source_path, destination_path, split_size, threads):
+def create_file_listing_hash_split_archives(source_path, destination_path, split_size, threads, hash_cache_path=None,
+                                            hash_algorithm=DEFAULT_HASH_ALGORITHM, max_files_per_part=None,
+                                            balanced_parts=False, split_compression=None):
 
-    split_archives = splitter.split_directory(source_path, split_size)
+    logging.info(f"Collecting file sizes in {source_path}")
+    size_tree = splitter.build_size_tree(source_path)
+    split_archives = splitter.split_directory_into_parts(source_path, split_size, max_files_per_part, balanced_parts,
+                                                         size_tree, split_compression)
 
     source_name = source_path.name
     nr_parts = 0
@@ -118,23 +201,32 @@ def create_file_listing_hash_split_archives(source_path, destination_path, split
         source_part_name = f"{source_name}.part{index + 1}"
         create_file_listing_hash(source_path, destination_path,
                                          source_part_name, archive,
-                                         max_workers=threads)
+                                         max_workers=threads, hash_cache_path=hash_cache_path,
+                                         hash_algorithm=hash_algorithm, size_tree=size_tree)
         nr_parts += 1
     return nr_parts
 
 
-def create_file_listing_hash(source_path_root, destination_path, source_name, archive_list=None, max_workers=1):
+def create_file_listing_hash(source_path_root, destination_path, source_name, archive_list=None, max_workers=1,
+                             hash_cache_path=None, hash_algorithm=DEFAULT_HASH_ALGORITHM, size_tree=None):
     if archive_list:
         paths_to_hash_list = archive_list
     else:
         paths_to_hash_list = [source_path_root]
 
-    hashes = sorted(hashes_for_path_list(paths_to_hash_list, source_path_root, max_workers), key=lambda p: p[0])
+    hashes = sorted(hashes_for_path_list(paths_to_hash_list, source_path_root, max_workers, hash_cache_path,
+                                         hash_algorithm, size_tree), key=lambda p: p[0])
     hash_file_path = destination_path.joinpath(source_name + ".md5")
 
+    write_file_listing_hash(hashes, hash_file_path, hash_algorithm)
 
+
+def write_file_listing_hash(hashes, hash_file_path, hash_algorithm=DEFAULT_HASH_ALGORITHM):
     logging.info(f"Writing file hash list to {hash_file_path}")
     with open(hash_file_path, "a") as hash_file:
+        if hash_file.tell() == 0:
+            hash_file.write(helpers.get_hash_file_header(hash_algorithm))
+
         for line in hashes:
             file_path = line[0]
             hash_prefix = ''
@@ -146,14 +238,26 @@ def create_file_listing_hash(source_path_root, destination_path, source_name, ar
             hash_file.write(f"{hash_prefix}{file_hash} {file_path}\n")
 
 
-def hashes_for_path_list(path_list, source_path_root, max_workers=1):
-    files = [path for path in path_list if not path.is_dir()]
+def hashes_for_path_list(path_list, source_path_root, max_workers=1, hash_cache_path=None,
+                         hash_algorithm=DEFAULT_HASH_ALGORITHM, size_tree=None):
+    if size_tree:
+        # reusing the stat results gathered for splitting instead of walking the directories again
+        files, file_stats = splitter.get_files_with_stats(size_tree, source_path_root, path_list)
+    else:
+        files = [path for path in path_list if not path.is_dir()]
+        file_stats = None
+
+        for path in path_list:
+            if path.is_dir():
+                files.extend(helpers.get_files_in_folder(path))
 
-    for path in path_list:
-        if path.is_dir():
-            files.extend(helpers.get_files_in_folder(path))
+    if hash_cache_path:
+        with HashCache(hash_cache_path, hash_algorithm) as hash_cache:
+            return helpers.hash_files_and_check_symlinks(source_path_root, files, max_workers=max_workers,
+                                                         hash_cache=hash_cache, abs_paths_stats=file_stats)
 
-    return helpers.hash_files_and_check_symlinks(source_path_root, files, max_workers=max_workers)
+    return helpers.hash_files_and_check_symlinks(source_path_root, files, max_workers=max_workers,
+                                                 algorithm=hash_algorithm, abs_paths_stats=file_stats)
 
 
 def _process_part(source_path, destination_path, work_dir, source_part_name):
@@ -168,8 +272,14 @@ def _process_part(source_path, destination_path, work_dir, source_part_name):
 
 
 def create_tar_archives_and_listings(source_path, destination_path, work_dir, parts=None, workers=1):
-    source_name = source_path.name
+    part_names = get_part_names(source_path.name, destination_path, parts)
+
+    logging.info(f"Creating tar archives and listings for {','.join(part_names)} using {workers} workers.")
+    helpers.exec_parallel(_process_part, part_names, lambda p: (source_path, destination_path, work_dir, p), workers)
+
 
+def get_part_names(source_name, destination_path, parts=None):
+    """Names of the parts (or the single archive) whose file listing hashes exist in the destination"""
     if parts:
         part_hashes = [destination_path / f"{source_name}.part{part}.md5" for part in parts]
     else:
@@ -182,10 +292,7 @@ def create_tar_archives_and_listings(source_path, destination_path, work_dir, pa
         if not part_hashes:
             helpers.terminate_with_message(f"No {source_name}.md5 or files matching {source_name}.part[0-9]*.md5 found in {destination_path}")
 
-    part_names = [os.path.splitext(p.name)[0] for p in helpers.sort_paths_with_part(part_hashes)]
-
-    logging.info(f"Creating tar archives and listings for {','.join(part_names)} using {workers} workers.")
-    helpers.exec_parallel(_process_part, part_names, lambda p: (source_path, destination_path, work_dir, p), workers)
+    return [os.path.splitext(p.name)[0] for p in helpers.sort_paths_with_part(part_hashes)]
 
 
 def create_tar_archive(source_path, destination_path, source_name, archive_list=None, work_dir=None):
@@ -201,17 +308,245 @@ def create_tar_archive(source_path, destination_path, source_name, archive_list=
 
 
 def create_tar_archive_from_list(source_path, archive_list, destination_file_path, source_path_parent, work_dir=None):
+    # Using TemporaryDirectory instead of NamedTemporaryFile to have full control over file creation
+    with tempfile.TemporaryDirectory(dir=work_dir) as temp_path_string:
+        tmp_file_path = Path(temp_path_string) / "paths.txt"
+        write_tar_path_list(source_path, archive_list, tmp_file_path)
+
+        helpers.run_shell_cmd(["tar", "--posix", "-cf", destination_file_path, "-C", source_path_parent, "--null", "--files-from", tmp_file_path])
+
+
+def write_tar_path_list(source_path, archive_list, path_list_file_path):
     relative_archive_list = [path.absolute().relative_to(source_path.absolute().parent) for path in archive_list]
     files_string_list = [path.as_posix() for path in relative_archive_list]
 
-    # Using TemporaryDirectory instead of NamedTemporaryFile to have full control over file creation
+    with open(path_list_file_path, "w") as path_list_file:
+        path_list_file.write("\0".join(files_string_list))
+
+
+def create_tar_archive_and_listing_hash(source_path, destination_path, source_name, archive_list=None, work_dir=None,
+                                        hash_algorithm=DEFAULT_HASH_ALGORITHM):
+    """
+    Creates the tar archive, the file hash list and the hash of the tar archive in a single pass.
+
+    The file hashes are computed from the tar stream while it is written to disk, s.t. the
+    source files are read only once.
+    """
+    destination_file_path = destination_path.joinpath(source_name + ".tar")
+    source_path_parent = source_path.absolute().parent
+
     with tempfile.TemporaryDirectory(dir=work_dir) as temp_path_string:
-        tmp_file_path = Path(temp_path_string) / "paths.txt"
+        if archive_list:
+            tmp_file_path = Path(temp_path_string) / "paths.txt"
+            write_tar_path_list(source_path, archive_list, tmp_file_path)
 
-        with open(tmp_file_path, "w") as tmp_file:
-            tmp_file.write("\0".join(files_string_list))
+            tar_cmd = ["tar", "--posix", "-cf", "-", "-C", source_path_parent, "--null", "--files-from", tmp_file_path]
+        else:
+            tar_cmd = ["tar", "--posix", "-cf", "-", "-C", source_path_parent, source_path.name]
+
+        logging.debug(f"Executing command: '{tar_cmd}'")
+        tar_process = subprocess.Popen(tar_cmd, stdout=subprocess.PIPE)
+
+        try:
+            with open(destination_file_path, "wb") as tar_file, \
+                    member_index.record_tar_members(destination_file_path) as record_member:
+                reader = streaming.HashingReader(tar_process.stdout, [tar_file], hash_algorithm)
+
+                hashes = []
+                for path, file_hash, member in streaming.hash_tar_members(
+                        reader, hash_algorithm, on_member=record_member,
+                        is_directory_link=_get_directory_link_predicate(source_path)):
+                    if member.issym():
+                        helpers.check_symlinks(source_path.parent / member.name, source_path)
+                    hashes.append([path, file_hash])
+
+                reader.drain()
+        finally:
+            tar_process.stdout.close()
+            tar_process.wait()
+
+    if tar_process.returncode != 0:
+        raise subprocess.CalledProcessError(tar_process.returncode, tar_cmd)
+
+    write_file_listing_hash(sorted(hashes, key=lambda p: p[0]), destination_path.joinpath(source_name + ".md5"),
+                            hash_algorithm)
+    helpers.write_file_hash(destination_file_path.absolute(), reader.hexdigest(), hash_algorithm)
+
+
+def _get_directory_link_predicate(source_path):
+    """
+    Symlinks to directories are listed as directories by os.walk and aren't part of the hash listings created from
+    the filesystem (see create_file_listing_hash), the hashes computed from the tar stream leave them out as well.
+    The name of the member is looked up as in the archive, since the normalized path might not exist on disk.
+    """
+    source_path_parent = source_path.absolute().parent
 
-        helpers.run_shell_cmd(["tar", "--posix", "-cf", destination_file_path, "-C", source_path_parent, "--null", "--files-from", tmp_file_path])
+    return lambda path, member: (source_path_parent / member.name).is_dir()
+
+
+def _process_part_single_pass(source_path, destination_path, work_dir, source_part_name, archive_list, hash_algorithm):
+    logging.info(f"Create tar archive and hash list for {source_part_name}")
+    create_tar_archive_and_listing_hash(source_path, destination_path, source_part_name, archive_list, work_dir,
+                                        hash_algorithm)
+    logging.info(f"Generating tar archive listing for {source_part_name}")
+    create_archive_listing(destination_path, source_part_name)
+
+
+def _split_into_parts(source_path, destination_path, split_size, force=False, max_files_per_part=None,
+                      balanced_parts=False, split_compression=None):
+    helpers.handle_destination_directory_creation(destination_path, force)
+
+    _log_split_size(split_size, split_compression)
+    split_archives = splitter.split_directory_into_parts(source_path, split_size, max_files_per_part, balanced_parts,
+                                                         compression=split_compression)
+    part_names = [f"{source_path.name}.part{index + 1}" for index in range(len(split_archives))]
+
+    with open(destination_path / f"{source_path.name}.parts.txt", "w") as f:
+        f.write(f"{len(part_names)}\n")
+
+    return part_names, split_archives
+
+
+def _log_split_size(split_size, split_compression=None):
+    if split_compression is None:
+        logging.info(f"Using a split size of {split_size} bytes ({split_size/1024**3:.3f}GB).")
+    else:
+        logging.info(f"Using a compressed split size of {split_size} bytes ({split_size/1024**3:.3f}GB), "
+                     f"estimated for compression level {split_compression}.")
+
+
+def _pump_stream(reader, closing_sinks):
+    try:
+        reader.drain()
+    except Exception:
+        # unblock the process writing into the stream, s.t. the whole pipeline terminates
+        reader.stream.close()
+        raise
+    finally:
+        for sink in closing_sinks:
+            sink.close()
+
+
+def create_archive_pipeline(source_path, destination_path, source_name, archive_list=None, work_dir=None, threads=1,
+                            compression=DEFAULT_COMPRESSION_LEVEL, encryption_keys=None, remove_unencrypted=False,
+                            hash_algorithm=DEFAULT_HASH_ALGORITHM):
+    """
+    Creates the compressed and optionally encrypted archive by chaining tar, plzip and gpg through pipes.
+
+    No intermediate .tar (or .tar.lz, if the unencrypted archive is removed) is written. The hash list,
+    the listing and the hashes of the .tar, .tar.lz and .tar.lz.gpg are all computed on the streams.
+    """
+    tar_path = destination_path.joinpath(source_name + ".tar").absolute()
+    compressed_path = helpers.add_suffix_to_path(tar_path, ".lz")
+    encrypted_path = helpers.add_suffix_to_path(compressed_path, ".gpg")
+    listing_path = destination_path.joinpath(source_name + ".tar.lst")
+    source_path_parent = source_path.absolute().parent
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as temp_path_string, ExitStack() as stack:
+        if archive_list:
+            tmp_file_path = Path(temp_path_string) / "paths.txt"
+            write_tar_path_list(source_path, archive_list, tmp_file_path)
+
+            tar_cmd = ["tar", "--posix", "-cf", "-", "-C", source_path_parent, "--null", "--files-from", tmp_file_path]
+        else:
+            tar_cmd = ["tar", "--posix", "-cf", "-", "-C", source_path_parent, source_path.name]
+
+        listing_cmd = ["tar", "-tvf", "-"]
+        plzip_cmd = ["plzip", f"-{compression}", "--threads", str(threads)]
+        encryption_cmd = get_stream_encryption_command(encryption_keys) if encryption_keys else None
+
+        logging.debug(f"Executing pipeline: '{tar_cmd} | {plzip_cmd}{f' | {encryption_cmd}' if encryption_cmd else ''}'")
+
+        listing_file = stack.enter_context(open(listing_path, "w"))
+        lzip_scanner = member_index.LzipMemberScanner()
+        compressed_sinks = [lzip_scanner]
+        if not (encryption_cmd and remove_unencrypted):
+            compressed_sinks.append(stack.enter_context(open(compressed_path, "wb")))
+        encrypted_file = stack.enter_context(open(encrypted_path, "wb")) if encryption_cmd else None
+
+        # entered last, s.t. the pumps are finished before any file is closed
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=2))
+
+        tar_process = subprocess.Popen(tar_cmd, stdout=subprocess.PIPE)
+        listing_process = subprocess.Popen(listing_cmd, stdin=subprocess.PIPE, stdout=listing_file, stderr=subprocess.STDOUT)
+        plzip_process = subprocess.Popen(plzip_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        processes = [(tar_process, tar_cmd), (listing_process, listing_cmd), (plzip_process, plzip_cmd)]
+
+        pumps = []
+        closing_sinks = []
+        encrypted_reader = None
+        if encryption_cmd:
+            encryption_process = subprocess.Popen(encryption_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            processes.append((encryption_process, encryption_cmd))
+            compressed_sinks.append(encryption_process.stdin)
+            closing_sinks.append(encryption_process.stdin)
+
+            encrypted_reader = streaming.HashingReader(encryption_process.stdout, [encrypted_file], hash_algorithm)
+            pumps.append(executor.submit(_pump_stream, encrypted_reader, []))
+
+        compressed_reader = streaming.HashingReader(plzip_process.stdout, compressed_sinks, hash_algorithm)
+        pumps.append(executor.submit(_pump_stream, compressed_reader, closing_sinks))
+
+        tar_reader = streaming.HashingReader(tar_process.stdout, [plzip_process.stdin, listing_process.stdin],
+                                             hash_algorithm)
+        tar_members = []
+        try:
+            hashes = []
+            for path, file_hash, member in streaming.hash_tar_members(
+                    tar_reader, hash_algorithm,
+                    on_member=lambda member: tar_members.append(member_index.get_tar_member_range(member)),
+                    is_directory_link=_get_directory_link_predicate(source_path)):
+                if member.issym():
+                    helpers.check_symlinks(source_path.parent / member.name, source_path)
+                hashes.append([path, file_hash])
+
+            tar_reader.drain()
+        finally:
+            tar_process.stdout.close()
+            plzip_process.stdin.close()
+            listing_process.stdin.close()
+
+        for pump in pumps:
+            pump.result()
+
+        for process, cmd in processes:
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(process.returncode, cmd)
+
+    write_file_listing_hash(sorted(hashes, key=lambda p: p[0]), destination_path.joinpath(source_name + ".md5"),
+                            hash_algorithm)
+    helpers.write_file_hash(tar_path, tar_reader.hexdigest(), hash_algorithm)
+    helpers.write_file_hash(compressed_path, compressed_reader.hexdigest(), hash_algorithm)
+
+    if encrypted_reader:
+        helpers.write_file_hash(encrypted_path, encrypted_reader.hexdigest(), hash_algorithm)
+
+    # without the .tar.lz, the index is named after the encrypted archive
+    member_index.create_member_index(compressed_path, tar_members, lzip_scanner,
+                                     encrypted_path if encryption_cmd and remove_unencrypted else None)
+
+
+def create_split_archive_pipeline(source_path, destination_path, split_size, work_dir=None, threads=1,
+                                  compression=DEFAULT_COMPRESSION_LEVEL, encryption_keys=None, remove_unencrypted=False,
+                                  force=False, hash_algorithm=DEFAULT_HASH_ALGORITHM, max_files_per_part=None,
+                                  balanced_parts=False, split_compression=None):
+    part_names, split_archives = _split_into_parts(source_path, destination_path, split_size, force, max_files_per_part,
+                                                   balanced_parts, split_compression)
+
+    # the threads are shared by the plzip processes of the parts processed concurrently
+    job_threads = helpers.get_lzip_job_threads(threads, len(part_names))
+
+    def create_part(part, nr_threads):
+        part_name, archive_list = part
+        logging.info(f"Create archive for {part_name} using a pipeline of tar, plzip{' and gpg' if encryption_keys else ''} "
+                     f"with {nr_threads} threads")
+        create_archive_pipeline(source_path, destination_path, part_name, archive_list, work_dir, nr_threads,
+                                compression, encryption_keys, remove_unencrypted, hash_algorithm)
+
+    if len(job_threads) > 1:
+        logging.info(f"Creating {len(part_names)} parts, {len(job_threads)} at a time")
+    with ThreadPoolExecutor(len(job_threads)) as executor:
+        list(executor.map(helpers.with_job_threads(create_part, job_threads), zip(part_names, split_archives)))
 
 
 def create_archive_listing(destination_path, source_name):
@@ -232,20 +567,50 @@ def compress_and_hash(destination_path, threads, compression, part=None):
 
     part_names = [os.path.splitext(p.name)[0] for p in helpers.sort_paths_with_part(parts)]
 
-    # compress sequentially
-    for part in part_names:
-        logging.info(f"Compressing {part} using {threads} threads.")
-        compress_using_lzip(destination_path, part, threads, compression)
+    compress_and_hash_concurrently(destination_path, part_names, threads, compression)
+
 
-    # compute md5sums of archive parts in parallel
-    logging.info(f"Generate hash of compressed tar {','.join(part_names)} using {threads} threads.")
+def compress_and_hash_concurrently(destination_path, part_names, threads, compression):
+    """
+    Compresses parts with concurrent plzip processes that share the thread budget and hashes every
+    compressed part as soon as it has been written.
 
-    helpers.exec_parallel(create_and_write_compressed_archive_hash, part_names, lambda part: (destination_path, part),
-                          min(threads, len(parts)))
+    plzip scales poorly on small parts and towards the end of every part, so several jobs with
+    fewer threads each keep more cores busy than a single job using all threads. Larger parts are
+    started first s.t. no large part is left running alone at the end.
+    """
+    job_threads = helpers.get_lzip_job_threads(threads, len(part_names))
+
+    def hash_compressed(part):
+        logging.info(f"Generate hash of compressed tar {part}.")
+        create_and_write_compressed_archive_hash(destination_path, part)
+
+    part_names = sorted(part_names, key=lambda part: destination_path.joinpath(part + ".tar").stat().st_size,
+                        reverse=True)
+    logging.info(f"Compressing {len(part_names)} parts in {len(job_threads)} concurrent jobs.")
+
+    stages = [("compress", _get_compression_function(destination_path, job_threads, compression), stages_executor.CPU),
+              ("hash", hash_compressed, stages_executor.IO)]
+    stages_executor.run_stages(part_names, stages,
+                               {stages_executor.IO: len(job_threads), stages_executor.CPU: len(job_threads)})
+
+
+def _get_compression_function(destination_path, job_threads, compression):
+    """Returns a function compressing a part using the threads of one of the concurrent compression jobs"""
+    def compress(part, nr_threads):
+        logging.info(f"Compressing {part} using {nr_threads} threads.")
+        compress_using_lzip(destination_path, part, nr_threads, compression)
+
+    return helpers.with_job_threads(compress, job_threads)
 
 
 def compress_using_lzip(destination_path, source_name, threads, compression):
+    """
+    Compresses the tar archive with plzip and writes the member index of the compressed archive,
+    from the ranges of the tar members recorded when the archive has been created
+    """
     path = destination_path.joinpath(source_name + ".tar")
+    tar_members = member_index.pop_tar_members(path)
 
     additional_arguments = []
 
@@ -253,18 +618,36 @@ def compress_using_lzip(destination_path, source_name, threads, compression):
         additional_arguments.extend(["--threads", str(threads)])
 
     helpers.run_shell_cmd(["plzip", path, f"-{compression}"] + additional_arguments)
+    member_index.create_member_index(helpers.add_suffix_to_path(path, ".lz"), tar_members)
 
 
 def create_and_write_archive_hash(destination_path, source_name):
+    """
+    Hashes the tar archive and records the ranges of its members while reading it, s.t. the member index
+    is created without reading the archive again after compressing it
+    """
     path = destination_path.joinpath(source_name + ".tar").absolute()
+    hash_algorithm = get_hash_algorithm_of_listing(destination_path, source_name)
+
+    with open(path, "rb") as tar_file, member_index.record_tar_members(path) as record_member:
+        reader = streaming.HashingReader(tar_file, algorithm=hash_algorithm)
+        with tarfile.open(fileobj=reader, mode="r|", bufsize=STREAM_CHUNK_BYTE_SIZE) as tar:
+            for member in streaming.iter_tar_members(tar):
+                record_member(member)
+        reader.drain()
 
-    helpers.create_and_write_file_hash(path)
+    helpers.write_file_hash(path, reader.hexdigest(), hash_algorithm)
 
 
 def create_and_write_compressed_archive_hash(destination_path, source_name):
     path = destination_path.joinpath(source_name + ".tar.lz").absolute()
 
-    helpers.create_and_write_file_hash(path)
+    helpers.create_and_write_file_hash(path, get_hash_algorithm_of_listing(destination_path, source_name))
+
+
+def get_hash_algorithm_of_listing(destination_path, source_name):
+    """The hashes of the archive files use the same algorithm as the file hash list"""
+    return helpers.get_hash_algorithm_from_file(destination_path.joinpath(source_name + ".md5"))
 
 
 def do_encryption(destination_path, encryption_keys, remove_unencrypted=False, part=None, threads=1):
@@ -0,0 +1,154 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import helpers
+from .constants import CHUNK_HASH_SUFFIX, CHUNK_HASH_BYTE_SIZE, CHUNK_HASH_VERSION, CHUNK_HASH_HEADER_REGEX, \
+    COMPRESSED_ARCHIVE_SUFFIX, ENCRYPTED_ARCHIVE_SUFFIX, STREAM_CHUNK_BYTE_SIZE, DEFAULT_HASH_ALGORITHM
+from .encryption import get_hash_algorithm_of_archive
+from .hashing import get_hasher
+
+
+def get_chunk_hash_path(file_path):
+    return helpers.add_suffix_to_path(file_path, CHUNK_HASH_SUFFIX)
+
+
+def create_chunk_hash_files(archive_path, chunk_size=CHUNK_HASH_BYTE_SIZE, workers=1):
+    """Writes a chunk hash sidecar for every .tar.lz and .tar.lz.gpg file of an archive directory or for a single archive file"""
+    if archive_path.is_dir():
+        archive_files = helpers.get_files_with_type_in_directory(archive_path, COMPRESSED_ARCHIVE_SUFFIX) + \
+                        helpers.get_files_with_type_in_directory(archive_path, ENCRYPTED_ARCHIVE_SUFFIX)
+    else:
+        archive_files = [archive_path]
+
+    if not archive_files:
+        helpers.terminate_with_message(f"No {COMPRESSED_ARCHIVE_SUFFIX} or {ENCRYPTED_ARCHIVE_SUFFIX} files found in {archive_path}")
+
+    for archive_file in helpers.sort_paths_with_part(archive_files):
+        create_chunk_hash_file(archive_file, chunk_size, get_hash_algorithm_of_archive(archive_file), workers)
+
+
+def create_chunk_hash_file(file_path, chunk_size=CHUNK_HASH_BYTE_SIZE, algorithm=DEFAULT_HASH_ALGORITHM, workers=1):
+    """
+    Writes the hashes of consecutive chunks of a file and a root hash over all chunk hashes to
+    a sidecar, s.t. the file can be verified by several threads in parallel.
+    """
+    logging.info(f"Creating chunk hashes of {file_path} using {workers} threads")
+    file_size = file_path.stat().st_size
+    chunk_ranges = get_chunk_ranges(file_size, chunk_size)
+
+    chunk_hashes = hash_ranges(file_path, chunk_ranges, algorithm, workers)
+
+    with open(get_chunk_hash_path(file_path), "w") as chunk_hash_file:
+        chunk_hash_file.write(f"# archiver-chunk-hashes version={CHUNK_HASH_VERSION} algorithm={algorithm} "
+                              f"chunk_size={chunk_size} file_size={file_size} "
+                              f"root={get_root_hash(chunk_hashes, algorithm)}\n")
+        for (offset, length), chunk_hash in zip(chunk_ranges, chunk_hashes):
+            chunk_hash_file.write(f"{offset} {length} {chunk_hash}\n")
+
+
+def verify_chunk_hashes(file_path, workers=1):
+    """
+    Verifies a file against its chunk hash sidecar.
+
+    :return: list of byte ranges (start, end) that don't match, adjacent ranges are merged
+    """
+    algorithm, file_size, root_hash, chunk_ranges, expected_hashes = read_chunk_hash_file(get_chunk_hash_path(file_path))
+
+    if get_root_hash(expected_hashes, algorithm) != root_hash:
+        logging.error(f"Root hash of chunk hash file {get_chunk_hash_path(file_path)} does not match its chunk hashes.")
+        return [(0, max(file_size, file_path.stat().st_size))]
+
+    start = time.monotonic()
+    actual_hashes = hash_ranges(file_path, chunk_ranges, algorithm, workers)
+    _log_throughput(file_path, file_size, time.monotonic() - start)
+
+    bad_ranges = [(offset, offset + length) for (offset, length), actual, expected
+                  in zip(chunk_ranges, actual_hashes, expected_hashes) if actual != expected]
+
+    actual_size = file_path.stat().st_size
+    if actual_size > file_size:
+        bad_ranges.append((file_size, actual_size))
+
+    return merge_ranges(bad_ranges)
+
+
+def read_chunk_hash_file(chunk_hash_path):
+    """Returns the algorithm, file size and root hash from the header and the chunk ranges and their hashes"""
+    with open(chunk_hash_path, "r") as chunk_hash_file:
+        header = CHUNK_HASH_HEADER_REGEX.match(chunk_hash_file.readline())
+        if not header:
+            helpers.terminate_with_message(f"{chunk_hash_path} is not a valid chunk hash file")
+
+        version, algorithm, _, file_size, root_hash = header.groups()
+        if int(version) > CHUNK_HASH_VERSION:
+            helpers.terminate_with_message(f"Chunk hash file {chunk_hash_path} has version {version}, "
+                                           f"but only versions up to {CHUNK_HASH_VERSION} are supported.")
+
+        chunk_ranges = []
+        chunk_hashes = []
+        for line in chunk_hash_file:
+            offset, length, chunk_hash = line.split()
+            chunk_ranges.append((int(offset), int(length)))
+            chunk_hashes.append(chunk_hash)
+
+    return algorithm, int(file_size), root_hash, chunk_ranges, chunk_hashes
+
+
+def get_chunk_ranges(file_size, chunk_size):
+    return [(offset, min(chunk_size, file_size - offset)) for offset in range(0, file_size, chunk_size)]
+
+
+def hash_ranges(file_path, ranges, algorithm, workers=1):
+    """Hashes the given (offset, length) ranges of a file with a thread pool, reading them with pread"""
+    fd = os.open(file_path, os.O_RDONLY)
+
+    try:
+        with ThreadPoolExecutor(workers) as executor:
+            return list(executor.map(lambda r: _hash_range(fd, r[0], r[1], algorithm), ranges))
+    finally:
+        os.close(fd)
+
+
+def _hash_range(fd, offset, length, algorithm):
+    hasher = get_hasher(algorithm)
+    end = offset + length
+
+    while offset < end:
+        data = os.pread(fd, min(STREAM_CHUNK_BYTE_SIZE, end - offset), offset)
+        if not data:
+            # the file is shorter than expected
+            break
+        hasher.update(data)
+        offset += len(data)
+
+    return hasher.hexdigest()
+
+
+def get_root_hash(chunk_hashes, algorithm):
+    hasher = get_hasher(algorithm)
+    for chunk_hash in chunk_hashes:
+        hasher.update(chunk_hash.encode("ascii"))
+
+    return hasher.hexdigest()
+
+
+def merge_ranges(ranges):
+    merged = []
+
+    for start, end in sorted(ranges):
+        if merged and merged[-1][1] >= start:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def _log_throughput(file_path, nr_bytes, duration):
+    # avoid division by zero for empty or very fast runs
+    duration = max(duration, 1e-6)
+
+    logging.info(f"Verified chunk hashes of {file_path.name} ({nr_bytes / 1000**2:.1f} MB) in {duration:.1f}s: "
+                 f"{nr_bytes / 1000**2 / duration:.1f} MB/s")
@@ -9,8 +9,60 @@ COMPRESSED_ARCHIVE_HASH_SUFFIX = ".tar.lz.md5"
 ENCRYPTED_ARCHIVE_HASH_SUFFIX = ".tar.lz.gpg.md5"
 LISTING_SUFFIX = ".tar.lst"
 READ_CHUNK_BYTE_SIZE = 1000 * 1000 * 100
+STREAM_CHUNK_BYTE_SIZE = 1024 * 1024
+# files below this size are hashed in batches by a process pool, larger ones by a thread pool
+SMALL_FILE_BYTE_SIZE = 1024 * 1024
+HASH_BATCH_FILE_COUNT = 1000
+HASH_BATCH_BYTE_SIZE = 1024 * 1024 * 64
+# sampling for estimating the compressed size of directories
+COMPRESSION_SAMPLE_BYTE_SIZE = 1024 * 1024
+COMPRESSION_SAMPLE_CHUNK_BYTE_SIZE = 1024 * 64
+COMPRESSION_SAMPLE_MIN_BYTE_SIZE = 1024 * 1024 * 16
+TAR_BLOCK_BYTE_SIZE = 512
+HASH_CACHE_FILE_NAME = "archiver-hash-cache.sqlite"
+HASH_CACHE_MAX_ENTRIES = 10 * 1000 * 1000
+# inodes looked up in the hash cache per query, below SQLite's default limit of 999 parameters
+HASH_CACHE_LOOKUP_BATCH = 900
+# files modified less than this before hashing started are not cached (timestamp resolution of e.g. FAT is 2s)
+HASH_CACHE_RACY_NS = 2 * 1000**3
+CHUNK_HASH_SUFFIX = ".chunks"
+SCRUB_LEDGER_FILE_NAME = "archiver-scrub-ledger.sqlite"
+CHECK_JOURNAL_FILE_PREFIX = "archiver-check-state-"
+# hashes of files checked by streaming deep checks are recorded after this many files or seconds
+CHECK_JOURNAL_MEMBER_BATCH = 1000
+CHECK_JOURNAL_MEMBER_INTERVAL_SECONDS = 60
+# kept in the destination directory until the extraction has completed
+EXTRACTION_JOURNAL_FILE_NAME = ".archiver-extraction-state.jsonl"
+# the last file extracted from a part is recorded at most every this many seconds
+EXTRACTION_JOURNAL_MEMBER_INTERVAL_SECONDS = 10
+CHUNK_HASH_BYTE_SIZE = 1024 * 1024 * 64
+# sidecar of a .tar.lz with the offsets of its tar and lzip members, for decompressing single files
+MEMBER_INDEX_SUFFIX = ".idx"
+# sidecar of a .tar with the ranges of its members, kept until its member index has been created
+TAR_MEMBERS_SUFFIX = ".members"
+LZIP_MAGIC = b"LZIP"
+LZIP_HEADER_BYTE_SIZE = 6
+LZIP_TRAILER_BYTE_SIZE = 20
 ENCRYPTION_ALGORITHM = "AES256"
 ENV_VAR_MAPPER_MAX_CPUS = "ARCHIVER_MAX_CPUS_ENV_VAR"
 DEFAULT_COMPRESSION_LEVEL = 6
+# parts are (de)compressed by concurrent plzip jobs with at least this many threads each
+MIN_THREADS_PER_LZIP_JOB = 4
+# symlinks in archives are resolved in memory following at most this many links (as Linux does)
+MAX_SYMLINK_HOPS = 40
+# paths indexed for resolving symlinks are sorted in runs of this many paths
+PATH_INDEX_RUN_LENGTH = 1000 * 1000
+# confidence level of the statement on the share of corrupted files after a sampled check
+SAMPLE_CONFIDENCE = 0.95
 
 MD5_LINE_REGEX = re.compile(r'(\S+)\s+(\S.*)')
+DEFAULT_HASH_ALGORITHM = "md5"
+# hash files of algorithms other than md5 start with this header, md5 hash files have no header (version 1)
+HASH_MANIFEST_VERSION = 2
+HASH_MANIFEST_HEADER_REGEX = re.compile(r'# archiver-hash-manifest version=(\d+) algorithm=(\S+)')
+# sidecar with the hashes of fixed-size chunks of an archive file, for verifying it in parallel
+CHUNK_HASH_VERSION = 1
+CHUNK_HASH_HEADER_REGEX = re.compile(
+    r'# archiver-chunk-hashes version=(\d+) algorithm=(\S+) chunk_size=(\d+) file_size=(\d+) root=(\S+)')
+MEMBER_INDEX_VERSION = 1
+MEMBER_INDEX_HEADER_REGEX = re.compile(r'# archiver-member-index version=(\d+) tar_size=(\d+) compressed_size=(\d+)')
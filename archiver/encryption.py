@@ -4,14 +4,15 @@ from pathlib import Path
 import os
 
 from . import helpers
-from .constants import REQUIRED_SPACE_MULTIPLIER, ENCRYPTION_ALGORITHM
+from .constants import REQUIRED_SPACE_MULTIPLIER, ENCRYPTION_ALGORITHM, DEFAULT_HASH_ALGORITHM, MEMBER_INDEX_SUFFIX
 
 
 def _encrypt_list_of_archives_fnc(output_dir, archive_path, encryption_keys, delete):
     output_file = output_dir / archive_path.name if output_dir else archive_path
     output_path = helpers.add_suffix_to_path(output_file, ".gpg")
+    hash_algorithm = get_hash_algorithm_of_archive(archive_path)
     encrypt_archive(archive_path, output_path, encryption_keys, delete)
-    helpers.create_and_write_file_hash(output_path)
+    helpers.create_and_write_file_hash(output_path, hash_algorithm)
 
 
 def encrypt_list_of_archives(archive_list, encryption_keys, delete=False, output_dir=None, threads=1):
@@ -25,13 +26,7 @@ def encrypt_list_of_archives(archive_list, encryption_keys, delete=False, output
 def encrypt_archive(archive_path, output_path, encryption_keys, delete=False):
     logging.info("Encrypting archive: " + helpers.get_absolute_path_string(archive_path))
 
-    argument_encryption_list = []
-
-    for key_path_string in encryption_keys:
-        key_path = Path(key_path_string).absolute().as_posix()
-
-        argument_encryption_list.append("--recipient-file")
-        argument_encryption_list.append(key_path)
+    argument_encryption_list = get_recipient_arguments(encryption_keys)
 
     try:
         helpers.run_shell_cmd(["gpg", "--cipher-algo", ENCRYPTION_ALGORITHM, "-z", "0", "--batch", "--output", output_path, "--encrypt"] + argument_encryption_list + [archive_path])
@@ -39,12 +34,48 @@ def encrypt_archive(archive_path, output_path, encryption_keys, delete=False):
         if delete:
             logging.debug("Deleting unencrypted archive: " + helpers.get_absolute_path_string(archive_path))
             os.remove(archive_path)
+            # the member index is valid for the encrypted archive as well and is named after it now
+            index_path = helpers.add_suffix_to_path(archive_path, MEMBER_INDEX_SUFFIX)
+            if index_path.is_file():
+                index_path.replace(helpers.add_suffix_to_path(output_path, MEMBER_INDEX_SUFFIX))
     except subprocess.CalledProcessError:
         helpers.terminate_with_message(f"Encryption of archive {archive_path} failed.")
 
     logging.info(f"Encryption of archive {archive_path} complete.")
 
 
+def get_hash_algorithm_of_archive(archive_path):
+    """The hash of the encrypted archive uses the same algorithm as the hash of the unencrypted one"""
+    archive_hash_path = helpers.add_suffix_to_path(archive_path, ".md5")
+
+    if archive_hash_path.exists():
+        return helpers.get_hash_algorithm_from_file(archive_hash_path)
+
+    return DEFAULT_HASH_ALGORITHM
+
+
+def get_recipient_arguments(encryption_keys):
+    argument_encryption_list = []
+
+    for key_path_string in encryption_keys:
+        key_path = Path(key_path_string).absolute().as_posix()
+
+        argument_encryption_list.append("--recipient-file")
+        argument_encryption_list.append(key_path)
+
+    return argument_encryption_list
+
+
+def get_stream_encryption_command(encryption_keys):
+    """gpg command encrypting stdin to stdout"""
+    return ["gpg", "--cipher-algo", ENCRYPTION_ALGORITHM, "-z", "0", "--batch", "--encrypt"] + get_recipient_arguments(encryption_keys)
+
+
+def get_stream_decryption_command():
+    """gpg command decrypting the file appended to it to stdout"""
+    return ["gpg", "--decrypt", "--quiet"]
+
+
 def _decrypt_list_of_archives_fnc(archive_path, target_directory, delete):
     decrypt_archive(archive_path, target_directory, delete)
 
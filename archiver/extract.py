@@ -1,11 +1,24 @@
+import hashlib
+import json
 import logging
 import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 from . import helpers
 from . import listing
-from .constants import COMPRESSED_ARCHIVE_SUFFIX, ENCRYPTED_ARCHIVE_SUFFIX, \
-    REQUIRED_SPACE_MULTIPLIER
+from . import member_index
+from . import streaming
+from .constants import COMPRESSED_ARCHIVE_SUFFIX, ENCRYPTED_ARCHIVE_SUFFIX, HASH_SUFFIX, \
+    REQUIRED_SPACE_MULTIPLIER, EXTRACTION_JOURNAL_MEMBER_INTERVAL_SECONDS
 from .encryption import decrypt_list_of_archives
+from .journal import ExtractionJournal, get_extraction_journal_path
 
 
 # Should there be a flag or automatically recongnize encrypted archives?
@@ -31,9 +44,25 @@ def decrypt_existing_archive(archive_path, destination_dir=None, remove_unencryp
     decrypt_list_of_archives([archive_path], destination_dir, delete=remove_unencrypted, threads=threads)
 
 
-def extract_archive(source_path, destination_directory_path, partial_extraction_path=None, threads=None, force=False, extract_at_destination=False):
-    # Create destination folder if nonexistent or overwrite if --force option used
-    helpers.handle_destination_directory_creation(destination_directory_path, force)
+def extract_archive(source_path, destination_directory_path, partial_extraction_path=None, threads=None, force=False,
+                    selection=None, resume=False, report=None):
+    """
+    Extracts the whole archive, or only the files below partial_extraction_path or selected by a listing.MemberSelection.
+    For partial extractions, the parts needed are determined from the listings and each of them is decompressed once.
+    Encrypted archives are decrypted in a stream while they are extracted, no decrypted copies are written.
+
+    The progress is recorded in a journal in the destination directory until the extraction has completed. With resume,
+    an extraction into an existing destination continues without extracting the parts (and, for parts with a member
+    index, the files) again that have been extracted before.
+
+    With a RestoreReport, the files are hashed while they are extracted and compared to the hash listings of the
+    parts, the results are added to the report.
+    """
+    if resume and destination_directory_path.is_dir():
+        logging.info(f"Resuming extraction into {helpers.get_absolute_path_string(destination_directory_path)}")
+    else:
+        # Create destination folder if nonexistent or overwrite if --force option used
+        helpers.handle_destination_directory_creation(destination_directory_path, force)
 
     if not threads:
         threads=1
@@ -42,64 +71,366 @@ def extract_archive(source_path, destination_directory_path, partial_extraction_
     archive_files_all = sorted(helpers.get_archives_from_path(source_path, is_encrypted))
 
     if partial_extraction_path:
-        archive_files = listing.relevant_splits_for_partial_path(source_path, partial_extraction_path)
+        selection = listing.MemberSelection([partial_extraction_path])
+
+    if selection:
+        plan = listing.plan_extraction(source_path, selection)
+        archive_files = [path for path in archive_files_all if helpers.filename_without_archive_extensions(path) in plan]
+        selections = [plan[helpers.filename_without_archive_extensions(path)] for path in archive_files]
     else:
         archive_files = archive_files_all
-
-    if is_encrypted:
-        # It might make sense to check that enough space is available for:
-        # archive encryption (encrypted archive size * multiplier) AND unencrypted archive size -> hard to estimate on encrypted archive
-        # Workaround would be to require enough space for  "encrypted archive size" * 2
-        ensure_sufficient_disk_capacity_for_encryption(archive_files, destination_directory_path)
-
-        # Only pass destination path if encryption output was stored at destination
-        # For example: deep integrity check should decrypt the archive in the tmp folder, in order to not touch the archive folder
-        destination_path = destination_directory_path if extract_at_destination else None
-
-        decrypt_list_of_archives(archive_files, destination_path, threads=threads)
-        archive_files = get_archive_names_after_encryption(archive_files, destination_path)
-
-    ensure_sufficient_disk_capacity_for_extraction(archive_files, destination_directory_path)
-
-    uncompress_and_extract(archive_files, destination_directory_path, threads, partial_extraction_path=partial_extraction_path)
+        selections = [None] * len(archive_files)
+
+    journal_path = get_extraction_journal_path(destination_directory_path)
+    with ExtractionJournal(journal_path, resume) as journal:
+        remaining_parts = [(path, part_selection) for path, part_selection in zip(archive_files, selections)
+                           if not journal.is_part_done(path, get_extraction_kind(part_selection))]
+        if len(remaining_parts) < len(archive_files):
+            logging.info(f"Skipping {len(archive_files) - len(remaining_parts)} archives extracted before")
+            if report:
+                remaining_paths = [path for path, _ in remaining_parts]
+                report.add_skipped_parts([path for path in archive_files if path not in remaining_paths])
+
+        if remaining_parts:
+            archive_files, selections = map(list, zip(*remaining_parts))
+            is_directory_link = _get_directory_link_predicate(archive_files_all) if report else None
+            _extract_archive_files(archive_files, destination_directory_path, threads, selections, journal, report,
+                                   is_directory_link)
+
+    journal_path.unlink()
 
     logging.info("Archive extracted to: " + helpers.get_absolute_path_string(destination_directory_path))
+    if report:
+        logging.log(logging.INFO if report.success else logging.ERROR, report.get_lines()[-1])
     return destination_directory_path / helpers.filename_without_extensions(source_path)
 
 
-def uncompress_and_extract(archive_file_paths, destination_directory_path, threads, partial_extraction_path=None, encrypted=False):
-    for archive_path in archive_file_paths:
-        logging.info(
-            f"Extracting {partial_extraction_path if partial_extraction_path else 'all'} "
-            f"from archive {helpers.get_absolute_path_string(archive_path)}")
-
-        plzip_cmd = ["plzip", "--decompress", "--stdout", archive_path]
-        if threads:
-            plzip_cmd.extend(["--threads", str(threads)])
+def _extract_archive_files(archive_files, destination_directory_path, threads, selections, journal, report=None,
+                           is_directory_link=None):
+    hash_listing_paths = None
+    if report:
+        hash_listing_paths = [path.parent / (helpers.filename_without_archive_extensions(path) + HASH_SUFFIX)
+                              for path in archive_files]
+        for path in hash_listing_paths:
+            helpers.terminate_if_path_nonexistent(path)
 
-        tar_cmd = ["tar", "-x", "-C", destination_directory_path]
-        if partial_extraction_path:
-            tar_cmd.append(partial_extraction_path)
+    ensure_sufficient_disk_capacity_for_extraction(archive_files, destination_directory_path)
 
-        logging.debug(f"Executing command: '{plzip_cmd} | {tar_cmd}'")
+    uncompress_and_extract(archive_files, destination_directory_path, threads, selections=selections, journal=journal,
+                           hash_listing_paths=hash_listing_paths, report=report, is_directory_link=is_directory_link)
+
+
+def _get_directory_link_predicate(archive_files):
+    """Symlinks to directories are resolved against the listings of all parts, see streaming.hash_tar_members"""
+    listing_paths = [listing.get_listing_path(path) for path in archive_files]
+
+    return listing.get_directory_link_predicate(listing.index_listing_paths(path for path in listing_paths
+                                                                            if path.is_file()))
+
+
+def get_extraction_kind(selection=None):
+    """Identifies the files extracted from a part in the extraction journal"""
+    if not selection:
+        return "all"
+
+    selectors = json.dumps(selection.get_selectors())
+    return "selection-" + hashlib.md5(selectors.encode("utf-8")).hexdigest()[:16]
+
+
+def uncompress_and_extract(archive_file_paths, destination_directory_path, threads, selections=None, encrypted=False,
+                           index_paths=None, journal=None, hash_listing_paths=None, report=None, is_directory_link=None):
+    """
+    Extracts the parts concurrently into the same destination, since they contain disjoint files.
+    The threads are shared by the plzip processes of the parts extracted at the same time.
+
+    :param selections: listing.MemberSelection of the files to extract for every part, all files by default
+    :param index_paths: paths of the member indexes of the parts, by default they are looked up next to the parts
+    :param journal: ExtractionJournal recording the progress
+    :param hash_listing_paths: with a RestoreReport, the files of every part are verified against these hash listings
+    :param is_directory_link: tells which symlinks point to directories, these aren't verified like in the hash listings
+    """
+    job_threads = helpers.get_lzip_job_threads(threads, len(archive_file_paths))
+    progress = _ExtractionProgress(len(archive_file_paths))
+    selections = dict(zip(archive_file_paths, selections)) if selections else {}
+    index_paths = dict(zip(archive_file_paths, index_paths)) if index_paths else {}
+    hash_listing_paths = dict(zip(archive_file_paths, hash_listing_paths)) if report else {}
+
+    def extract_part(archive_path, nr_threads):
+        selection = selections.get(archive_path)
+        part_journal = _PartJournal(journal, archive_path, selection, index_paths.get(archive_path)) if journal else None
+
+        verification = _uncompress_and_extract_part(archive_path, destination_directory_path, nr_threads, selection,
+                                                    index_paths.get(archive_path), part_journal,
+                                                    hash_listing_paths.get(archive_path), is_directory_link)
+        if report:
+            report.add_part(verification)
+        progress.part_done(archive_path, destination_directory_path)
+
+    extract_part_with_job_threads = helpers.with_job_threads(extract_part, job_threads)
+
+    if len(job_threads) > 1:
+        logging.info(f"Extracting {len(archive_file_paths)} archives, {len(job_threads)} at a time")
+
+    failed_parts = []
+    with ThreadPoolExecutor(len(job_threads)) as executor:
+        futures = {executor.submit(extract_part_with_job_threads, archive_path): archive_path
+                   for archive_path in archive_file_paths}
+        for future, archive_path in futures.items():
+            try:
+                future.result()
+            except (subprocess.CalledProcessError, tarfile.TarError, ValueError, OSError) as error:
+                logging.error(f"Extraction of archive {archive_path} failed: {error}")
+                failed_parts.append(archive_path.name)
+
+    if failed_parts:
+        if journal:
+            logging.info(f"Progress is recorded in {journal.path}, continue the extraction with --resume")
+        helpers.terminate_with_message(f"Extraction of {len(failed_parts)} of {len(archive_file_paths)} archives "
+                                       f"failed: {', '.join(failed_parts)}")
+
+
+def _uncompress_and_extract_part(archive_path, destination_directory_path, threads, selection=None, index_path=None,
+                                 part_journal=None, hash_listing_path=None, is_directory_link=None):
+    """
+    With a selection, only the parts of the archive containing the selected files are decompressed if it has a member index.
+    With a hash listing, the stream is parsed while tar extracts it and the files are verified, a PartVerification is returned.
+    """
+    logging.info(
+        f"Extracting {selection if selection else 'all'} "
+        f"from archive {helpers.get_absolute_path_string(archive_path)}")
+
+    tar_cmd = ["tar", "-x", "-C", destination_directory_path]
+    select = selection.matches if selection else None
+    tar_selection = selection
+    hash_result = None
+    recording = None
+
+    if part_journal:
+        select, tar_selection = part_journal.get_remaining_members_selection(selection, archive_path, index_path)
+    if part_journal and part_journal.records_members:
+        # tar lists every file when it starts extracting it
+        tar_cmd.append("-v")
+
+    with tempfile.TemporaryDirectory() as temp_path_string:
+        if tar_selection:
+            tar_cmd.extend(tar_selection.write_tar_arguments(Path(temp_path_string)))
+
+        with member_index.open_archive_stream(archive_path, select, threads, index_path) as stream:
+            logging.debug(f"Executing command: '{tar_cmd}'")
+            process = subprocess.Popen(tar_cmd, stdin=subprocess.PIPE if hash_listing_path else stream,
+                                       stdout=subprocess.PIPE if "-v" in tar_cmd else None)
+
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                if "-v" in tar_cmd:
+                    recording = executor.submit(part_journal.record_extracted_members, process.stdout)
+                if hash_listing_path:
+                    hash_result = _hash_members_while_extracting(stream, process, hash_listing_path, selection,
+                                                                 is_directory_link)
+
+            returncode = process.wait()
+            # tar fails as well if recording failed, since its output has been closed then
+            if recording:
+                recording.result()
+            if returncode:
+                raise subprocess.CalledProcessError(returncode, tar_cmd)
+
+    if part_journal:
+        part_journal.record_done()
+
+    if hash_listing_path:
+        skipped_members = part_journal.skipped_members if part_journal else set()
+        return verify_part(archive_path, hash_result, hash_listing_path, selection, skipped_members)
+
+
+def _hash_members_while_extracting(stream, tar_process, hash_listing_path, selection=None, is_directory_link=None):
+    """Parses the tar stream while it is copied to tar and returns the hashes of the files as list of [path, hash]"""
+    hash_algorithm = helpers.get_hash_algorithm_from_file(hash_listing_path)
+    # the tar stream itself isn't verified, it's only copied to tar
+    reader = streaming.HashingReader(stream, [tar_process.stdin], algorithm=None)
+    # files from before the stream (e.g. skipped by a member index) get the hash None if hard links point to them
+    select = selection.matches if selection else (lambda path: True)
+
+    try:
+        hash_result = [[path, file_hash] for path, file_hash, _
+                       in streaming.hash_tar_members(reader, hash_algorithm, select=select,
+                                                     is_directory_link=is_directory_link)]
+        reader.drain()
+    except BrokenPipeError:
+        # tar exited early, its exit status tells why
+        hash_result = []
+    finally:
         try:
-            p1 = subprocess.Popen(plzip_cmd, stdout=subprocess.PIPE)
-            p2 = subprocess.Popen(tar_cmd, stdin=p1.stdout)
-            p1.stdout.close()
-            p2.wait()
-        except subprocess.CalledProcessError:
-            helpers.terminate_with_message(f"Extraction of archive {archive_path} failed.")
-
-        destination_directory_path_string = helpers.get_absolute_path_string(destination_directory_path)
-
-        logging.info(f"Extracted archive {archive_path.stem} to {destination_directory_path_string}")
-
-
-def get_archive_names_after_encryption(archive_files, destination_path=None):
-    if destination_path:
-        return [destination_path / path.with_suffix("").name for path in archive_files]
-
-    return [path.with_suffix("") for path in archive_files]
+            tar_process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    return hash_result
+
+
+PartVerification = namedtuple('PartVerification', ['archive_name', 'nr_verified', 'corrupted', 'missing',
+                                                   'unexpected', 'unverified'])
+
+
+def verify_part(archive_path, hash_result, hash_listing_path, selection=None, skipped_members=frozenset()):
+    """
+    Compares the hashes of the files extracted from a part to its hash listing. Only the files of the listing which
+    have been selected and haven't been skipped (since they have been extracted before) are expected.
+    """
+    expected_dict = {path: file_hash for path, file_hash in helpers.read_hash_file(hash_listing_path).items()
+                     if (not selection or selection.matches(path)) and path not in skipped_members}
+    hash_result_dict = dict(hash_result)
+
+    unverified = sorted(path for path, file_hash in hash_result_dict.items() if file_hash is None)
+    verified = [path for path, file_hash in hash_result_dict.items()
+                if file_hash is not None and expected_dict.get(path) == file_hash]
+
+    return PartVerification(archive_path.name, len(verified),
+                            sorted(path for path, file_hash in hash_result_dict.items()
+                                   if file_hash is not None and path in expected_dict and expected_dict[path] != file_hash),
+                            sorted(expected_dict.keys() - hash_result_dict.keys()),
+                            sorted(hash_result_dict.keys() - expected_dict.keys() - set(unverified)),
+                            unverified)
+
+
+class RestoreReport:
+    """Results of verifying the files while they are extracted, collected from the parts extracted concurrently"""
+    def __init__(self):
+        self.parts = []
+        self.skipped_parts = []
+        self.lock = threading.Lock()
+
+    def add_part(self, verification):
+        with self.lock:
+            self.parts.append(verification)
+
+    def add_skipped_parts(self, archive_paths):
+        with self.lock:
+            self.skipped_parts.extend(path.name for path in archive_paths)
+
+    @property
+    def success(self):
+        return not any(part.corrupted or part.missing or part.unexpected for part in self.parts)
+
+    def get_lines(self):
+        lines = []
+        parts = sorted(self.parts)
+
+        for part in parts:
+            lines.append(f"{part.archive_name}: {part.nr_verified} files verified, {len(part.corrupted)} corrupted, "
+                         f"{len(part.missing)} missing, {len(part.unexpected)} not in hash listing, "
+                         f"{len(part.unverified)} unverified")
+        for name in sorted(self.skipped_parts):
+            lines.append(f"{name}: not verified, extracted before")
+
+        for label, attribute in [("CORRUPTED", "corrupted"), ("MISSING", "missing"),
+                                 ("NOT IN HASH LISTING", "unexpected"), ("UNVERIFIED", "unverified")]:
+            lines.extend(f"{label}: {path}" for part in parts for path in getattr(part, attribute))
+
+        nr_verified = sum(part.nr_verified for part in parts)
+        nr_problems = sum(len(part.corrupted) + len(part.missing) + len(part.unexpected) for part in parts)
+        lines.append(f"{'Restore verified' if self.success else 'Restore verification failed'}: "
+                     f"{nr_verified} files verified in {len(parts)} archives, {nr_problems} problems found")
+
+        return lines
+
+
+class _PartJournal:
+    """
+    Records the extraction of a part in the extraction journal. If the part has a member index, the files
+    extracted are known by their names in the verbose output of tar, which lists every file when it starts
+    extracting it, i.e. when the file before has been extracted completely. Without a member index, an interrupted
+    extraction can't continue within the part, so only the completed part is recorded.
+    """
+    def __init__(self, journal, part_path, selection, index_path=None):
+        self.journal = journal
+        self.part_path = part_path
+        self.kind = get_extraction_kind(selection)
+        self.skipped_members = set()
+        self.last_record = time.monotonic()
+        self.records_members = (index_path if index_path else member_index.find_member_index_path(part_path)) is not None
+
+        if not self.records_members:
+            logging.info(f"{part_path.name} has no member index, an interrupted extraction will extract it again "
+                         f"as a whole")
+
+    def get_remaining_members_selection(self, selection, archive_path, index_path):
+        """
+        Returns a predicate selecting the same files as selection (or all files), except for those up to the last file
+        extracted before, and the selection to pass to tar. Tar fails for paths and patterns not found in the stream,
+        so only those matching the remaining files are passed. If no file has been extracted before, the predicate of
+        selection is returned as is, s.t. the archive is only decompressed using its member index for a selection.
+        """
+        select = selection.matches if selection else None
+        last_member = self.journal.get_last_member(self.part_path, self.kind)
+
+        if last_member is not None:
+            index = member_index.load_member_index(archive_path, index_path)
+            if index is None or last_member not in (unicodedata.normalize('NFC', path) for _, _, path in index.tar_members):
+                logging.warning(f"Extracting {archive_path.name} from the beginning, since the last file extracted before "
+                                f"isn't contained in its member index")
+                last_member = None
+            else:
+                logging.info(f"Resuming extraction of {archive_path.name} after {last_member}")
+
+        if last_member is None:
+            return select, selection
+
+        skipping = True
+
+        def select_remaining(path):
+            nonlocal skipping
+            if skipping:
+                skipping = path != last_member
+                self.skipped_members.add(path)
+                return False
+
+            return not select or select(path)
+
+        if selection:
+            paths = [unicodedata.normalize('NFC', path) for _, _, path in index.tar_members]
+            remaining_paths = paths[paths.index(last_member) + 1:]
+            selection = selection.restricted_to({selector for path in remaining_paths
+                                                 for selector in selection.get_matching_selectors(path)})
+
+        return select_remaining, selection
+
+    def record_extracted_members(self, verbose_output):
+        """
+        Records the last file extracted every now and then, i.e. the one listed before the file tar has started
+        extracting. The files are matched by name, whatever else tar lists or leaves out.
+        """
+        try:
+            last_started = None
+            for line in verbose_output:
+                if last_started is not None and \
+                        time.monotonic() - self.last_record >= EXTRACTION_JOURNAL_MEMBER_INTERVAL_SECONDS:
+                    self.journal.record_last_member(self.part_path, self.kind, last_started)
+                    self.last_record = time.monotonic()
+                last_started = listing.parse_verbose_member_name(line)
+        except BaseException:
+            # otherwise tar blocks once the pipe is full, it gets SIGPIPE instead
+            verbose_output.close()
+            raise
+
+    def record_done(self):
+        self.journal.record_part_done(self.part_path, self.kind)
+
+
+class _ExtractionProgress:
+    """Logs the progress of parts extracted concurrently"""
+    def __init__(self, nr_parts):
+        self.nr_parts = nr_parts
+        self.nr_parts_done = 0
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def part_done(self, archive_path, destination_directory_path):
+        with self.lock:
+            self.nr_parts_done += 1
+            nr_parts_done = self.nr_parts_done
+
+        logging.info(f"Extracted archive {archive_path.stem} to {helpers.get_absolute_path_string(destination_directory_path)} "
+                     f"({nr_parts_done} of {self.nr_parts} archives after {time.monotonic() - self.start:.1f}s)")
 
 
 def ensure_sufficient_disk_capacity_for_extraction(archive_files, extraction_path):
@@ -107,19 +438,26 @@ def ensure_sufficient_disk_capacity_for_extraction(archive_files, extraction_pat
     available_bytes = helpers.get_device_available_capacity_from_path(extraction_path)
 
     for archive_path in archive_files:
-        archives_total_uncompressed_byte_size += helpers.get_uncompressed_archive_size_in_bytes(archive_path)
+        archives_total_uncompressed_byte_size += get_uncompressed_archive_size_in_bytes(archive_path)
 
     # multiply by REQUIRED_SPACE_MULTIPLIER for margin
     if available_bytes < archives_total_uncompressed_byte_size * REQUIRED_SPACE_MULTIPLIER:
         helpers.terminate_with_message("Not enough space available for archive extraction.")
 
 
-def ensure_sufficient_disk_capacity_for_encryption(archive_files, extraction_path):
-    total_archive_byte_size = 0
-    available_bytes = helpers.get_device_available_capacity_from_path(extraction_path)
+def get_uncompressed_archive_size_in_bytes(archive_path):
+    """Size of the tar archive, for encrypted archives taken from the member index or listing instead of decrypting it"""
+    if not archive_path.name.endswith(ENCRYPTED_ARCHIVE_SUFFIX):
+        return helpers.get_uncompressed_archive_size_in_bytes(archive_path)
 
-    for archive_path in archive_files:
-        total_archive_byte_size += helpers.get_size_of_file(archive_path)
+    index = member_index.load_member_index(archive_path)
+    if index:
+        return index.tar_size
+
+    listing_path = listing.get_listing_path(archive_path)
+    if not listing_path.is_file():
+        logging.warning(f"Size of {archive_path.name} after extraction is unknown, since its listing is missing")
+        return 0
 
-    if available_bytes < total_archive_byte_size * REQUIRED_SPACE_MULTIPLIER:
-        helpers.terminate_with_message("Not enough space available for archive encryption.")
+    # device files have their device numbers listed instead of a size
+    return sum(int(entry.size) for entry in listing.iter_tar_listing(listing_path) if entry.size.isdigit())
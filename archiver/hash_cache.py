@@ -0,0 +1,150 @@
+import logging
+import sqlite3
+import time
+
+from .constants import HASH_CACHE_MAX_ENTRIES, HASH_CACHE_RACY_NS, HASH_CACHE_LOOKUP_BATCH, DEFAULT_HASH_ALGORITHM
+from .hashing import hash_files
+
+# bump whenever the table layout or the meaning of a stored hash changes
+SCHEMA_VERSION = 2
+
+
+class HashCache:
+    """
+    Persistent cache of file hashes, stored as SQLite database (usually in the work dir).
+
+    Entries are keyed by (device, inode, size, mtime_ns, ctime_ns) as returned by lstat and the hash
+    algorithm. Hashes of different algorithms share the same database. Touching,
+    modifying, replacing or moving a file changes at least one of these, s.t. stale entries are never
+    hit again and eventually get evicted. Least recently used entries are evicted once the cache holds
+    more than `max_entries` entries.
+
+    The cache must only be used from a single process. Hashing itself may still happen in parallel.
+    """
+    def __init__(self, db_path, algorithm=DEFAULT_HASH_ALGORITHM, max_entries=HASH_CACHE_MAX_ENTRIES):
+        self.db_path = db_path
+        self.algorithm = algorithm
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(db_path)
+
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            self.connection.execute("DROP TABLE IF EXISTS file_hashes")
+            self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS file_hashes (
+                device INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                ctime_ns INTEGER NOT NULL,
+                algorithm TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                last_used INTEGER NOT NULL,
+                PRIMARY KEY (device, inode, size, mtime_ns, ctime_ns, algorithm)
+            ) WITHOUT ROWID""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS file_hashes_last_used ON file_hashes (last_used)")
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.evict()
+        self.connection.close()
+
+    def lookup(self, file_stats):
+        """
+        Returns the cached hash for every stat result, None if there is none.
+
+        The entries of many files are selected by a single query and the hits are marked as used at once,
+        instead of running two statements for every file.
+        """
+        now = time.time_ns()
+        keys = [self._cache_key(file_stat) for file_stat in file_stats]
+        requested_keys = set(keys)
+        inodes_by_device = {}
+        for key in requested_keys:
+            inodes_by_device.setdefault(key[0], []).append(key[1])
+        cached = {}
+
+        with self.connection:
+            for device, inodes in inodes_by_device.items():
+                # in the order of the primary key, s.t. the entries of a query and those marked as used are close
+                inodes.sort()
+                for start in range(0, len(inodes), HASH_CACHE_LOOKUP_BATCH):
+                    batch = inodes[start:start + HASH_CACHE_LOOKUP_BATCH]
+                    rows = self.connection.execute(f"""
+                        SELECT device, inode, size, mtime_ns, ctime_ns, algorithm, hash FROM file_hashes
+                        WHERE device = ? AND inode IN ({", ".join("?" * len(batch))}) AND algorithm = ?""",
+                        [device] + batch + [self.algorithm])
+                    # entries of other versions of the files are left out
+                    cached.update((row[:6], row[6]) for row in rows if row[:6] in requested_keys)
+
+            self.connection.executemany("""
+                UPDATE file_hashes SET last_used = ?
+                WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ? AND ctime_ns = ? AND algorithm = ?""",
+                [(now,) + key for key in cached])
+
+        return [cached.get(key) for key in keys]
+
+    def store(self, file_stats, hashes, hashing_started_ns):
+        """
+        Stores the hashes of files whose stat results were taken before hashing started at `hashing_started_ns`.
+
+        Files modified shortly before hashing started are not stored: due to the limited timestamp
+        resolution of some file systems, a modification during hashing may not change the mtime.
+        """
+        racy_limit = hashing_started_ns - HASH_CACHE_RACY_NS
+        now = time.time_ns()
+
+        entries = [self._cache_key(file_stat) + (file_hash, now) for file_stat, file_hash in zip(file_stats, hashes)
+                   if file_stat.st_mtime_ns < racy_limit]
+
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", entries)
+
+        return len(entries)
+
+    def evict(self):
+        nr_entries = self.connection.execute("SELECT COUNT(*) FROM file_hashes").fetchone()[0]
+        nr_evicted = nr_entries - self.max_entries
+
+        if nr_evicted > 0:
+            logging.info(f"Evicting {nr_evicted} least recently used entries from hash cache {self.db_path}")
+            with self.connection:
+                self.connection.execute("""
+                    DELETE FROM file_hashes WHERE (device, inode, size, mtime_ns, ctime_ns, algorithm) IN (
+                        SELECT device, inode, size, mtime_ns, ctime_ns, algorithm FROM file_hashes
+                        ORDER BY last_used LIMIT ?)""", (nr_evicted,))
+
+    def hash_files(self, file_paths, file_stats, max_workers=1):
+        """Same as hashing.hash_files but only files without a matching cache entry are hashed"""
+        hashes = self.lookup(file_stats)
+        missing = [i for i, file_hash in enumerate(hashes) if file_hash is None]
+
+        logging.info(f"Hash cache: {len(hashes) - len(missing)} hits, {len(missing)} misses")
+
+        if missing:
+            hashing_started_ns = time.time_ns()
+            missing_hashes = hash_files([file_paths[i] for i in missing],
+                                        [file_stats[i].st_size for i in missing], max_workers, self.algorithm)
+
+            for i, file_hash in zip(missing, missing_hashes):
+                hashes[i] = file_hash
+
+            self.store([file_stats[i] for i in missing], missing_hashes, hashing_started_ns)
+
+        return hashes
+
+    def _cache_key(self, file_stat):
+        return (_to_signed_64(file_stat.st_dev), _to_signed_64(file_stat.st_ino), file_stat.st_size,
+                file_stat.st_mtime_ns, file_stat.st_ctime_ns, self.algorithm)
+
+
+def _to_signed_64(value):
+    # SQLite integers are signed, but device and inode numbers may use the full unsigned range
+    return value - 2**64 if value >= 2**63 else value
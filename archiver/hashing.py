@@ -0,0 +1,146 @@
+import contextlib
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .constants import READ_CHUNK_BYTE_SIZE, SMALL_FILE_BYTE_SIZE, \
+    HASH_BATCH_FILE_COUNT, HASH_BATCH_BYTE_SIZE, DEFAULT_HASH_ALGORITHM
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+def get_available_hash_algorithms():
+    algorithms = ["md5", "sha256", "blake2b"]
+
+    if xxhash:
+        algorithms.append("xxh3")
+
+    return algorithms
+
+
+def get_hasher(algorithm=DEFAULT_HASH_ALGORITHM):
+    """Returns a new hash object with update() and hexdigest() for the given algorithm"""
+    if algorithm == "xxh3":
+        if not xxhash:
+            raise ValueError("Hash algorithm xxh3 requires the xxhash package")
+        return xxhash.xxh3_128()
+
+    if algorithm not in get_available_hash_algorithms():
+        raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+
+    return hashlib.new(algorithm)
+
+
+def get_file_hash_from_path(file_path, algorithm=DEFAULT_HASH_ALGORITHM):
+    if file_path.is_symlink():
+        return get_symlink_path_hash(file_path, algorithm)
+
+    hasher = get_hasher(algorithm)
+
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(READ_CHUNK_BYTE_SIZE), b""):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+def get_symlink_path_hash(symlink_path, algorithm=DEFAULT_HASH_ALGORITHM):
+    hasher = get_hasher(algorithm)
+    encoded_text_symlink = os.readlink(symlink_path).encode("utf-8")
+    hasher.update(encoded_text_symlink)
+
+    return hasher.hexdigest()
+
+
+def hash_files(file_paths, file_sizes, max_workers=1, algorithm=DEFAULT_HASH_ALGORITHM):
+    """
+    Hashes files and returns the hashes in the same order as the given paths.
+
+    Large files are hashed by a thread pool: reading is I/O bound and hashlib releases the GIL
+    while hashing large buffers. Small files are hashed in batches by a process pool, s.t. the
+    overhead of pickling and IPC is shared by many files instead of being paid for every file.
+    Both pools run at the same time and the results are merged afterwards.
+
+    :param file_paths: paths of files or symlinks to hash
+    :param file_sizes: size of every file in bytes (as given by lstat), used to pick the strategy
+    :param max_workers: number of threads and processes, respectively
+    :param algorithm: hash algorithm, see get_available_hash_algorithms
+    :return: list of hashes
+    """
+    start = time.monotonic()
+
+    if max_workers == 1:
+        hashes = _hash_batch(file_paths, algorithm)
+    else:
+        hashes = [None] * len(file_paths)
+
+        large_files = [i for i, size in enumerate(file_sizes) if size >= SMALL_FILE_BYTE_SIZE]
+        small_files = [i for i, size in enumerate(file_sizes) if size < SMALL_FILE_BYTE_SIZE]
+        batches = _split_into_batches(small_files, file_sizes)
+
+        # a single batch isn't worth starting a process pool for
+        threaded_files = large_files if len(batches) > 1 else large_files + small_files
+
+        with contextlib.ExitStack() as stack:
+            # submit the batches first s.t. the process pool hashes small files while the threads hash large files
+            if len(batches) > 1:
+                logging.debug(f"Hashing {len(small_files)} small files in {len(batches)} batches")
+                pool = stack.enter_context(multiprocessing.Pool(min(max_workers, len(batches))))
+                batch_hashes = pool.starmap_async(_hash_batch,
+                                                  [([file_paths[i] for i in batch], algorithm) for batch in batches],
+                                                  chunksize=1)
+
+            if threaded_files:
+                with ThreadPoolExecutor(max_workers) as executor:
+                    threaded_hashes = executor.map(get_file_hash_from_path, [file_paths[i] for i in threaded_files],
+                                                   itertools.repeat(algorithm))
+                    for i, file_hash in zip(threaded_files, threaded_hashes):
+                        hashes[i] = file_hash
+
+            if len(batches) > 1:
+                for batch, file_hashes in zip(batches, batch_hashes.get()):
+                    for i, file_hash in zip(batch, file_hashes):
+                        hashes[i] = file_hash
+
+    _log_throughput(len(file_paths), sum(file_sizes), time.monotonic() - start)
+
+    return hashes
+
+
+def _hash_batch(file_paths, algorithm):
+    return [get_file_hash_from_path(f, algorithm) for f in file_paths]
+
+
+def _split_into_batches(indices, file_sizes):
+    batches = []
+    batch = []
+    batch_size = 0
+
+    for i in indices:
+        if batch and (len(batch) >= HASH_BATCH_FILE_COUNT or batch_size + file_sizes[i] > HASH_BATCH_BYTE_SIZE):
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+
+        batch.append(i)
+        batch_size += file_sizes[i]
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def _log_throughput(nr_files, nr_bytes, duration):
+    # avoid division by zero for empty or very fast runs
+    duration = max(duration, 1e-6)
+
+    logging.info(f"Hashed {nr_files} files ({nr_bytes / 1000**2:.1f} MB) in {duration:.1f}s: "
+                 f"{nr_files / duration:.1f} files/s, {nr_bytes / 1000**2 / duration:.1f} MB/s")
@@ -1,17 +1,20 @@
 import re
+import stat
 import sys
 import os
-import hashlib
 from pathlib import Path
 import subprocess
 import logging
 import shutil
 import multiprocessing
+import queue
 from typing import List, Union, Sequence
 import unicodedata
 
-from .constants import READ_CHUNK_BYTE_SIZE, COMPRESSED_ARCHIVE_SUFFIX, \
-    ENCRYPTED_ARCHIVE_SUFFIX, ENV_VAR_MAPPER_MAX_CPUS, MD5_LINE_REGEX
+from .constants import COMPRESSED_ARCHIVE_SUFFIX, \
+    ENCRYPTED_ARCHIVE_SUFFIX, ENV_VAR_MAPPER_MAX_CPUS, MD5_LINE_REGEX, DEFAULT_HASH_ALGORITHM, \
+    HASH_MANIFEST_VERSION, HASH_MANIFEST_HEADER_REGEX, MIN_THREADS_PER_LZIP_JOB
+from .hashing import get_file_hash_from_path, get_symlink_path_hash, hash_files
 
 
 def get_files_with_type_in_directory_or_terminate(directory, file_type):
@@ -39,25 +42,54 @@ def get_absolute_path_string(path):
     return path.absolute().as_posix()
 
 
-def create_and_write_file_hash(file_path):
+def create_and_write_file_hash(file_path, algorithm=DEFAULT_HASH_ALGORITHM):
     """Will save the file in same directory"""
 
-    hash_output = get_file_hash_from_path(file_path)
+    hash_output = get_file_hash_from_path(file_path, algorithm)
+    write_file_hash(file_path, hash_output, algorithm)
 
+
+def write_file_hash(file_path, hash_output, algorithm=DEFAULT_HASH_ALGORITHM):
+    # the suffix is kept for all algorithms, s.t. existing tooling finds the hash files
     with open(file_path.as_posix() + ".md5", "w") as hash_file:
+        hash_file.write(get_hash_file_header(algorithm))
         hash_file.write(f"{hash_output}  {file_path.name}\n")
 
 
+def get_hash_file_header(algorithm):
+    """Header line for hash files, empty for md5 to keep them compatible with md5sum and older versions"""
+    if algorithm == "md5":
+        return ""
+
+    return f"# archiver-hash-manifest version={HASH_MANIFEST_VERSION} algorithm={algorithm}\n"
+
+
+def get_hash_algorithm_from_file(file_path):
+    with open(file_path, "r", newline='\n') as file:
+        m = HASH_MANIFEST_HEADER_REGEX.match(file.readline())
+
+    if not m:
+        return "md5"
+
+    if int(m.group(1)) > HASH_MANIFEST_VERSION:
+        terminate_with_message(f"Hash file {file_path} has version {m.group(1)}, which is not supported by this version of archiver")
+
+    return m.group(2)
+
+
 def read_hash_file(file_path):
     hash_dict = {}
 
     with open(file_path, "r", newline='\n') as file:
         for l in file.readlines():
+            if HASH_MANIFEST_HEADER_REGEX.match(l):
+                continue
+
             m = MD5_LINE_REGEX.match(l)
 
             if not m:
                 logging.error(
-                    f"Not properly formatted MD5 checksum line found in file {file_path}: {l}")
+                    f"Not properly formatted checksum line found in file {file_path}: {l}")
                 return False
 
             hash_val = m.groups()[0]
@@ -75,39 +107,14 @@ def read_hash_file(file_path):
     return hash_dict
 
 
-def get_file_hash_from_path(file_path):
-    if file_path.is_symlink():
-        return get_symlink_path_hash(file_path)
-
-    hasher = hashlib.md5()
-
-    with open(file_path, "rb") as file:
-        for chunk in iter(lambda: file.read(READ_CHUNK_BYTE_SIZE), b""):
-            hasher.update(chunk)
-
-    return hasher.hexdigest()
-
-
-def get_symlink_path_hash(symlink_path):
-    hasher = hashlib.md5()
-    encoded_text_symlink = os.readlink(symlink_path).encode("utf-8")
-    hasher.update(encoded_text_symlink)
-
-    return hasher.hexdigest()
-
-
-def _check_symlinks(abs_file, relative_to_path, integrity_check=False):
+def check_symlinks(abs_file, relative_to_path, integrity_check=False):
     if not abs_file.is_symlink():
         return
 
     link = Path(os.readlink(abs_file))
 
     if integrity_check:
-        if link.is_absolute():
-            logging.warning(
-                f"Symlink {abs_file.relative_to(relative_to_path.parent)} found pointing to {str(link)} ."
-                f" The archive contains the link itself, but possibly not the file it points to.")
-        # if the link is relative, check existence in a later step using file listings
+        check_symlink_in_archive(abs_file.relative_to(relative_to_path.parent), link)
     else:
         # archiving
         absolute_root = relative_to_path.resolve().absolute()
@@ -128,13 +135,33 @@ def _check_symlinks(abs_file, relative_to_path, integrity_check=False):
                             f"resolved when unpacking the archive on another system.")
 
 
-def hash_files_and_check_symlinks(source_path, abs_paths, max_workers=1, integrity_check=False):
-    # ignoring other file types like FIFO, sockets etc
-    file_list = [f for f in abs_paths if f.is_symlink() or f.is_file()]
+def check_symlink_in_archive(relative_path, link):
+    if Path(link).is_absolute():
+        logging.warning(
+            f"Symlink {relative_path} found pointing to {str(link)} ."
+            f" The archive contains the link itself, but possibly not the file it points to.")
+    # if the link is relative, check existence in a later step using file listings
+
+
+def hash_files_and_check_symlinks(source_path, abs_paths, max_workers=1, integrity_check=False, hash_cache=None,
+                                  algorithm=DEFAULT_HASH_ALGORITHM, abs_paths_stats=None):
+    if abs_paths_stats is None:
+        abs_paths_stats = [f.lstat() for f in abs_paths]
+
+    file_list = []
+    file_stats = []
+    for f, file_stat in zip(abs_paths, abs_paths_stats):
+        # ignoring other file types like FIFO, sockets etc
+        if stat.S_ISLNK(file_stat.st_mode) or stat.S_ISREG(file_stat.st_mode):
+            file_list.append(f)
+            file_stats.append(file_stat)
 
-    [_check_symlinks(f, source_path, integrity_check=integrity_check) for f in file_list]
+    [check_symlinks(f, source_path, integrity_check=integrity_check) for f in file_list]
 
-    hashes_list = exec_parallel(get_file_hash_from_path, file_list, lambda f: (f,), max_workers)
+    if hash_cache:
+        hashes_list = hash_cache.hash_files(file_list, file_stats, max_workers)
+    else:
+        hashes_list = hash_files(file_list, [file_stat.st_size for file_stat in file_stats], max_workers, algorithm)
 
     return [[unicodedata.normalize('NFC', e[0].relative_to(source_path.parent).as_posix()), e[1]] for e
             in zip(file_list, hashes_list)]
@@ -150,6 +177,36 @@ def get_files_in_folder(folder_path):
     return file_list
 
 
+def get_lzip_job_threads(threads, nr_parts, max_jobs=None):
+    """Splits the thread budget into the thread counts of concurrent plzip jobs processing the given number of parts"""
+    if not threads:
+        return [None]
+
+    nr_jobs = max(1, min(nr_parts, threads // MIN_THREADS_PER_LZIP_JOB, max_jobs or nr_parts))
+
+    return [threads // nr_jobs + (1 if index < threads % nr_jobs else 0) for index in range(nr_jobs)]
+
+
+def with_job_threads(fnc, job_threads):
+    """
+    Returns a function calling fnc(item, threads) with the thread count of a job that isn't in use by
+    any other concurrent call, s.t. at most len(job_threads) concurrent calls share the thread budget.
+    """
+    # every running call holds one entry, which is handed on to the next call once it is done
+    free_job_threads = queue.Queue()
+    for nr_threads in job_threads:
+        free_job_threads.put(nr_threads)
+
+    def run_with_job_threads(item):
+        nr_threads = free_job_threads.get()
+        try:
+            return fnc(item, nr_threads)
+        finally:
+            free_job_threads.put(nr_threads)
+
+    return run_with_job_threads
+
+
 def get_threads_from_args_or_environment(threads_arg):
     if threads_arg:
         return threads_arg
@@ -272,6 +329,40 @@ def get_bytes_in_string_with_unit(size_string):
         raise ValueError(f"Unable to parse provided size string {size_string}. Specify file size with unit, for example: 5G for 5 gigibytes (2^30 bytes).")
 
 
+duration_units = {"S": 1, "M": 60, "H": 60 * 60, "D": 24 * 60 * 60}
+
+
+def get_seconds_in_string_with_unit(duration_string):
+    try:
+        match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([SMHD]?)\s*', duration_string.upper())
+        number, unit = match.groups()
+        return float(number) * duration_units[unit or "S"]
+    except:
+        raise ValueError(f"Unable to parse provided duration string {duration_string}. Specify duration with unit, for example: 30m for 30 minutes.")
+
+
+def get_sample_size_from_string(sample_string):
+    """
+    Returns the sample size as ("files", number of files), ("fraction", fraction of files)
+    or ("bytes", total size of files), e.g. for "100", "5%" or "10G"
+    """
+    try:
+        if sample_string.strip().endswith("%"):
+            fraction = float(sample_string.strip()[:-1]) / 100
+            if 0 < fraction <= 1:
+                return "fraction", fraction
+        elif sample_string.strip().isdigit():
+            if int(sample_string) > 0:
+                return "files", int(sample_string)
+        else:
+            return "bytes", get_bytes_in_string_with_unit(sample_string)
+    except ValueError:
+        pass
+
+    raise ValueError(f"Unable to parse provided sample size {sample_string}. Specify a number of files, a percentage "
+                     f"of files or a size with unit, for example: 100, 5% or 10G.")
+
+
 def file_has_type(path, file_type):
     return path.is_file() and path.as_posix().endswith(file_type)
 
@@ -1,18 +1,51 @@
+import contextlib
 import logging
+import math
+import random
+import subprocess
+import tarfile
 import tempfile
+import time
+import unicodedata
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from . import chunk_hashes
 from . import helpers
+from . import member_index
+from . import streaming
 from .constants import COMPRESSED_ARCHIVE_SUFFIX, ENCRYPTED_ARCHIVE_SUFFIX, \
     LISTING_SUFFIX, HASH_SUFFIX, TAR_HASH_SUFFIX, COMPRESSED_ARCHIVE_HASH_SUFFIX, \
-    ENCRYPTED_ARCHIVE_HASH_SUFFIX
+    ENCRYPTED_ARCHIVE_HASH_SUFFIX, HASH_MANIFEST_HEADER_REGEX, CHECK_JOURNAL_MEMBER_BATCH, \
+    CHECK_JOURNAL_MEMBER_INTERVAL_SECONDS, SAMPLE_CONFIDENCE
 from .extract import extract_archive
-from .listing import parse_tar_listing
+from .journal import CheckJournal, get_check_journal_path
+from .listing import parse_tar_listing, iter_tar_listing, relevant_splits_for_partial_path, path_is_in_subpath, \
+    get_listing_path, index_listing_paths, get_directory_link_predicate, normalize_member_path, \
+    parse_verbose_member_name
 
+# kinds of checks recorded in the check journal, deep checks with and without --stream verify the same
+DEEP_CHECK = "deep"
+MEDIUM_CHECK = "medium"
 
-def check_integrity(source_path, deep_flag=False, threads=None, work_dir=None):
+
+def get_subpath_check(subpath):
+    """Deep checks of a subpath are recorded apart from those of whole archives, since they verify fewer files"""
+    return f"{DEEP_CHECK}:{normalize_member_path(subpath)}"
+
+
+SampleResult = namedtuple('SampleResult', ['nr_files', 'nr_sampled', 'nr_corrupted', 'success'])
+
+
+def check_integrity(source_path, deep_flag=False, threads=None, work_dir=None, stream=False, io_workers=None,
+                    medium_flag=False, resume=False, sample_size=None, seed=None, subpath=None):
 
     archives_with_hashes = get_archives_with_hashes_from_path(source_path)
+    # links are resolved against the paths of all parts, even if only some of them are checked
+    listing_paths = [get_listing_path(archive[0]) for archive in archives_with_hashes]
+    if subpath:
+        archives_with_hashes = get_archives_containing_subpath(source_path, archives_with_hashes, subpath)
     is_encrypted = helpers.path_target_is_encrypted(source_path)
 
     logging.info("Starting integrity check on: " + source_path.as_posix())
@@ -33,8 +66,14 @@ def check_integrity(source_path, deep_flag=False, threads=None, work_dir=None):
 
     if deep_flag:
         # with deep flag still continue, no matter what the result of the previous test was
-        deep_check_result = deep_integrity_check(archives_with_hashes,
-                                                 is_encrypted, threads, work_dir)
+        with open_check_journal(work_dir, source_path, resume) as journal:
+            if subpath:
+                deep_check_result = subpath_integrity_check(archives_with_hashes, subpath, threads, io_workers,
+                                                            index_listing_paths(listing_paths), journal)
+            else:
+                deep_check_result = deep_integrity_check(archives_with_hashes,
+                                                         is_encrypted, threads, work_dir, stream, io_workers, journal,
+                                                         index_listing_paths(listing_paths))
 
         if check_result and deep_check_result:
             logging.info("Deep integrity check successful.")
@@ -46,6 +85,37 @@ def check_integrity(source_path, deep_flag=False, threads=None, work_dir=None):
                 "Deep integrity check unsuccessful. Archive has been changed since creation.")
         return check_result and deep_check_result
 
+    if medium_flag:
+        with open_check_journal(work_dir, source_path, resume) as journal:
+            medium_check_result = medium_integrity_check(archives_with_hashes, threads, io_workers, journal)
+
+        if check_result and medium_check_result:
+            logging.info("Medium integrity check successful.")
+        elif not check_result and medium_check_result:
+            logging.error(
+                "Basic integrity check unsuccessful. But the decompressed archives match their tar hashes.")
+        else:
+            logging.error(
+                "Medium integrity check unsuccessful. Archive has been changed since creation.")
+        return check_result and medium_check_result
+
+    if sample_size:
+        if seed is None:
+            seed = random.randrange(2**32)
+        logging.info(f"Sampling files with seed {seed}, use --seed {seed} to check the same files again")
+
+        sample_check_result = sample_integrity_check(archives_with_hashes, sample_size, seed, threads, io_workers)
+
+        if check_result and sample_check_result:
+            logging.info("Sampled integrity check successful.")
+        elif not check_result and sample_check_result:
+            logging.error(
+                "Basic integrity check unsuccessful. But checksums of the sampled files in archive match.")
+        else:
+            logging.error(
+                "Sampled integrity check unsuccessful. Archive has been changed since creation.")
+        return check_result and sample_check_result
+
     if not check_result:
         logging.error(
             "Basic integrity check unsuccessful. Archive has been changed since creation.")
@@ -55,6 +125,17 @@ def check_integrity(source_path, deep_flag=False, threads=None, work_dir=None):
     return check_result
 
 
+def open_check_journal(work_dir, source_path, resume=False):
+    """
+    The progress of deep and medium checks is recorded in the work dir, s.t. an interrupted check can be resumed.
+    Without a work dir, nothing is recorded.
+    """
+    if not work_dir:
+        return contextlib.nullcontext()
+
+    return CheckJournal(get_check_journal_path(Path(work_dir), source_path), resume)
+
+
 def check_archive_part_integrity(source_name: Path) -> bool:
 
     check_result = True
@@ -100,15 +181,33 @@ def _shallow_integrity_check_part(archive_file_path, archive_hash_file_path):
     return True
 
 
+def _shallow_integrity_check_part_chunked(archive_file_path, workers):
+    logging.info(f"Verifying chunk hashes of {archive_file_path} using {workers} threads")
+    bad_ranges = chunk_hashes.verify_chunk_hashes(archive_file_path, workers)
+
+    if bad_ranges:
+        logging.warning(f"Chunk hashes of file {archive_file_path.name} have changed in byte ranges "
+                        f"{', '.join(f'{start}-{end}' for start, end in bad_ranges)}.")
+        return False
+    return True
+
+
 def shallow_integrity_check(archives_with_hashes, workers=None):
     eff_workers = workers if workers else 1
 
-    ret = helpers.exec_parallel(_shallow_integrity_check_part, archives_with_hashes, lambda p: (p[0], p[1]), eff_workers)
+    # a single large archive with chunk hashes is verified by several threads, the others by one process each
+    chunked = [p for p in archives_with_hashes if chunk_hashes.get_chunk_hash_path(p[0]).is_file()]
+    unchunked = [p for p in archives_with_hashes if p not in chunked]
+
+    ret = [_shallow_integrity_check_part_chunked(p[0], eff_workers) for p in chunked]
+    if unchunked:
+        ret += helpers.exec_parallel(_shallow_integrity_check_part, unchunked, lambda p: (p[0], p[1]),
+                                     min(eff_workers, len(unchunked)))
 
     return all(ret)
 
 
-def verify_relative_symbolic_links(archives_with_hashes):
+def verify_relative_symbolic_links(archives_with_hashes, path_index=None):
     """
     Checks whether relative links in archives can be resolved.
 
@@ -116,69 +215,464 @@ def verify_relative_symbolic_links(archives_with_hashes):
     of split archives, we would need to unpack all splits, since a link may point to a file in some other
     split. However, unpacking all splits may turn out to not feasible, e.g. for space reasons.
 
+    Links are resolved in memory against the paths of all listings, including chains of links and links
+    to directories. The filesystem isn't accessed.
+
     :param archives_with_hashes:
+    :param path_index: ArchivePathIndex of all paths in the archive (parts), built from the listings by default
     :return: dictionary of paths to symlinks where target is missing and is relative
     """
-    file_set = set() # the set of all files in the archive (parts)
-    symlink_dict = {} # all symlinks found across listing
-    for archive in archives_with_hashes:
-        part_path = archive[0]
-        part_listing = part_path.parent / (helpers.filename_without_archive_extensions(part_path) + LISTING_SUFFIX)
-        entries = parse_tar_listing(part_listing)
-
-        file_set.update([str(e.path).rstrip('/') for e in entries])
-        symlink_dict.update(
-            {e.path: e.link_target for e in entries if e.link_target})
+    listing_paths = [get_listing_path(archive[0]) for archive in archives_with_hashes]
+    if not path_index:
+        path_index = index_listing_paths(listing_paths)
 
     missing = {}
-    for path, target in symlink_dict.items():
-        # for absolute targets we already gave warning during hash_listing_for_files_in_folder
-        if not Path(target).is_absolute():
-            target_path = (Path(path).parent / Path(target)).resolve()
-
-            if Path().resolve() not in target_path.parents:
-                missing[path] = target
-                continue
-
-            relative_target_path = target_path.relative_to(Path().resolve())
-
-            if str(relative_target_path) not in file_set:
-                missing[path] = target
+    for part_listing in listing_paths:
+        for entry in iter_tar_listing(part_listing):
+            # for absolute targets we already gave warning during hash_listing_for_files_in_folder
+            if entry.link_target and not Path(entry.link_target).is_absolute() and \
+                    not path_index.link_target_exists(entry.path, entry.link_target):
+                missing[entry.path] = entry.link_target
 
     return missing
 
 
-def deep_integrity_check(archives_with_hashes, is_encrypted, threads, work_dir):
+def deep_integrity_check(archives_with_hashes, is_encrypted, threads, work_dir, stream=False, io_workers=None,
+                         journal=None, path_index=None):
+    if not path_index:
+        path_index = index_listing_paths(get_listing_path(archive[0]) for archive in archives_with_hashes)
+
     # verify link structure
-    missing_links = verify_relative_symbolic_links(archives_with_hashes)
+    missing_links = verify_relative_symbolic_links(archives_with_hashes, path_index)
 
     for path, target in missing_links.items():
         logging.warning(f"Symlink {path} pointing to {target} is broken in archive")
 
-    # verify md5sums in archives
-    successful = True
-    for archive in archives_with_hashes:
-        archive_file_path = archive[0]
-        expected_listing_hash_path = archive[2]
+    # verify file hashes in archives
+    remaining_archives = _get_unverified_parts(archives_with_hashes, journal, DEEP_CHECK)
+    if stream:
+        results = _deep_integrity_check_parts_streaming(remaining_archives, threads, io_workers, journal,
+                                                        get_directory_link_predicate(path_index))
+    else:
+        check_part = _with_journal(lambda archive: _deep_integrity_check_part(archive[0], archive[2], threads, work_dir),
+                                   journal, DEEP_CHECK)
+        # one part after another, since extracting several parts at once would multiply the required scratch space
+        results = [check_part(archive) for archive in remaining_archives]
+
+    failed_parts = [archive[0].name for archive, result in zip(remaining_archives, results) if not result]
+    if failed_parts:
+        logging.error(f"Deep check failed for {len(failed_parts)} of {len(archives_with_hashes)} archives: "
+                      f"{', '.join(failed_parts)}")
+        _log_retry_hint(journal)
+
+    return not failed_parts
+
+
+def _deep_integrity_check_part(archive_file_path, expected_listing_hash_path, threads, work_dir):
+    # Create temporary directory to unpack archive
+    with tempfile.TemporaryDirectory(dir=work_dir) as temp_path_string:
+        temp_path = Path(temp_path_string) / "extraction-folder"
+        archive_content_path = extract_archive(archive_file_path, temp_path, threads=threads)
+
+        terminate_if_extracted_archive_not_existing(archive_content_path)
+
+        files = helpers.get_files_in_folder(archive_content_path)
+        hash_algorithm = helpers.get_hash_algorithm_from_file(expected_listing_hash_path)
+        hash_result = helpers.hash_files_and_check_symlinks(archive_content_path, files, max_workers=threads,
+                                                            integrity_check=True, algorithm=hash_algorithm)
+
+        return compare_archive_listing_hashes(hash_result, expected_listing_hash_path)
+
+
+def _deep_integrity_check_parts_streaming(archives_with_hashes, threads, io_workers=None, journal=None,
+                                          is_directory_link=None):
+    def check_part(archive, nr_threads):
+        return _deep_integrity_check_part_streaming(archive[0], archive[2], nr_threads, journal, is_directory_link)
+
+    return _check_parts_concurrently(archives_with_hashes, _with_journal(check_part, journal, DEEP_CHECK),
+                                     threads, io_workers)
+
+
+def _check_parts_concurrently(archives_with_hashes, check_part, threads, io_workers=None):
+    """
+    Checks several archives at the same time using check_part(archive, threads). The threads are shared by
+    the plzip processes of the archives checked concurrently, at most `io_workers` archives are read at the same time.
+    """
+    job_threads = helpers.get_lzip_job_threads(threads, len(archives_with_hashes), io_workers)
+    check_part_with_job_threads = helpers.with_job_threads(check_part, job_threads)
+
+    if len(job_threads) == 1:
+        return [check_part_with_job_threads(archive) for archive in archives_with_hashes]
+
+    logging.info(f"Checking {len(archives_with_hashes)} archives, {len(job_threads)} at a time")
+    with ThreadPoolExecutor(len(job_threads)) as executor:
+        return list(executor.map(check_part_with_job_threads, archives_with_hashes))
+
+
+def _deep_integrity_check_part_streaming(archive_file_path, expected_listing_hash_path, threads, journal=None,
+                                         is_directory_link=None):
+    """Same as _deep_integrity_check_part, but hashes the files while the archive is decompressed instead of extracting it"""
+    logging.info(f"Hashing files in the decompressed stream of {archive_file_path} using {threads} threads")
+    hash_algorithm = helpers.get_hash_algorithm_from_file(expected_listing_hash_path)
+    start = time.monotonic()
+
+    try:
+        hash_result, nr_bytes = hash_archive_members(archive_file_path, hash_algorithm, threads, journal,
+                                                     is_directory_link=is_directory_link)
+    except (subprocess.CalledProcessError, tarfile.TarError) as error:
+        logging.error(f"Decompressing archive {archive_file_path} failed: {error}")
+        return False
+
+    result = compare_archive_listing_hashes(hash_result, expected_listing_hash_path)
+    _log_part_throughput(archive_file_path, len(hash_result), nr_bytes, time.monotonic() - start, result)
+
+    return result
+
+
+def hash_archive_members(archive_file_path, hash_algorithm, threads=None, journal=None, select=None,
+                         is_directory_link=None, check=DEEP_CHECK):
+    """
+    Computes the hashes of all files and symlinks in the archive on the decompressed stream, or only
+    of those selected, see streaming.hash_tar_members.
+
+    With a journal, the hashes of files are recorded every now and then and files recorded by
+    an earlier, interrupted check are not hashed again. The archive is still decompressed from
+    its beginning though. With select, only the parts of the archive containing the selected files
+    are decompressed, if the archive has a member index. Symlinks to directories are skipped if is_directory_link
+    is given, like in hash listings created from the filesystem. The hashes are recorded in the journal as the given
+    kind of check.
+
+    :return: list of [path, hash] and the total size of all files in bytes
+    """
+    hash_result = []
+    nr_bytes = 0
+
+    known_hashes = journal.get_member_hashes(archive_file_path, check) if journal else {}
+    if known_hashes:
+        logging.info(f"Skipping {len(known_hashes)} files of {archive_file_path.name} hashed by a previous check")
+    checkpoint = []
+    last_checkpoint = time.monotonic()
+
+    with member_index.open_archive_stream(archive_file_path, select, threads) as stream:
+        for path, file_hash, member in streaming.hash_tar_members(stream, hash_algorithm, known_hashes, select,
+                                                                  is_directory_link=is_directory_link):
+            if member.issym():
+                helpers.check_symlink_in_archive(path, member.linkname)
+            elif member.isreg():
+                nr_bytes += member.size
+                if journal and path not in known_hashes:
+                    checkpoint.append([path, file_hash])
+            hash_result.append([path, file_hash])
+
+            if checkpoint and (len(checkpoint) >= CHECK_JOURNAL_MEMBER_BATCH or
+                               time.monotonic() - last_checkpoint >= CHECK_JOURNAL_MEMBER_INTERVAL_SECONDS):
+                journal.record_members(archive_file_path, check, checkpoint)
+                checkpoint = []
+                last_checkpoint = time.monotonic()
+
+    return hash_result, nr_bytes
+
+
+def subpath_integrity_check(archives_with_hashes, subpath, threads, io_workers=None, path_index=None, journal=None):
+    """
+    Deep check of the files below subpath inside the archives only. Only these files are hashed while the
+    archives are decompressed in a stream and they are compared to the matching entries of the hash listings.
+    Symlinks to directories are resolved using the path_index of the whole archive, by default of the archives checked.
+    With a journal, the progress is recorded like for deep checks, apart from those of other subpaths.
+    """
+    if not path_index:
+        path_index = index_listing_paths(get_listing_path(archive[0]) for archive in archives_with_hashes)
+    is_directory_link = get_directory_link_predicate(path_index)
+    check = get_subpath_check(subpath)
+
+    def check_part(archive, nr_threads):
+        return _subpath_integrity_check_part(archive[0], archive[2], subpath, nr_threads, is_directory_link, journal)
+
+    remaining_archives = _get_unverified_parts(archives_with_hashes, journal, check)
+    results = _check_parts_concurrently(remaining_archives, _with_journal(check_part, journal, check), threads,
+                                        io_workers)
+
+    failed_parts = [archive[0].name for archive, result in zip(remaining_archives, results) if not result]
+    if failed_parts:
+        logging.error(f"Deep check of {subpath} failed for {len(failed_parts)} of {len(archives_with_hashes)} "
+                      f"archives: {', '.join(failed_parts)}")
+        _log_retry_hint(journal)
+
+    return not failed_parts
+
 
-        # Create temporary directory to unpack archive
-        with tempfile.TemporaryDirectory(dir=work_dir) as temp_path_string:
-            temp_path = Path(temp_path_string) / "extraction-folder"
-            archive_content_path = extract_archive(archive_file_path, temp_path, threads=threads, extract_at_destination=True)
+def _subpath_integrity_check_part(archive_file_path, expected_listing_hash_path, subpath, threads,
+                                  is_directory_link=None, journal=None):
+    expected_dict = {path: file_hash for path, file_hash in helpers.read_hash_file(expected_listing_hash_path).items()
+                     if path_is_in_subpath(path, subpath)}
 
-            terminate_if_extracted_archive_not_existing(archive_content_path)
+    logging.info(f"Hashing {len(expected_dict)} files below {subpath} in the decompressed stream of "
+                 f"{archive_file_path} using {threads} threads")
+    hash_algorithm = helpers.get_hash_algorithm_from_file(expected_listing_hash_path)
+    start = time.monotonic()
+
+    try:
+        hash_result, nr_bytes = hash_archive_members(archive_file_path, hash_algorithm, threads, journal,
+                                                     select=lambda path: path_is_in_subpath(path, subpath),
+                                                     is_directory_link=is_directory_link,
+                                                     check=get_subpath_check(subpath))
+    except (subprocess.CalledProcessError, tarfile.TarError, ValueError) as error:
+        logging.error(f"Decompressing archive {archive_file_path} failed: {error}")
+        return False
+
+    unverified = {path for path, file_hash in hash_result if file_hash is None}
+    for path in sorted(unverified):
+        logging.warning(f"Hard link {path} is not verified, since the file it points to is not below {subpath}")
+    hash_result = [[path, file_hash] for path, file_hash in hash_result if path not in unverified]
+    expected_dict = {path: file_hash for path, file_hash in expected_dict.items() if path not in unverified}
+
+    result = compare_hashes_with_expected(hash_result, expected_dict)
+    _log_part_throughput(archive_file_path, len(hash_result), nr_bytes, time.monotonic() - start, result)
+
+    return result
+
+
+def get_archives_containing_subpath(source_path, archives_with_hashes, subpath):
+    """Returns the archives whose listing contains files below subpath"""
+    relevant_names = {helpers.filename_without_archive_extensions(path) for path
+                      in relevant_splits_for_partial_path(source_path, subpath)}
+    archives = [archive for archive in archives_with_hashes
+                if helpers.filename_without_archive_extensions(archive[0]) in relevant_names]
+
+    if not archives:
+        helpers.terminate_with_message(f"No files below {subpath} found in the listings of {source_path}")
+
+    logging.info(f"Files below {subpath} are contained in {len(archives)} of {len(archives_with_hashes)} archives: "
+                 f"{', '.join(archive[0].name for archive in archives)}")
+
+    return archives
+
+
+def medium_integrity_check(archives_with_hashes, threads, io_workers=None, journal=None):
+    """
+    Decompresses every archive in a stream and compares the hash of the tar stream with the .tar.md5
+    written on creation. plzip verifies the CRC of every lzip member while decompressing.
+    No files are extracted and nothing is written to disk.
+    """
+    def check_part(archive, nr_threads):
+        return _medium_integrity_check_part(archive[0], nr_threads)
+
+    remaining_archives = _get_unverified_parts(archives_with_hashes, journal, MEDIUM_CHECK)
+    results = _check_parts_concurrently(remaining_archives, _with_journal(check_part, journal, MEDIUM_CHECK),
+                                        threads, io_workers)
+
+    failed_parts = [archive[0].name for archive, result in zip(remaining_archives, results) if not result]
+    if failed_parts:
+        logging.error(f"Medium check failed for {len(failed_parts)} of {len(archives_with_hashes)} archives: "
+                      f"{', '.join(failed_parts)}")
+        _log_retry_hint(journal)
+
+    return not failed_parts
+
+
+def _medium_integrity_check_part(archive_file_path, threads):
+    tar_hash_path = archive_file_path.parent / (helpers.filename_without_archive_extensions(archive_file_path)
+                                                + TAR_HASH_SUFFIX)
+    if not tar_hash_path.is_file():
+        logging.error(f"Tar hash {tar_hash_path} of archive {archive_file_path.name} is missing.")
+        return False
+
+    logging.info(f"Verifying decompressed stream of {archive_file_path} using {threads} threads")
+    start = time.monotonic()
+
+    try:
+        with streaming.open_decompressed_stream(archive_file_path, threads) as stream:
+            reader = streaming.HashingReader(stream, algorithm=helpers.get_hash_algorithm_from_file(tar_hash_path))
+            reader.drain()
+    except subprocess.CalledProcessError as error:
+        logging.error(f"Decompressing archive {archive_file_path} failed: {error}")
+        return False
+
+    result = hash_matches_hash_file(reader.hexdigest(), tar_hash_path)
+    if not result:
+        logging.warning(f"Hash of the tar archive in {archive_file_path.name} has changed.")
+
+    _log_part_throughput(archive_file_path, None, reader.bytes_read, time.monotonic() - start, result)
+
+    return result
+
+
+def sample_integrity_check(archives_with_hashes, sample_size, seed, threads, io_workers=None):
+    """
+    Verifies the hashes of a random, but reproducible sample of the files in every archive, see
+    helpers.get_sample_size_from_string for sample_size. The archives are decompressed in a stream,
+    only the sampled files are hashed and nothing is written to disk.
+    """
+    def check_part(archive, nr_threads):
+        return _sample_integrity_check_part(archive[0], archive[2], sample_size, seed, nr_threads)
+
+    results = _check_parts_concurrently(archives_with_hashes, check_part, threads, io_workers)
+
+    failed_parts = [archive[0].name for archive, result in zip(archives_with_hashes, results) if not result.success]
+    if failed_parts:
+        logging.error(f"Sampled check failed for {len(failed_parts)} of {len(results)} archives: {', '.join(failed_parts)}")
+
+    _log_sample_confidence(sum(r.nr_files for r in results), sum(r.nr_sampled for r in results),
+                           sum(r.nr_corrupted for r in results))
+
+    return not failed_parts
 
-            files = helpers.get_files_in_folder(archive_content_path)
-            hash_result = helpers.hash_files_and_check_symlinks(archive_content_path, files, max_workers=threads, integrity_check=True)
 
-            r = compare_archive_listing_hashes(hash_result, expected_listing_hash_path)
-            successful = successful and r
+def _sample_integrity_check_part(archive_file_path, expected_listing_hash_path, sample_size, seed, threads):
+    expected_dict = helpers.read_hash_file(expected_listing_hash_path)
+    file_sizes = _get_file_sizes_from_listing(archive_file_path, expected_dict.keys()) if sample_size[0] == "bytes" \
+        else {}
+    # seeded per part, s.t. the sample of a part doesn't depend on the other parts checked
+    sample = select_sample(expected_dict.keys(), sample_size, random.Random(f"{seed}:{archive_file_path.name}"),
+                           file_sizes)
 
-    return successful
+    logging.info(f"Hashing {len(sample)} of {len(expected_dict)} files in the decompressed stream of "
+                 f"{archive_file_path} using {threads} threads")
+    hash_algorithm = helpers.get_hash_algorithm_from_file(expected_listing_hash_path)
+    start = time.monotonic()
+
+    select = set(sample).__contains__
+    try:
+        # with a member index, only the parts of the archive containing the sample are decompressed
+        with member_index.open_archive_stream(archive_file_path, select, threads) as stream:
+            members = {path: (file_hash, member) for path, file_hash, member
+                       in streaming.hash_tar_members(stream, hash_algorithm, select=select)}
+    except (subprocess.CalledProcessError, tarfile.TarError, ValueError) as error:
+        logging.error(f"Decompressing archive {archive_file_path} failed: {error}")
+        return SampleResult(len(expected_dict), 0, 0, False)
+
+    nr_sampled = 0
+    nr_corrupted = 0
+    for path in sample:
+        if path not in members:
+            logging.error(f"Missing file {path} in archive!")
+            nr_corrupted += 1
+        elif members[path][0] is None:
+            logging.warning(f"Hard link {path} is not verified, since the file it points to isn't part of the sample")
+            continue
+        elif members[path][0] != expected_dict[path]:
+            logging.error(f"Hash of {path} has changed: Expected {expected_dict[path]} but got {members[path][0]}")
+            nr_corrupted += 1
+
+        nr_sampled += 1
+
+    nr_bytes = sum(member.size for _, member in members.values() if member.isreg())
+    _log_part_throughput(archive_file_path, nr_sampled, nr_bytes, time.monotonic() - start, not nr_corrupted)
+
+    return SampleResult(len(expected_dict), nr_sampled, nr_corrupted, not nr_corrupted)
+
+
+def select_sample(paths, sample_size, rng, file_sizes=None):
+    """
+    Returns a random subset of paths, drawn by rng. The sample size is given as in helpers.get_sample_size_from_string,
+    for samples by size the sizes of the files are taken from file_sizes (by path, unknown sizes count as 0).
+    """
+    unit, value = sample_size
+    # sorted, s.t. the sample only depends on rng and not on the order of paths
+    shuffled = sorted(paths)
+    rng.shuffle(shuffled)
+
+    if unit == "files":
+        return shuffled[:value]
+    if unit == "fraction":
+        return shuffled[:max(1, math.ceil(value * len(shuffled)))]
+
+    sample = []
+    sample_bytes = 0
+    for path in shuffled:
+        if sample_bytes >= value:
+            break
+        sample.append(path)
+        sample_bytes += file_sizes.get(path, 0) if file_sizes else 0
+
+    return sample
+
+
+def _get_file_sizes_from_listing(archive_file_path, paths):
+    """
+    Returns the sizes of the files with the given paths (as in the hash listing) from the listing of the archive.
+    Tar escapes some characters of the names it lists, the names are parsed like those listed while extracting.
+    """
+    listing_path = get_listing_path(archive_file_path)
+    if not listing_path.is_file():
+        logging.warning(f"Listing {listing_path} is missing, the size of the sample can't be determined.")
+        return {}
+
+    listed_sizes = {parse_verbose_member_name(entry.path.encode("utf-8", "surrogateescape")): int(entry.size)
+                    for entry in parse_tar_listing(listing_path) if entry.size.isdigit()}
+
+    file_sizes = {}
+    for path in paths:
+        normalized_path = unicodedata.normalize('NFC', path)
+        if normalized_path in listed_sizes:
+            file_sizes[path] = listed_sizes[normalized_path]
+
+    return file_sizes
+
+
+def _log_sample_confidence(nr_files, nr_sampled, nr_corrupted):
+    if nr_corrupted:
+        logging.error(f"{nr_corrupted} of {nr_sampled} sampled files are missing or have been changed.")
+    elif nr_sampled == nr_files:
+        logging.info(f"All {nr_files} files have been verified.")
+    elif nr_sampled:
+        # upper bound of the share of corrupted files if none has been found in the sample (exact binomial bound,
+        # which is about 3 / nr_sampled for a confidence of 95%)
+        max_share = 1 - (1 - SAMPLE_CONFIDENCE) ** (1 / nr_sampled)
+        logging.info(f"All {nr_sampled} sampled of {nr_files} files match their hashes: with {SAMPLE_CONFIDENCE:.0%} "
+                     f"confidence, less than {max_share:.2%} of the files are missing or have been changed.")
+
+
+def _log_part_throughput(archive_file_path, nr_files, nr_bytes, duration, result):
+    # avoid division by zero for empty or very fast runs
+    duration = max(duration, 1e-6)
+    archive_bytes = archive_file_path.stat().st_size
+
+    content = f"{nr_files} files" if nr_files is not None else "tar stream"
+    logging.info(f"{'Verified' if result else 'Failed to verify'} {content} ({nr_bytes / 1000**2:.1f} MB) "
+                 f"of {archive_file_path.name} in {duration:.1f}s: {nr_bytes / 1000**2 / duration:.1f} MB/s "
+                 f"uncompressed, {archive_bytes / 1000**2 / duration:.1f} MB/s read")
 
 
 # MARK: Helpers
 
+def _get_unverified_parts(archives_with_hashes, journal, check):
+    """Returns the archives which haven't been verified successfully by a previous check recorded in the journal"""
+    if not journal:
+        return archives_with_hashes
+
+    remaining_archives = []
+    for archive in archives_with_hashes:
+        result = journal.get_part_result(archive[0], check)
+
+        if result:
+            logging.info(f"Skipping archive {archive[0].name}, it has been verified by a previous check")
+            continue
+        if result is False:
+            logging.info(f"Checking archive {archive[0].name} again, it failed a previous check")
+        remaining_archives.append(archive)
+
+    return remaining_archives
+
+
+def _with_journal(check_part, journal, check):
+    """Records the result of check_part(archive, ...) in the journal"""
+    if not journal:
+        return check_part
+
+    def check_and_record_part(archive, *args):
+        result = check_part(archive, *args)
+        journal.record_part(archive[0], check, result)
+        return result
+
+    return check_and_record_part
+
+
+def _log_retry_hint(journal):
+    if journal:
+        logging.info(f"Results are recorded in {journal.path}, check again with --resume to retry the failed archives only")
+
+
 def terminate_if_extracted_archive_not_existing(extracted_archive):
     # generate hash listing using existing method and compare with test-folder.md5
     if not extracted_archive.is_dir():
@@ -186,9 +680,11 @@ def terminate_if_extracted_archive_not_existing(extracted_archive):
 
 
 def compare_archive_listing_hashes(hash_result, expected_hash_listing_path):
-    hash_result_dict = {fn: hash for (fn, hash) in hash_result}
+    return compare_hashes_with_expected(hash_result, helpers.read_hash_file(expected_hash_listing_path))
 
-    expected_dict = helpers.read_hash_file(expected_hash_listing_path)
+
+def compare_hashes_with_expected(hash_result, expected_dict):
+    hash_result_dict = {fn: hash for (fn, hash) in hash_result}
 
     corruption_found = False
 
@@ -207,15 +703,20 @@ def compare_archive_listing_hashes(hash_result, expected_hash_listing_path):
 
 
 def compare_hashes_from_files(archive_file_path, archive_hash_file_path):
-    # Generate hash of .tar.lz
-    archive_hash = helpers.get_file_hash_from_path(archive_file_path)
+    # Generate hash of .tar.lz using the algorithm recorded in the hash file
+    hash_algorithm = helpers.get_hash_algorithm_from_file(archive_hash_file_path)
+    archive_hash = helpers.get_file_hash_from_path(archive_file_path, hash_algorithm)
+
+    return hash_matches_hash_file(archive_hash, archive_hash_file_path)
+
 
-    # Read hash of .tar.lz.md5
-    with open(archive_hash_file_path, "r") as file:
-        hash_file_content = file.read()
+def hash_matches_hash_file(file_hash, hash_file_path):
+    # Read hash of e.g. .tar.lz.md5, skipping the header
+    with open(hash_file_path, "r") as file:
+        hash_file_content = "".join(l for l in file if not HASH_MANIFEST_HEADER_REGEX.match(l))
 
     # hash_file_content may contain path of file
-    return hash_file_content.startswith(archive_hash)
+    return hash_file_content.startswith(file_hash)
 
 
 def get_archives_with_hashes_from_path(path):
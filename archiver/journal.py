@@ -0,0 +1,170 @@
+import hashlib
+import json
+import logging
+import threading
+
+from .constants import CHECK_JOURNAL_FILE_PREFIX, EXTRACTION_JOURNAL_FILE_NAME
+
+
+def get_check_journal_path(work_dir, source_path):
+    """Every archive (or single archive file) that is checked gets its own journal in the work dir"""
+    source_id = hashlib.md5(source_path.absolute().as_posix().encode("utf-8")).hexdigest()[:16]
+
+    return work_dir / f"{CHECK_JOURNAL_FILE_PREFIX}{source_id}.jsonl"
+
+
+def get_extraction_journal_path(destination_directory_path):
+    return destination_directory_path / EXTRACTION_JOURNAL_FILE_NAME
+
+
+class _Journal:
+    """
+    Append-only record of the progress of an operation on the parts of an archive, stored as JSON lines.
+
+    Records are keyed by the absolute path, size and mtime of the archive part and the kind of operation,
+    s.t. records of archive files that have been replaced or modified since are ignored.
+
+    Records may be written from several threads.
+    """
+    operation = None
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        truncated = False
+
+        if resume:
+            if path.is_file():
+                truncated = self._load()
+                logging.info(f"Resuming {self.operation} from {path}")
+            else:
+                logging.info(f"No progress of a previous {self.operation} found in {path}, starting from the beginning")
+
+        self.file = open(path, "a" if resume else "w")
+        if truncated:
+            # terminate the truncated last line, s.t. new records aren't appended to it
+            self.file.write("\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def _write(self, key, record):
+        path, size, mtime_ns, check = key
+        line = json.dumps({"part": path, "size": size, "mtime_ns": mtime_ns, "check": check, **record})
+
+        with self.lock:
+            self.file.write(line + "\n")
+            # the process may be killed at any time
+            self.file.flush()
+
+    def _load(self):
+        """Reads all records and returns whether the last line has been truncated"""
+        line = "\n"
+
+        with open(self.path, "r") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                    key = (record["part"], record["size"], record["mtime_ns"], record["check"])
+                except (ValueError, KeyError):
+                    # e.g. the last line, if the process was killed while writing it
+                    logging.debug(f"Ignoring invalid line in {self.path}: {line!r}")
+                    continue
+
+                self._load_record(key, record)
+
+        return not line.endswith("\n")
+
+    def _load_record(self, key, record):
+        raise NotImplementedError
+
+
+class CheckJournal(_Journal):
+    """
+    Journal of an integrity check (usually in the work dir).
+
+    Records the result of every archive part checked and, for streaming deep checks, the hashes of
+    the files within a part, s.t. a check that has been interrupted can be resumed.
+    """
+    operation = "check"
+
+    def __init__(self, path, resume=False):
+        self.part_results = {}
+        self.member_hashes = {}
+        super().__init__(path, resume)
+
+    def get_part_result(self, part_path, check):
+        """Returns True or False if the part has been checked before, None otherwise"""
+        return self.part_results.get(_get_part_key(part_path, check))
+
+    def get_member_hashes(self, part_path, check):
+        """Returns the hashes of the files of the part that have been checked before by path"""
+        return dict(self.member_hashes.get(_get_part_key(part_path, check), {}))
+
+    def record_part(self, part_path, check, result):
+        key = _get_part_key(part_path, check)
+        self.part_results[key] = result
+        self._write(key, {"result": result})
+
+    def record_members(self, part_path, check, members):
+        """Records the hashes of files of a part as list of [path, hash]"""
+        key = _get_part_key(part_path, check)
+        self.member_hashes.setdefault(key, {}).update(members)
+        self._write(key, {"members": members})
+
+    def _load_record(self, key, record):
+        if "result" in record:
+            self.part_results[key] = record["result"]
+        if "members" in record:
+            self.member_hashes.setdefault(key, {}).update(record["members"])
+
+
+class ExtractionJournal(_Journal):
+    """
+    Journal of an extraction, stored in the destination directory while the extraction is running.
+
+    Records every archive part extracted completely and, for parts extracted using their member index,
+    the last file extracted every now and then, s.t. an extraction that has been interrupted can be
+    resumed without extracting those again. The kind of extraction identifies the files selected.
+    """
+    operation = "extraction"
+
+    def __init__(self, path, resume=False):
+        self.parts_done = set()
+        self.last_members = {}
+        super().__init__(path, resume)
+
+    def is_part_done(self, part_path, kind):
+        return _get_part_key(part_path, kind) in self.parts_done
+
+    def get_last_member(self, part_path, kind):
+        """Returns the path of the last file of the part extracted before (in the order of the archive) or None"""
+        return self.last_members.get(_get_part_key(part_path, kind))
+
+    def record_part_done(self, part_path, kind):
+        key = _get_part_key(part_path, kind)
+        self.parts_done.add(key)
+        self._write(key, {"done": True})
+
+    def record_last_member(self, part_path, kind, member_path):
+        key = _get_part_key(part_path, kind)
+        self.last_members[key] = member_path
+        self._write(key, {"last_member": member_path})
+
+    def _load_record(self, key, record):
+        if record.get("done"):
+            self.parts_done.add(key)
+        if "last_member" in record:
+            self.last_members[key] = record["last_member"]
+
+
+def _get_part_key(part_path, check):
+    stat = part_path.stat()
+
+    return part_path.absolute().as_posix(), stat.st_size, stat.st_mtime_ns, check
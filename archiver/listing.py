@@ -1,19 +1,22 @@
+import fnmatch
 import logging
 import re
-import tempfile
+import subprocess
+import unicodedata
 from collections import namedtuple
 from pathlib import Path
 from typing import List
 
 from . import helpers
+from . import member_index
 from .constants import LISTING_SUFFIX, COMPRESSED_ARCHIVE_SUFFIX, \
     ENCRYPTED_ARCHIVE_SUFFIX
-from .encryption import decrypt_list_of_archives
+from .path_index import ArchivePathIndex
 
 
-def create_listing(source_path, subdir_path=None, deep=False, work_dir=None):
+def create_listing(source_path, subdir_path=None, deep=False):
     if deep:
-        listing_from_archive(source_path, subdir_path, work_dir)
+        listing_from_archive(source_path, subdir_path)
     else:
         listing_from_listing_file(source_path, subdir_path)
 
@@ -36,7 +39,7 @@ def listing_from_listing_file(source_path, subdir_path):
         print("")
 
 
-def listing_from_archive(source_path, subdir_path, work_dir):
+def listing_from_archive(source_path, subdir_path):
     is_encrypted = helpers.path_target_is_encrypted(source_path)
     archives = helpers.get_archives_from_path(source_path, is_encrypted)
 
@@ -50,38 +53,47 @@ def listing_from_archive(source_path, subdir_path, work_dir):
 
     if is_encrypted:
         logging.info("Deep listing of encrypted archive.")
-        decrypt_and_list(archives, subdir_path, work_dir)
     else:
         logging.info("Deep listing of compressed archive.")
-        list_archives(archives, subdir_path)
 
-
-def decrypt_and_list(archives, subdir_path, work_dir):
-    # TODO: Check if enough disk space or warn
-    with tempfile.TemporaryDirectory(dir=work_dir) as temp_path_string:
-        temp_path = Path(temp_path_string)
-
-        decrypt_list_of_archives(archives, temp_path)
-        archives_encrypted = [temp_path / path.with_suffix("").name for path in archives]
-
-        list_archives(archives_encrypted, subdir_path)
+    list_archives(archives, subdir_path)
 
 
 def list_archives(archives, subdir_path):
     for archive in archives:
+        # the content of an encrypted archive is the one of its .tar.lz
+        name = archive.with_suffix("").name if archive.name.endswith(ENCRYPTED_ARCHIVE_SUFFIX) else archive.name
+
         # Both log and print, since listing information is relevant to the user
-        logging.info(f"Listing content of: {archive.name}")
-        print(f"Listing content of: {archive.name}")
-        if subdir_path:
-            result = helpers.run_shell_cmd(["tar", "-tvf", archive, subdir_path], pipe_stdout=True)
-        else:
-            result = helpers.run_shell_cmd(["tar", "-tvf", archive], pipe_stdout=True)
+        logging.info(f"Listing content of: {name}")
+        print(f"Listing content of: {name}")
 
-        decoded_output = result.stdout.decode("utf-8")
+        decoded_output = list_archive(archive, subdir_path).decode("utf-8")
 
         print(decoded_output)
 
 
+def list_archive(archive, subdir_path=None):
+    """
+    Lists the content of an archive, or only subdir_path inside it. Encrypted archives are decrypted in a stream.
+    If the archive has a member index, only the parts of the archive containing subdir_path are decompressed.
+    """
+    tar_cmd = ["tar", "-tvf", "-"] + ([subdir_path] if subdir_path else [])
+    select = (lambda path: path_is_in_subpath(path, subdir_path)) if subdir_path else None
+
+    try:
+        with member_index.open_archive_stream(archive, select) as stream:
+            logging.debug(f"Executing command: '{tar_cmd}'")
+            result = subprocess.run(tar_cmd, stdin=stream, stdout=subprocess.PIPE)
+    except (subprocess.CalledProcessError, ValueError) as error:
+        helpers.terminate_with_message(f"Listing {archive} failed: {error}")
+
+    if result.returncode != 0:
+        helpers.terminate_with_message(f"Listing {subdir_path if subdir_path else 'content'} of {archive} failed")
+
+    return result.stdout
+
+
 # MARK: Helpers
 
 def get_listing_files_for_path(path):
@@ -101,6 +113,11 @@ ListingEntry=namedtuple('ListingEntry', ['permissions', 'owner',
 
 
 def parse_tar_listing(path):
+    return list(iter_tar_listing(path))
+
+
+def iter_tar_listing(path):
+    """Same as parse_tar_listing, but yields the entries one after another"""
     LINK_RE_SEP = re.compile(r"\s?->\s?")
 
     def _process_path(fields, path_index, orig_line):
@@ -132,18 +149,64 @@ def parse_tar_listing(path):
         return ListingEntry(line[0], line[2], line[3], line[4],
                             ' '.join(line[5:7]), line[7], path, link_target)
 
-    entries = []
     with open(path, 'r', newline='\n') as f:
-        for l in f.readlines():
+        for l in f:
             fields = l.split()
 
             # assume field 3 is a date formatted like 2020-12-17 to determine listing format
             is_gnu_tar = '-' in fields[3]
             entry = _process_gnutar(fields, l) if is_gnu_tar else _process_bsdtar(
                 fields, l)
-            entries.append(entry)
+            yield entry
+
+
+# escape sequences of the names tar lists, other characters are escaped as octal numbers
+_TAR_NAME_ESCAPES = {b"a": b"\a", b"b": b"\b", b"f": b"\f", b"n": b"\n", b"r": b"\r", b"t": b"\t", b"v": b"\v"}
 
-    return entries
+
+def parse_verbose_member_name(line):
+    """Path of a member in a line of the verbose output of tar -x, as given by tarfile (without the trailing slash)"""
+    def unescape(match):
+        sequence = match.group(1)
+        if len(sequence) == 3:
+            return bytes([int(sequence, 8)])
+
+        return _TAR_NAME_ESCAPES.get(sequence, sequence)
+
+    name = re.sub(rb"\\([0-7]{3}|.)", unescape, line.rstrip(b"\n"))
+
+    return unicodedata.normalize('NFC', name.decode("utf-8", "surrogateescape")).rstrip("/")
+
+
+def get_listing_path(archive_path):
+    return archive_path.parent / (helpers.filename_without_archive_extensions(archive_path) + LISTING_SUFFIX)
+
+
+def index_listing_paths(listing_paths):
+    """ArchivePathIndex of all paths in the given listings, e.g. of all parts of an archive"""
+    path_index = ArchivePathIndex()
+    for listing_path in listing_paths:
+        for entry in iter_tar_listing(listing_path):
+            path_index.add(entry.path, entry.link_target, entry.permissions.startswith("d"))
+    path_index.freeze()
+
+    return path_index
+
+
+def get_directory_link_predicate(path_index):
+    """
+    Returns a function telling whether a symlink, given by its path and target, points to a directory, see
+    streaming.hash_tar_members. Relative targets are resolved within the archive using the path index. Absolute
+    targets are looked up on the local filesystem, just like os.walk does for an extracted archive.
+    """
+    def is_directory_link(path, member):
+        link_target = member.linkname
+        if Path(link_target).is_absolute():
+            return Path(link_target).is_dir()
+
+        return path_index.link_points_to_directory(path, link_target)
+
+    return is_directory_link
 
 
 def relevant_splits_for_partial_path(archive_path: Path,
@@ -162,3 +225,113 @@ def relevant_splits_for_partial_path(archive_path: Path,
                 archive_file_set.add(part_path)
 
     return sorted(list(archive_file_set))
+
+
+def path_is_in_subpath(path, subpath):
+    """Whether path is subpath or inside of it, in the way tar matches member names given on the command line"""
+    subpath = normalize_member_path(subpath)
+
+    return path == subpath or path.startswith(subpath + "/")
+
+
+def normalize_member_path(path):
+    path = unicodedata.normalize('NFC', str(path)).strip("/")
+
+    return path[2:] if path.startswith("./") else path
+
+
+class MemberSelection:
+    """
+    Paths and glob patterns selecting members of an archive, e.g. for extraction. A member is selected if
+    it or one of its parent directories is one of the paths or matches one of the patterns, the way tar
+    matches member names given on the command line (i.e. `*` matches `/` as well).
+    """
+    def __init__(self, paths=None, patterns=None):
+        self.paths = list(dict.fromkeys(normalize_member_path(path) for path in paths or []))
+        self.patterns = list(dict.fromkeys(patterns or []))
+        self._path_set = set(self.paths)
+        self._pattern_regexes = [re.compile(fnmatch.translate(pattern)) for pattern in self.patterns]
+        # most paths don't match any pattern, which a single regex for all patterns tells faster
+        self._any_pattern_regex = re.compile("|".join(fnmatch.translate(pattern) for pattern in self.patterns)) \
+            if self.patterns else None
+
+    def __bool__(self):
+        return bool(self.paths or self.patterns)
+
+    def __str__(self):
+        if len(self.paths) + len(self.patterns) == 1:
+            return (self.paths + self.patterns)[0]
+
+        return f"{len(self.paths)} paths and {len(self.patterns)} patterns"
+
+    def get_selectors(self):
+        return [("path", path) for path in self.paths] + [("pattern", pattern) for pattern in self.patterns]
+
+    def get_matching_selectors(self, path):
+        """Returns the paths and patterns selecting path as ("path", path) or ("pattern", pattern)"""
+        selectors = []
+        candidate = normalize_member_path(path)
+
+        while candidate:
+            if candidate in self._path_set:
+                selectors.append(("path", candidate))
+            if self._any_pattern_regex and self._any_pattern_regex.match(candidate):
+                selectors.extend(("pattern", pattern) for pattern, regex in zip(self.patterns, self._pattern_regexes)
+                                 if regex.match(candidate))
+            candidate = candidate.rpartition("/")[0]
+
+        return selectors
+
+    def matches(self, path):
+        return bool(self.get_matching_selectors(path))
+
+    def restricted_to(self, selectors):
+        """Returns the selection of the given paths and patterns only, e.g. of those matching the members of a part"""
+        return MemberSelection([path for path in self.paths if ("path", path) in selectors],
+                               [pattern for pattern in self.patterns if ("pattern", pattern) in selectors])
+
+    def write_tar_arguments(self, directory):
+        """
+        Writes the paths and patterns to files in directory and returns the arguments making tar select the
+        same members. The names are passed verbatim, i.e. without unquoting or treating them as options.
+        """
+        arguments = []
+
+        for kind, values, matching in [("paths", self.paths, "--no-wildcards"), ("patterns", self.patterns, "--wildcards")]:
+            if values:
+                list_path = directory / f"{kind}.txt"
+                list_path.write_text("".join(f"{value}\n" for value in values))
+                arguments.extend([matching, "--verbatim-files-from", "--files-from", list_path])
+
+        return arguments
+
+
+def plan_extraction(source_path, selection):
+    """
+    Works out which parts of an archive contain members selected, reading the listing of every part once.
+
+    :return: dict of the listing name of every part needed (without suffix, e.g. "project.part2") to the
+             selection restricted to the paths and patterns matching members in this part
+    """
+    plan = {}
+    matched_selectors = set()
+
+    for listing_file in get_listing_files_for_path(source_path):
+        selectors = set()
+        for entry in iter_tar_listing(listing_file):
+            selectors.update(selection.get_matching_selectors(entry.path))
+
+        if selectors:
+            plan[listing_file.name[:-len(LISTING_SUFFIX)]] = selection.restricted_to(selectors)
+            matched_selectors.update(selectors)
+
+    for kind, value in selection.get_selectors():
+        if (kind, value) not in matched_selectors:
+            logging.warning(f"No files matching {kind} {value} found in the listings of {source_path}")
+
+    if not plan:
+        helpers.terminate_with_message(f"No files matching {selection} found in the listings of {source_path}")
+
+    logging.info(f"Files matching {selection} are contained in {len(plan)} parts: {', '.join(plan)}")
+
+    return plan
@@ -13,10 +13,14 @@ from archiver import helpers, __version__
 from archiver.archive import create_archive, encrypt_existing_archive, \
     create_filelist_and_hashs, \
     create_tar_archives_and_listings, compress_and_hash
-from archiver.constants import DEFAULT_COMPRESSION_LEVEL
-from archiver.extract import extract_archive, decrypt_existing_archive
+from archiver.chunk_hashes import create_chunk_hash_files
+from archiver.constants import DEFAULT_COMPRESSION_LEVEL, HASH_CACHE_FILE_NAME, DEFAULT_HASH_ALGORITHM, \
+    CHUNK_HASH_BYTE_SIZE, SCRUB_LEDGER_FILE_NAME
+from archiver.hashing import get_available_hash_algorithms
+from archiver.extract import extract_archive, decrypt_existing_archive, RestoreReport
 from archiver.integrity import check_integrity
-from archiver.listing import create_listing
+from archiver.listing import create_listing, MemberSelection
+from archiver.scrub import scrub
 from archiver.preparation_checks import CmdBasedCheck
 
 
@@ -83,6 +87,24 @@ def parse_arguments(args):
     encryption_key_help = "Path to public key which will be used for encryption. Archive will be encrypted when this " \
                           "option is used. Can be used more than once."
     remove_unencrypted_help = "Remove unencrypted archive after encrypted archive has been created and stored."
+    single_pass_help = "Compute the file hashes from the tar stream while the archive is written, " \
+                       "s.t. the source files are read only once."
+    pipeline_help = "Chain tar, plzip and gpg through pipes without writing intermediate files. " \
+                    "All hashes are computed on the streams. Implies --single-pass."
+    hash_cache_help = "Cache file hashes in the work dir (requires --work-dir), s.t. unchanged files are not " \
+                      "hashed again when the command is re-run. Ignored by --single-pass and --pipeline."
+    compressed_part_size_help = "Split archive into parts by specifying the maximum size of each compressed part. " \
+                                "The compressed sizes are estimated from samples of the data, s.t. parts may " \
+                                "slightly exceed this size. Example: 500G."
+    max_files_per_part_help = "Maximum number of files per part, requires --part-size. Implies the planner of --balanced-parts."
+    balanced_parts_help = "Plan parts s.t. they are as equally sized as possible instead of filling parts one after " \
+                          "another, without increasing the number of parts. Requires --part-size."
+    io_workers_help = "Maximum number of I/O bound steps (tar, hashing) running at the same time while the " \
+                      "parts of a split archive are compressed, default is the number of threads."
+    chunk_hashes_help = "Write the hashes of fixed-size chunks of every compressed and encrypted archive file to a " \
+                        "sidecar (.chunks), which lets check verify large archive files with several threads."
+    hash_algorithm_help = f"Hash algorithm for file and archive hashes, default is {DEFAULT_HASH_ALGORITHM}. " \
+                          "The algorithm is recorded in the hash files and detected automatically by all other commands."
 
     # Create Archive Parent Parser
     archive_parent_parser = argparse.ArgumentParser(add_help=False)
@@ -96,8 +118,18 @@ def parse_arguments(args):
     parser_archive.add_argument("-k", "--key", type=str, action="append",
                                 help=encryption_key_help)
     parser_archive.add_argument("--part-size", type=str, help=part_size_help)
+    parser_archive.add_argument("--compressed-part-size", type=str, help=compressed_part_size_help)
+    parser_archive.add_argument("--max-files-per-part", type=int, help=max_files_per_part_help)
+    parser_archive.add_argument("--balanced-parts", action="store_true", default=False, help=balanced_parts_help)
+    parser_archive.add_argument("--io-workers", type=int, help=io_workers_help)
+    parser_archive.add_argument("--chunk-hashes", action="store_true", default=False, help=chunk_hashes_help)
     parser_archive.add_argument("-r", "--remove", action="store_true", default=False, help=remove_unencrypted_help)
     parser_archive.add_argument("-f", "--force", action="store_true", default=False, help=force_help)
+    parser_archive.add_argument("--single-pass", action="store_true", default=False, help=single_pass_help)
+    parser_archive.add_argument("--pipeline", action="store_true", default=False, help=pipeline_help)
+    parser_archive.add_argument("--hash-cache", action="store_true", default=False, help=hash_cache_help)
+    parser_archive.add_argument("--hash-algorithm", choices=get_available_hash_algorithms(),
+                                default=DEFAULT_HASH_ALGORITHM, help=hash_algorithm_help)
     parser_archive.set_defaults(func=handle_archive)
 
     parser_create = subparsers.add_parser("create", help="Create archives step-by-step (optimization possibilities for large split archives)")
@@ -105,7 +137,15 @@ def parse_arguments(args):
 
     parser_create_filelist = subparser_create.add_parser("filelist", help="create list and hashs of all files to be archived", parents=[archive_parent_parser])
     parser_create_filelist.add_argument("--part-size", type=str, help=part_size_help)
+    parser_create_filelist.add_argument("--compressed-part-size", type=str, help=compressed_part_size_help)
+    parser_create_filelist.add_argument("-c", "--compression", type=int,
+                                        help=compression_help + ". Only used for estimating sizes with --compressed-part-size")
+    parser_create_filelist.add_argument("--max-files-per-part", type=int, help=max_files_per_part_help)
+    parser_create_filelist.add_argument("--balanced-parts", action="store_true", default=False, help=balanced_parts_help)
     parser_create_filelist.add_argument("-f", "--force", action="store_true", default=False, help=force_help)
+    parser_create_filelist.add_argument("--hash-cache", action="store_true", default=False, help=hash_cache_help)
+    parser_create_filelist.add_argument("--hash-algorithm", choices=get_available_hash_algorithms(),
+                                        default=DEFAULT_HASH_ALGORITHM, help=hash_algorithm_help)
     parser_create_filelist.set_defaults(func=handle_create_filelist)
 
     parser_create_tar = subparser_create.add_parser("tar", help="create tar archives and listings", parents=[archive_parent_parser])
@@ -119,6 +159,13 @@ def parse_arguments(args):
     parser_create_compressed.add_argument("-p", "--part", type=str, help=part_help)
     parser_create_compressed.set_defaults(func=handle_create_compressed)
 
+    parser_create_chunk_hashes = subparser_create.add_parser("chunk-hashes", help="create chunk hashes of existing archives")
+    parser_create_chunk_hashes.add_argument("archive_dir", type=str, help="Archive directory or .tar.lz(.gpg) file")
+    parser_create_chunk_hashes.add_argument("-n", "--threads", type=int, help=thread_help)
+    parser_create_chunk_hashes.add_argument("--chunk-size", type=str,
+                                            help=f"Size of the chunks, default is {CHUNK_HASH_BYTE_SIZE // 1024**2}M")
+    parser_create_chunk_hashes.set_defaults(func=handle_create_chunk_hashes)
+
     # Encryption parser
     parser_encrypt = subparsers.add_parser("encrypt", help="Encrypt existing unencrypted archive")
     parser_encrypt.add_argument("source", type=str, help="Existing archive directory or .tar.lz file")
@@ -144,8 +191,19 @@ def parse_arguments(args):
     parser_extract.add_argument("archive_dir", type=str, help="Select source archive tar.lz file")
     parser_extract.add_argument("destination", type=str, help="Path to directory where archive will be extracted")
     parser_extract.add_argument("-s", "--subpath", type=str, help="Directory or file inside archive to extract")
+    parser_extract.add_argument("--files-from", type=str,
+                                help="Extract the directories or files inside the archive listed in this file, one per line")
+    parser_extract.add_argument("--glob", type=str, action="append",
+                                help="Extract the files inside the archive matching this shell pattern, "
+                                     "e.g. 'data/*.csv'. Can be repeated and combined with --files-from")
     parser_extract.add_argument("-n", "--threads", type=int, help=thread_help)
     parser_extract.add_argument("-f", "--force", action="store_true", default=False, help=force_help)
+    parser_extract.add_argument("--resume", action="store_true",
+                                help="Continue an interrupted extraction into the existing destination, "
+                                     "without extracting the archives and files again that have been extracted before")
+    parser_extract.add_argument("--verify", action="store_true",
+                                help="Hash the files while they are extracted, compare them to the hash listings "
+                                     "of the archive and print a restore report")
     parser_extract.set_defaults(func=handle_extract)
 
     # List parser
@@ -159,9 +217,47 @@ def parse_arguments(args):
     parser_check = subparsers.add_parser("check", help="Check integrity of archive")
     parser_check.add_argument("archive_dir", type=str, help="Select source archive directory or .tar.lz file")
     parser_check.add_argument("-d", "--deep", action="store_true", help="Verify integrity by unpacking archive and hashing each file")
+    parser_check.add_argument("-m", "--medium", action="store_true",
+                              help="Verify integrity by decompressing the archive without unpacking it, which checks "
+                                   "the lzip checksums and the hash of the tar archive. Ignored with --deep")
+    parser_check.add_argument("--stream", action="store_true",
+                              help="Only with --deep: hash the files while the archive is decompressed instead of "
+                                   "extracting it, s.t. no scratch space is needed")
     parser_check.add_argument("-n", "--threads", type=int, help=thread_help)
+    parser_check.add_argument("--io-workers", type=int,
+                              help="Only with --deep --stream or --medium: maximum number of archive parts read at the same time, "
+                                   "by default as many as the threads allow")
+    parser_check.add_argument("--subpath", type=str,
+                              help="Only with --deep: only verify the files below this path inside the archive. Only the "
+                                   "parts containing such files according to the listings are read. Implies --stream")
+    parser_check.add_argument("--sample", type=str,
+                              help="Verify the hashes of a random sample of the files in every part instead of all files, "
+                                   "given as number of files, percentage of files or total size per part. "
+                                   "Examples: 100, 5%%, 10G")
+    parser_check.add_argument("--seed", type=int,
+                              help="Only with --sample: seed for drawing the sample, s.t. the same files are checked again. "
+                                   "By default, a random seed is used and logged")
+    parser_check.add_argument("--resume", action="store_true",
+                              help="Only with --deep or --medium: skip the archive parts (and with --stream, the files) "
+                                   "verified by a previous, interrupted check (of the same --subpath, if given). "
+                                   "Requires --work-dir, in which the progress of deep and medium checks is recorded")
     parser_check.set_defaults(func=handle_check)
 
+    # Scrubbing
+    parser_scrub = subparsers.add_parser("scrub", help="Check integrity of all archives below a directory, least recently checked parts first")
+    parser_scrub.add_argument("root_dir", type=str, help="Directory containing archive directories")
+    parser_scrub.add_argument("-n", "--threads", type=int, help="Set the number of archive parts checked at the same time")
+    parser_scrub.add_argument("--max-bytes", type=str,
+                              help="Stop once this many bytes of archive parts have been checked, but check at least one part. Example: 500G")
+    parser_scrub.add_argument("--max-time", type=str,
+                              help="Don't start checking further parts after this time. Example: 90m, 8h")
+    parser_scrub.add_argument("--ledger", type=str,
+                              help=f"Ledger file recording when parts were checked and the results, default is {SCRUB_LEDGER_FILE_NAME} in the work dir")
+    parser_scrub.add_argument("--forget-missing", action="store_true",
+                              help="Remove parts which don't exist anymore from the ledger, e.g. of archives deleted on purpose. "
+                                   "Otherwise, they are reported as missing by the first run not finding them")
+    parser_scrub.set_defaults(func=handle_scrub)
+
     # Preparation checks
     parser_preparation_check = subparsers.add_parser("preparation-checks",
                                      help='Verify source directory has a sound structure before archiving')
@@ -185,33 +281,61 @@ def handle_archive(args):
 
     threads = helpers.get_threads_from_args_or_environment(args.threads)
 
-    bytes_splitting = None
-
     work_dir = args.work_dir
 
-    if args.part_size:
-        try:
-            bytes_splitting = helpers.get_bytes_in_string_with_unit(args.part_size)
-        except Exception as error:
-            helpers.terminate_with_exception(error)
+    bytes_splitting, split_compression = get_split_size_from_args(args, compression)
+    hash_cache_path = get_hash_cache_path_from_args(args)
 
-    create_archive(source_path, destination_path, threads, args.key, compression, bytes_splitting, args.remove, args.force, work_dir)
+    create_archive(source_path, destination_path, threads, args.key, compression, bytes_splitting, args.remove, args.force, work_dir, args.single_pass, args.pipeline, hash_cache_path, args.hash_algorithm, args.max_files_per_part, args.balanced_parts, split_compression, args.io_workers, args.chunk_hashes)
 
 
 def handle_create_filelist(args):
     source_path = Path(args.source)
     destination_path = Path(args.archive_dir)
     threads = helpers.get_threads_from_args_or_environment(args.threads)
+    compression = args.compression if args.compression else DEFAULT_COMPRESSION_LEVEL
 
-    bytes_splitting = None
+    bytes_splitting, split_compression = get_split_size_from_args(args, compression)
+    hash_cache_path = get_hash_cache_path_from_args(args)
 
-    if args.part_size:
-        try:
-            bytes_splitting = helpers.get_bytes_in_string_with_unit(args.part_size)
-        except Exception as error:
-            helpers.terminate_with_exception(error)
+    create_filelist_and_hashs(source_path, destination_path, bytes_splitting, threads, args.force, hash_cache_path,
+                              args.hash_algorithm, args.max_files_per_part, args.balanced_parts, split_compression)
+
+
+def get_split_size_from_args(args, compression):
+    """
+    Returns the part size in bytes and the compression level to estimate compressed sizes with,
+    which is None if the part size refers to uncompressed sizes
+    """
+    if args.part_size and args.compressed_part_size:
+        helpers.terminate_with_message("Only one of --part-size and --compressed-part-size can be used")
 
-    create_filelist_and_hashs(source_path, destination_path, bytes_splitting, threads, args.force)
+    if (args.max_files_per_part or args.balanced_parts) and not (args.part_size or args.compressed_part_size):
+        helpers.terminate_with_message("--max-files-per-part and --balanced-parts require --part-size or --compressed-part-size")
+
+    part_size = args.part_size or args.compressed_part_size
+    if not part_size:
+        return None, None
+
+    try:
+        bytes_splitting = helpers.get_bytes_in_string_with_unit(part_size)
+    except Exception as error:
+        helpers.terminate_with_exception(error)
+
+    return bytes_splitting, compression if args.compressed_part_size else None
+
+
+def get_hash_cache_path_from_args(args):
+    if not args.hash_cache:
+        return None
+
+    if not args.work_dir:
+        helpers.terminate_with_message("--hash-cache requires a work dir to store the cache in, use --work-dir")
+
+    work_dir = Path(args.work_dir)
+    helpers.terminate_if_directory_nonexistent(work_dir)
+
+    return work_dir / HASH_CACHE_FILE_NAME
 
 
 def handle_create_tar_archive(args):
@@ -236,6 +360,21 @@ def handle_create_compressed(args):
     compress_and_hash(destination_path, threads, compression, part)
 
 
+def handle_create_chunk_hashes(args):
+    archive_path = Path(args.archive_dir)
+    threads = helpers.get_threads_from_args_or_environment(args.threads)
+    chunk_size = CHUNK_HASH_BYTE_SIZE
+
+    if args.chunk_size:
+        try:
+            chunk_size = helpers.get_bytes_in_string_with_unit(args.chunk_size)
+        except Exception as error:
+            helpers.terminate_with_exception(error)
+
+    helpers.terminate_if_path_nonexistent(archive_path)
+    create_chunk_hash_files(archive_path, chunk_size, threads)
+
+
 def handle_encryption(args):
     source_path = Path(args.source)
     destination_path = Path(args.destination) if args.destination else None
@@ -257,7 +396,7 @@ def handle_decryption(args):
     source_path = Path(args.source)
     destination_path = Path(args.destination) if args.destination else None
 
-    threads = args.threads if args.threads else 1
+    threads = helpers.get_threads_from_args_or_environment(args.threads)
     decrypt_existing_archive(source_path, destination_path, args.remove, args.force, threads=threads)
 
 
@@ -268,14 +407,41 @@ def handle_extract(args):
 
     threads = helpers.get_threads_from_args_or_environment(args.threads)
 
-    extract_archive(source_path, destination_directory_path, args.subpath, threads, args.force)
+    if args.resume and args.force:
+        helpers.terminate_with_message("--resume can't be combined with --force, which deletes the existing destination")
+
+    selection = None
+    if args.files_from or args.glob:
+        if args.subpath:
+            helpers.terminate_with_message("--subpath can't be combined with --files-from or --glob")
+        selection = MemberSelection(_read_paths_from_file(Path(args.files_from)) if args.files_from else None,
+                                    args.glob)
+
+    report = RestoreReport() if args.verify else None
+
+    extract_archive(source_path, destination_directory_path, args.subpath, threads, args.force, selection=selection,
+                    resume=args.resume, report=report)
+
+    if report:
+        print("\n".join(report.get_lines()))
+        if not report.success:
+            # same error code as an unsuccessful integrity check
+            return sys.exit(3)
+
+
+def _read_paths_from_file(path):
+    if not path.is_file():
+        helpers.terminate_with_message(f"File with paths to extract {path} doesn't exist")
+
+    with open(path, "r", newline="\n") as file:
+        return [line.rstrip("\n") for line in file if line.strip()]
 
 
 def handle_list(args):
     # Path to archive file *.tar.lz
     source_path = Path(args.archive_dir)
 
-    create_listing(source_path, args.subpath, args.deep, args.work_dir)
+    create_listing(source_path, args.subpath, args.deep)
 
 
 def handle_check(args):
@@ -283,12 +449,61 @@ def handle_check(args):
     source_path = Path(args.archive_dir)
     threads = helpers.get_threads_from_args_or_environment(args.threads)
 
-    if not check_integrity(source_path, args.deep, threads, args.work_dir):
+    if args.resume and not args.work_dir:
+        helpers.terminate_with_message("--resume requires the work dir of the interrupted check, use --work-dir")
+
+    if args.resume and not (args.deep or args.medium):
+        helpers.terminate_with_message("--resume requires --deep or --medium")
+
+    if args.subpath and not args.deep:
+        helpers.terminate_with_message("--subpath requires --deep")
+
+    sample_size = None
+    if args.sample:
+        if args.deep or args.medium:
+            helpers.terminate_with_message("--sample can't be combined with --deep or --medium")
+        try:
+            sample_size = helpers.get_sample_size_from_string(args.sample)
+        except Exception as error:
+            helpers.terminate_with_exception(error)
+    elif args.seed is not None:
+        helpers.terminate_with_message("--seed requires --sample")
+
+    if not check_integrity(source_path, args.deep, threads, args.work_dir, args.stream, args.io_workers,
+                           args.medium, args.resume, sample_size, args.seed, args.subpath):
         # return a different error code to the default code of 1 to be able to distinguish
         # general errors from a successful run of the program with an unsuccessful outcome
         # not taking 2, as it usually stands for command line argument errors
         return sys.exit(3)
 
+
+def handle_scrub(args):
+    root_path = Path(args.root_dir)
+    threads = helpers.get_threads_from_args_or_environment(args.threads)
+
+    try:
+        max_bytes = helpers.get_bytes_in_string_with_unit(args.max_bytes) if args.max_bytes else None
+        max_seconds = helpers.get_seconds_in_string_with_unit(args.max_time) if args.max_time else None
+    except Exception as error:
+        helpers.terminate_with_exception(error)
+
+    if not scrub(root_path, get_scrub_ledger_path_from_args(args), threads, max_bytes, max_seconds, args.forget_missing):
+        return sys.exit(3)
+
+
+def get_scrub_ledger_path_from_args(args):
+    if args.ledger:
+        return Path(args.ledger)
+
+    if not args.work_dir:
+        helpers.terminate_with_message("scrub requires a ledger file, use --ledger or --work-dir")
+
+    work_dir = Path(args.work_dir)
+    helpers.terminate_if_directory_nonexistent(work_dir)
+
+    return work_dir / SCRUB_LEDGER_FILE_NAME
+
+
 DEFAULT_FILE_CHECK_PATH = Path(__file__).parent / 'checks' / 'default_preparation_checks.ini'
 def handle_preparation_check(parsed_args):
     wdir = Path(parsed_args.archive_source_dir).absolute()
@@ -0,0 +1,508 @@
+import contextlib
+import logging
+import os
+import re
+import struct
+import subprocess
+import tarfile
+import unicodedata
+from bisect import bisect_right
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from . import helpers
+from . import streaming
+from .encryption import get_stream_decryption_command
+from .constants import COMPRESSED_ARCHIVE_SUFFIX, ENCRYPTED_ARCHIVE_SUFFIX, MEMBER_INDEX_SUFFIX, MEMBER_INDEX_VERSION, \
+    MEMBER_INDEX_HEADER_REGEX, LZIP_MAGIC, LZIP_HEADER_BYTE_SIZE, LZIP_TRAILER_BYTE_SIZE, STREAM_CHUNK_BYTE_SIZE, \
+    TAR_BLOCK_BYTE_SIZE, TAR_MEMBERS_SUFFIX
+
+# lzip_members: (compressed offset, uncompressed offset) of every lzip member
+# tar_members: (offset, end, path) of every tar member in the uncompressed tar archive, including its extended headers
+MemberIndex = namedtuple("MemberIndex", ["tar_size", "compressed_size", "lzip_members", "tar_members"])
+
+
+def get_member_index_path(archive_path):
+    """
+    The index is stored next to the archive file and named after it. The index of a .tar.lz is valid for the decrypted
+    .tar.lz of a .tar.lz.gpg as well, i.e. it's named after the .tar.lz.gpg if only that is kept.
+    """
+    return helpers.add_suffix_to_path(archive_path, MEMBER_INDEX_SUFFIX)
+
+
+def find_member_index_path(archive_path):
+    """
+    Returns the path of the existing index of an archive file or None. For a .tar.lz.gpg, this may be the index of
+    the .tar.lz next to it, which it has been encrypted from.
+    """
+    candidates = [get_member_index_path(archive_path)]
+    if archive_path.name.endswith(ENCRYPTED_ARCHIVE_SUFFIX):
+        candidates.append(get_member_index_path(archive_path.parent / (
+            helpers.filename_without_archive_extensions(archive_path) + COMPRESSED_ARCHIVE_SUFFIX)))
+
+    return next((path for path in candidates if path.is_file()), None)
+
+
+def get_tar_member_range(member):
+    """Returns the offset, end and name of a tarfile member, the range covers all of its headers and its data"""
+    end = member.offset_data
+    if member.isreg() or member.type not in tarfile.SUPPORTED_TYPES:
+        end += -(-member.size // TAR_BLOCK_BYTE_SIZE) * TAR_BLOCK_BYTE_SIZE
+
+    return member.offset, end, member.name
+
+
+def get_tar_members(tar_path):
+    """Returns the ranges of all members of a tar archive, reading only their headers"""
+    with tarfile.open(tar_path, "r:") as tar:
+        return [get_tar_member_range(member) for member in streaming.iter_tar_members(tar)]
+
+
+@contextlib.contextmanager
+def record_tar_members(tar_path):
+    """
+    Context manager yielding a function to call with the tarinfo of every member of a tar archive, e.g. while the
+    archive is written or hashed. The ranges of the members are written next to the archive, s.t. its member index
+    can be created once it has been compressed without reading it again, see pop_tar_members.
+    """
+    with open(helpers.add_suffix_to_path(tar_path, TAR_MEMBERS_SUFFIX), "w", encoding="utf-8",
+              errors="surrogateescape") as members_file:
+        def record(member):
+            offset, end, path = get_tar_member_range(member)
+            members_file.write(f"{offset} {end} {_escape_path(path)}\n")
+
+        yield record
+
+
+def pop_tar_members(tar_path):
+    """
+    Returns the ranges of the members of a tar archive recorded by record_tar_members and removes the file they have
+    been recorded in. If they haven't been recorded, the headers of the archive are read.
+    """
+    members_path = helpers.add_suffix_to_path(tar_path, TAR_MEMBERS_SUFFIX)
+
+    if not members_path.is_file():
+        return get_tar_members(tar_path)
+
+    with open(members_path, "r", encoding="utf-8", errors="surrogateescape", newline="\n") as members_file:
+        tar_members = [(int(offset), int(end), _unescape_path(path))
+                       for offset, end, path in (line.rstrip("\n").split(" ", 2) for line in members_file)]
+    members_path.unlink()
+
+    return tar_members
+
+
+def read_lzip_members(compressed_path):
+    """
+    Returns the (compressed offset, uncompressed offset) of every member of an lzip file and its uncompressed size.
+
+    The members are found from the end of the file using the member sizes stored in their trailers,
+    s.t. only a few bytes per member are read.
+
+    :raises ValueError: if the file isn't a sequence of lzip members
+    """
+    with open(compressed_path, "rb") as file:
+        def get_trailer_before(position):
+            file.seek(position - LZIP_TRAILER_BYTE_SIZE)
+            return file.read(LZIP_TRAILER_BYTE_SIZE)
+
+        def is_member_start(position):
+            file.seek(position)
+            return file.read(len(LZIP_MAGIC)) == LZIP_MAGIC
+
+        return _find_lzip_members(file.seek(0, os.SEEK_END), get_trailer_before, is_member_start)
+
+
+class LzipMemberScanner:
+    """
+    Sink for an lzip stream which finds its members while the stream is written to it, for creating the
+    member index without reading the compressed file again (or if it isn't stored at all).
+
+    The offset of every lzip header magic in the stream is kept with the 20 bytes in front of it,
+    which are the trailer of the previous member if it's the start of a member. In the end, the
+    members are found from the end of the stream, as by read_lzip_members.
+    """
+    def __init__(self):
+        self.size = 0
+        self.trailers_before = {}
+        # enough to find a magic spanning two writes and the trailer in front of it
+        self.tail = b""
+        self.tail_size = LZIP_TRAILER_BYTE_SIZE + len(LZIP_MAGIC) - 1
+
+    def write(self, data):
+        buffer = self.tail + data
+        buffer_offset = self.size - len(self.tail)
+        # magics starting in the tail have been searched for before
+        position = buffer.find(LZIP_MAGIC, max(0, len(self.tail) - len(LZIP_MAGIC) + 1))
+
+        while position != -1:
+            offset = buffer_offset + position
+            if offset == 0 or offset >= LZIP_HEADER_BYTE_SIZE + LZIP_TRAILER_BYTE_SIZE:
+                self.trailers_before[offset] = buffer[position - LZIP_TRAILER_BYTE_SIZE:position]
+            position = buffer.find(LZIP_MAGIC, position + 1)
+
+        self.size += len(data)
+        self.tail = buffer[-self.tail_size:]
+
+    def get_lzip_members(self):
+        """Same as read_lzip_members for the stream written so far"""
+        def get_trailer_before(position):
+            return self.tail[-LZIP_TRAILER_BYTE_SIZE:] if position == self.size else self.trailers_before[position]
+
+        return _find_lzip_members(self.size, get_trailer_before, self.trailers_before.__contains__)
+
+
+def _find_lzip_members(size, get_trailer_before, is_member_start):
+    offsets = []
+    data_sizes = []
+    position = size
+
+    while position > 0:
+        if position < LZIP_HEADER_BYTE_SIZE + LZIP_TRAILER_BYTE_SIZE:
+            raise ValueError(f"There are {position} bytes before the first lzip member")
+
+        _, data_size, member_size = struct.unpack("<IQQ", get_trailer_before(position))
+        if not LZIP_HEADER_BYTE_SIZE + LZIP_TRAILER_BYTE_SIZE <= member_size <= position:
+            raise ValueError(f"Invalid lzip member trailer at offset {position - LZIP_TRAILER_BYTE_SIZE}")
+
+        position -= member_size
+        if not is_member_start(position):
+            raise ValueError(f"No lzip member header at offset {position}")
+
+        offsets.append(position)
+        data_sizes.append(data_size)
+
+    lzip_members = []
+    uncompressed_offset = 0
+    for offset, data_size in zip(reversed(offsets), reversed(data_sizes)):
+        lzip_members.append((offset, uncompressed_offset))
+        uncompressed_offset += data_size
+
+    return lzip_members, uncompressed_offset
+
+
+def create_member_index(compressed_path, tar_members, scanner=None, archive_path=None):
+    """
+    Writes the member index of a .tar.lz file, given the ranges of the members (see get_tar_member_range)
+    of the tar archive it has been compressed from. The lzip members are read from the file, or taken
+    from the scanner the compressed stream has been written to.
+
+    The index is stored next to archive_path, by default the .tar.lz file. If only its encrypted version is kept,
+    that is the .tar.lz.gpg file.
+    """
+    archive_path = archive_path if archive_path else compressed_path
+
+    try:
+        if scanner:
+            (lzip_members, tar_size), compressed_size = scanner.get_lzip_members(), scanner.size
+        else:
+            (lzip_members, tar_size), compressed_size = read_lzip_members(compressed_path), compressed_path.stat().st_size
+    except ValueError as error:
+        logging.warning(f"No member index created for {compressed_path.name}: {error}")
+        return
+
+    if tar_members and tar_members[-1][1] > tar_size:
+        logging.warning(f"No member index created for {compressed_path.name}: "
+                        f"the tar members exceed its uncompressed size")
+        return
+
+    index_path = get_member_index_path(archive_path)
+    with open(index_path, "w", encoding="utf-8", errors="surrogateescape") as index_file:
+        index_file.write(f"# archiver-member-index version={MEMBER_INDEX_VERSION} tar_size={tar_size} "
+                         f"compressed_size={compressed_size}\n")
+        for compressed_offset, uncompressed_offset in lzip_members:
+            index_file.write(f"l {compressed_offset} {uncompressed_offset}\n")
+        for offset, end, path in tar_members:
+            index_file.write(f"t {offset} {end} {_escape_path(path)}\n")
+
+    logging.info(f"Member index of {archive_path.name} written to {index_path.name}: {len(tar_members)} tar members "
+                 f"in {len(lzip_members)} lzip members")
+
+
+def read_member_index(index_path):
+    """:raises ValueError: if the file isn't a valid member index"""
+    lzip_members = []
+    tar_members = []
+
+    with open(index_path, "r", encoding="utf-8", errors="surrogateescape", newline="\n") as index_file:
+        header = MEMBER_INDEX_HEADER_REGEX.match(index_file.readline())
+        if not header:
+            raise ValueError(f"{index_path} is not a valid member index")
+
+        version, tar_size, compressed_size = (int(group) for group in header.groups())
+        if version > MEMBER_INDEX_VERSION:
+            raise ValueError(f"Member index {index_path} has version {version}, "
+                             f"but only versions up to {MEMBER_INDEX_VERSION} are supported")
+
+        for line in index_file:
+            kind, fields = line[0], line[2:].rstrip("\n").split(" ", 2)
+            if kind == "l":
+                lzip_members.append((int(fields[0]), int(fields[1])))
+            elif kind == "t":
+                tar_members.append((int(fields[0]), int(fields[1]), _unescape_path(fields[2])))
+            else:
+                raise ValueError(f"Invalid line in member index {index_path}: {line!r}")
+
+    if not lzip_members:
+        raise ValueError(f"Member index {index_path} contains no lzip members")
+
+    return MemberIndex(tar_size, compressed_size, lzip_members, tar_members)
+
+
+def load_member_index(archive_path, index_path=None):
+    """
+    Returns the member index of an archive file or None, if there is none or it doesn't match the archive.
+    The index is looked up next to the archive (see find_member_index_path), unless index_path is given. The size of an encrypted archive
+    after decryption is only known once it has been decrypted, it's checked while decrypting it then.
+    """
+    index_path = index_path if index_path else find_member_index_path(archive_path)
+
+    if not index_path or not index_path.is_file():
+        return None
+
+    try:
+        index = read_member_index(index_path)
+    except (ValueError, IndexError) as error:
+        logging.warning(f"Ignoring member index {index_path}: {error}")
+        return None
+
+    if not archive_path.name.endswith(ENCRYPTED_ARCHIVE_SUFFIX) and index.compressed_size != archive_path.stat().st_size:
+        logging.warning(f"Ignoring member index {index_path}, since it has been created for an archive of "
+                        f"{index.compressed_size} bytes, but {archive_path} has {archive_path.stat().st_size} bytes")
+        return None
+
+    return index
+
+
+def get_selected_ranges(index, select):
+    """
+    Returns the ranges of the uncompressed tar archive containing the members for whose path select(path) is true.
+
+    Pax global headers aren't members for tarfile, so they are in the gaps between the ranges of the members. Since
+    they apply to all members following them, those before a selected member are included as well.
+    """
+    ranges = []
+    global_headers = []
+    last_end = 0
+
+    def add_range(offset, end):
+        if ranges and ranges[-1][1] == offset:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((offset, end))
+
+    for offset, end, path in index.tar_members:
+        if offset > last_end:
+            global_headers.append((last_end, offset))
+        last_end = end
+
+        if not select(unicodedata.normalize('NFC', path)):
+            continue
+
+        for header_offset, header_end in global_headers:
+            add_range(header_offset, header_end)
+        global_headers = []
+        add_range(offset, end)
+
+    return ranges
+
+
+@contextlib.contextmanager
+def open_archive_stream(archive_path, select=None, threads=None, index_path=None):
+    """
+    Context manager yielding the tar stream of an archive file. If select is given and the archive has
+    a member index, the stream contains only the members for whose path select(path) is true and only
+    the lzip members containing them are decompressed. Otherwise, it's the whole decompressed archive.
+
+    :raises subprocess.CalledProcessError: if decryption or decompression fail
+    :raises ValueError: if an encrypted archive turns out not to match its member index
+    """
+    index = load_member_index(archive_path, index_path) if select else None
+
+    if index is None:
+        with streaming.open_decompressed_stream(archive_path, threads) as stream:
+            yield stream
+        return
+
+    with open_selected_members_stream(archive_path, index, get_selected_ranges(index, select), threads) as stream:
+        yield stream
+
+
+@contextlib.contextmanager
+def open_selected_members_stream(archive_path, index, ranges, threads=None):
+    """
+    Context manager yielding a tar stream of the given ranges of the uncompressed archive, followed by
+    the end-of-archive blocks. Data left unread in the stream is consumed on exit.
+
+    If decompressing fails, the stream ends early and the error is raised instead of the error this causes
+    while reading the stream (e.g. tar failing on the truncated archive).
+    """
+    jobs = _get_decoding_jobs(index, ranges)
+    logging.info(f"Decompressing {sum(last - first + 1 for first, last, _ in jobs)} of {len(index.lzip_members)} "
+                 f"lzip members of {archive_path.name} using its member index")
+
+    read_fd, write_fd = os.pipe()
+
+    def write_members():
+        # on errors, the write end is closed as well, s.t. reading the stream doesn't block
+        with open(write_fd, "wb") as sink, _open_compressed_archive(archive_path, index) as feed_range:
+            for job in jobs:
+                _decode_lzip_members(archive_path, index, job, sink, feed_range, threads)
+            sink.write(b"\0" * 2 * TAR_BLOCK_BYTE_SIZE)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        writer = executor.submit(write_members)
+        stream = open(read_fd, "rb")
+
+        try:
+            yield stream
+
+            for _ in iter(lambda: stream.read(STREAM_CHUNK_BYTE_SIZE), b""):
+                pass
+        except BaseException:
+            stream.close()
+            # a broken pipe is only the consequence of the stream being closed early here
+            error = writer.exception()
+            if error and not isinstance(error, BrokenPipeError):
+                raise error
+            raise
+        finally:
+            stream.close()
+
+    # the stream has been read completely, so any error of the writer is the actual one
+    error = writer.exception()
+    if error:
+        raise error
+
+
+def _get_decoding_jobs(index, ranges):
+    """
+    Groups the ranges of the uncompressed archive by the lzip members containing them: every job is
+    a list of [first member, last member, ranges], where no members between two jobs are needed.
+    """
+    uncompressed_offsets = [uncompressed_offset for _, uncompressed_offset in index.lzip_members]
+    jobs = []
+
+    for start, end in ranges:
+        first = bisect_right(uncompressed_offsets, start) - 1
+        last = bisect_right(uncompressed_offsets, end - 1) - 1
+
+        if jobs and first <= jobs[-1][1] + 1:
+            jobs[-1][1] = max(jobs[-1][1], last)
+            jobs[-1][2].append((start, end))
+        else:
+            jobs.append([first, last, [(start, end)]])
+
+    return jobs
+
+
+def _decode_lzip_members(archive_path, index, job, sink, feed_range, threads=None):
+    """
+    Decompresses the consecutive lzip members of a job and writes the ranges of the job to sink, the
+    compressed members are written to plzip by feed_range (see _open_compressed_archive)
+    """
+    first, last, ranges = job
+    compressed_start = index.lzip_members[first][0]
+    compressed_end = index.lzip_members[last + 1][0] if last + 1 < len(index.lzip_members) else index.compressed_size
+    position = index.lzip_members[first][1]
+
+    plzip_cmd = ["plzip", "--decompress", "--stdout"]
+    if threads:
+        plzip_cmd.extend(["--threads", str(threads)])
+
+    logging.debug(f"Executing command: '{plzip_cmd}' on bytes {compressed_start} to {compressed_end} of {archive_path}")
+    plzip_process = subprocess.Popen(plzip_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        feeder = executor.submit(feed_range, compressed_start, compressed_end, plzip_process.stdin)
+
+        try:
+            next_range = 0
+            for chunk in iter(lambda: plzip_process.stdout.read(STREAM_CHUNK_BYTE_SIZE), b""):
+                chunk_end = position + len(chunk)
+
+                while next_range < len(ranges) and ranges[next_range][0] < chunk_end:
+                    start, end = ranges[next_range]
+                    sink.write(chunk[max(start, position) - position:min(end, chunk_end) - position])
+                    if end > chunk_end:
+                        break
+                    next_range += 1
+
+                position = chunk_end
+        finally:
+            plzip_process.stdout.close()
+            plzip_process.wait()
+
+    if plzip_process.returncode != 0:
+        raise subprocess.CalledProcessError(plzip_process.returncode, plzip_cmd)
+    feeder.result()
+
+
+@contextlib.contextmanager
+def _open_compressed_archive(archive_path, index):
+    """
+    Context manager yielding a function feed_range(start, end, stream), which writes a byte range of the compressed
+    archive to stream and closes it. Ranges must be requested in ascending order. Encrypted archives are decrypted
+    by gpg in a stream, which is read until its end (s.t. gpg verifies its integrity) and must have the size
+    recorded in the member index.
+    """
+    if not archive_path.name.endswith(ENCRYPTED_ARCHIVE_SUFFIX):
+        yield lambda start, end, stream: _feed_file_range(archive_path, start, end, stream)
+        return
+
+    decryption_cmd = get_stream_decryption_command() + [archive_path]
+    decryption_process = subprocess.Popen(decryption_cmd, stdout=subprocess.PIPE)
+    position = 0
+
+    def feed_decrypted_range(start, end, stream):
+        nonlocal position
+        try:
+            position += _copy_bytes(decryption_process.stdout, None, start - position)
+            position += _copy_bytes(decryption_process.stdout, stream, end - start)
+        finally:
+            stream.close()
+
+    try:
+        yield feed_decrypted_range
+        position += _copy_bytes(decryption_process.stdout, None)
+    finally:
+        decryption_process.stdout.close()
+        returncode = decryption_process.wait()
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, decryption_cmd)
+    if position != index.compressed_size:
+        raise ValueError(f"Member index of {archive_path.name} has been created for an archive of {index.compressed_size} "
+                         f"bytes, but it has {position} bytes after decryption")
+
+
+def _feed_file_range(file_path, start, end, stream):
+    try:
+        with open(file_path, "rb") as file:
+            file.seek(start)
+            _copy_bytes(file, stream, end - start)
+    finally:
+        stream.close()
+
+
+def _copy_bytes(source, sink, size=None):
+    """Copies size bytes (or all remaining ones) from source to sink, or skips them if sink is None"""
+    copied = 0
+
+    while size is None or copied < size:
+        data = source.read(STREAM_CHUNK_BYTE_SIZE if size is None else min(STREAM_CHUNK_BYTE_SIZE, size - copied))
+        if not data:
+            break
+        if sink:
+            sink.write(data)
+        copied += len(data)
+
+    return copied
+
+
+def _escape_path(path):
+    return path.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _unescape_path(path):
+    return re.sub(r"\\(.)", lambda match: "\n" if match.group(1) == "n" else match.group(1), path)
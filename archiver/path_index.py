@@ -0,0 +1,216 @@
+import hashlib
+import heapq
+from array import array
+from bisect import bisect_left
+
+from .constants import MAX_SYMLINK_HOPS, PATH_INDEX_RUN_LENGTH
+
+
+def get_path_key(path):
+    """64 bit hash of a path, collisions are negligible even for hundreds of millions of paths"""
+    return int.from_bytes(hashlib.blake2b(path.encode("utf-8", "surrogateescape"), digest_size=8).digest(), "little")
+
+
+def normalize_archive_path(path):
+    path = path.rstrip("/")
+
+    return path[2:] if path.startswith("./") else path
+
+
+class ArchivePathIndex:
+    """
+    Index of all paths in an archive for resolving symlinks without touching the filesystem.
+
+    Paths are stored as 64 bit hashes in a sorted array, i.e. with 8 bytes per path. While paths are
+    added, they are sorted in runs of bounded length which are merged in the end, s.t. the index never
+    needs more than about twice that memory. The parent directories of all paths are added implicitly.
+    Symlinks are kept with their targets, s.t. chains of links and links to directories can be followed.
+    The targets are packed in the same way (see _LinkTargets), i.e. without an object per link.
+    The keys of directories (those added as such and all parents) are kept in a second sorted array.
+
+    Add all paths with `add`, then call `freeze` before resolving links.
+    """
+    def __init__(self, run_length=PATH_INDEX_RUN_LENGTH):
+        self.keys = array("Q")
+        self.directory_keys = array("Q")
+        self.symlink_targets = _LinkTargets(run_length)
+        self.frozen = False
+        self._run_length = run_length
+        self._runs = []
+        self._directory_runs = []
+        self._last_parent = ""
+
+    def add(self, path, link_target=None, is_directory=False):
+        path = normalize_archive_path(path)
+        self._add_key(get_path_key(path), is_directory)
+
+        if link_target is not None:
+            self.symlink_targets.add(get_path_key(path), link_target)
+
+        # listings are sorted by directory, so usually the parents have been added with the previous path
+        parent = path.rpartition("/")[0]
+        while parent and parent != self._last_parent and not self._last_parent.startswith(parent + "/"):
+            self._add_key(get_path_key(parent), True)
+            parent = parent.rpartition("/")[0]
+        self._last_parent = path.rpartition("/")[0]
+
+    def _add_key(self, key, is_directory=False):
+        self.keys.append(key)
+        if is_directory:
+            self.directory_keys.append(key)
+        if len(self.keys) >= self._run_length:
+            self._sort_run()
+
+    def _sort_run(self):
+        if self.keys:
+            self._runs.append(array("Q", sorted(set(self.keys))))
+            self.keys = array("Q")
+        if self.directory_keys:
+            self._directory_runs.append(array("Q", sorted(set(self.directory_keys))))
+            self.directory_keys = array("Q")
+
+    def freeze(self):
+        """Merges the sorted runs and removes duplicates"""
+        self._sort_run()
+
+        self.keys = _merge_key_runs(self._runs)
+        self.directory_keys = _merge_key_runs(self._directory_runs)
+        self._runs = []
+        self._directory_runs = []
+        self.symlink_targets.freeze()
+        self.frozen = True
+
+    def __contains__(self, path):
+        assert self.frozen, "The index must be frozen before looking up paths"
+
+        return _contains_key(self.keys, get_path_key(normalize_archive_path(path)))
+
+    def is_directory(self, path):
+        assert self.frozen, "The index must be frozen before looking up paths"
+
+        return _contains_key(self.directory_keys, get_path_key(normalize_archive_path(path)))
+
+    def resolve_link(self, link_path, link_target, max_hops=MAX_SYMLINK_HOPS):
+        """
+        Returns the path within the archive that the symlink at link_path points to, following further links
+        on the way. Returns None if the target is absolute, leaves the archive or more than max_hops links
+        have to be followed (e.g. due to a loop).
+        """
+        resolved = normalize_archive_path(link_path).split("/")[:-1]
+        pending = list(reversed(link_target.split("/")))
+        hops = 1
+
+        if link_target.startswith("/"):
+            return None
+
+        while pending:
+            component = pending.pop()
+            if component in ("", "."):
+                continue
+            if component == "..":
+                if not resolved:
+                    return None
+                resolved.pop()
+                continue
+
+            resolved.append(component)
+            target = self.symlink_targets.get(get_path_key("/".join(resolved)))
+            if target is not None:
+                hops += 1
+                if hops > max_hops or target.startswith("/"):
+                    return None
+                resolved.pop()
+                pending.extend(reversed(target.split("/")))
+
+        return "/".join(resolved)
+
+    def link_target_exists(self, link_path, link_target):
+        resolved = self.resolve_link(link_path, link_target)
+
+        return bool(resolved) and resolved in self
+
+    def link_points_to_directory(self, link_path, link_target):
+        """
+        Whether the symlink points to a directory within the archive. An empty resolved path is the directory
+        containing the archived folder, which exists wherever the archive is extracted.
+        """
+        resolved = self.resolve_link(link_path, link_target)
+
+        return resolved is not None and (not resolved or self.is_directory(resolved))
+
+
+def _merge_key_runs(runs):
+    keys = array("Q")
+    for key in heapq.merge(*runs):
+        if not keys or keys[-1] != key:
+            keys.append(key)
+
+    return keys
+
+
+def _contains_key(keys, key):
+    position = bisect_left(keys, key)
+
+    return position < len(keys) and keys[position] == key
+
+
+class _LinkTargets:
+    """
+    Symlink targets by the key of the link path, packed into a sorted array of keys, an array of offsets
+    and a single bytes blob of all targets. Like the keys of ArchivePathIndex, they are sorted in runs of
+    bounded length while they are added, which are merged by `freeze`.
+    """
+    def __init__(self, run_length=PATH_INDEX_RUN_LENGTH):
+        self.keys = array("Q")
+        self.offsets = array("Q", [0])
+        self.targets = bytearray()
+        self._run_length = run_length
+        self._runs = []
+
+    def add(self, key, target):
+        self.keys.append(key)
+        self.targets += target.encode("utf-8", "surrogateescape")
+        self.offsets.append(len(self.targets))
+
+        if len(self.keys) >= self._run_length:
+            self._sort_run()
+
+    def _get_entry(self, position):
+        return self.keys[position], self.targets[self.offsets[position]:self.offsets[position + 1]]
+
+    def _iter_entries(self):
+        return (self._get_entry(position) for position in range(len(self.keys)))
+
+    def _sort_run(self):
+        if self.keys:
+            entries = (self._get_entry(position) for position in sorted(range(len(self.keys)), key=self.keys.__getitem__))
+            self._runs.append(_pack_link_targets(entries))
+            self.keys, self.offsets, self.targets = array("Q"), array("Q", [0]), bytearray()
+
+    def freeze(self):
+        self._sort_run()
+
+        merged = _pack_link_targets(heapq.merge(*[run._iter_entries() for run in self._runs], key=lambda entry: entry[0]))
+        self.keys, self.offsets, self.targets = merged.keys, merged.offsets, merged.targets
+        self._runs = []
+
+    def get(self, key):
+        position = bisect_left(self.keys, key)
+        if position == len(self.keys) or self.keys[position] != key:
+            return None
+
+        return self._get_entry(position)[1].decode("utf-8", "surrogateescape")
+
+
+def _pack_link_targets(entries):
+    """Packs sorted (key, encoded target) entries into _LinkTargets, keeping the first target of a key"""
+    packed = _LinkTargets()
+
+    for key, target in entries:
+        if packed.keys and packed.keys[-1] == key:
+            continue
+        packed.keys.append(key)
+        packed.targets += target
+        packed.offsets.append(len(packed.targets))
+
+    return packed
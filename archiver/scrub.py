@@ -0,0 +1,226 @@
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+from . import helpers
+from .constants import COMPRESSED_ARCHIVE_SUFFIX, ENCRYPTED_ARCHIVE_SUFFIX
+from .integrity import shallow_integrity_check
+
+# bump whenever the table layout changes
+SCHEMA_VERSION = 1
+
+
+class ScrubLedger:
+    """
+    Record of the verification results of archive parts, stored as SQLite database.
+
+    Parts are identified by the absolute path of their .tar.lz or .tar.lz.gpg file. Besides the latest
+    result of every part, the result of every single verification is kept as history.
+
+    The ledger must only be used from a single thread, verification itself may still happen in parallel.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            self.connection.execute("DROP TABLE IF EXISTS parts")
+            self.connection.execute("DROP TABLE IF EXISTS checks")
+            self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS parts (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                last_checked INTEGER,
+                last_result TEXT,
+                nr_checks INTEGER NOT NULL DEFAULT 0,
+                nr_failures INTEGER NOT NULL DEFAULT 0
+            )""")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS checks (
+                path TEXT NOT NULL,
+                checked_at INTEGER NOT NULL,
+                result TEXT NOT NULL,
+                duration REAL NOT NULL
+            )""")
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def update_parts(self, parts_with_sizes):
+        """Adds new parts and updates the size of known ones"""
+        with self.connection:
+            self.connection.executemany("""
+                INSERT INTO parts (path, size) VALUES (?, ?)
+                ON CONFLICT (path) DO UPDATE SET size = excluded.size""",
+                [(str(path), size) for path, size in parts_with_sizes])
+
+    def get_least_recently_checked(self, paths):
+        """Returns the given paths with their size, never checked parts first, then the least recently checked ones"""
+        known = {row[0]: row[1:] for row in self.connection.execute("SELECT path, size, last_checked FROM parts")}
+        entries = [(path, known[str(path)][0], known[str(path)][1]) for path in paths]
+
+        return [(path, size) for path, size, last_checked
+                in sorted(entries, key=lambda e: (e[2] is not None, e[2] or 0, str(e[0])))]
+
+    def get_missing_parts(self, root_path, existing_paths):
+        """
+        Returns the parts below root_path which have been recorded, but do not exist anymore,
+        as (path, last result), the result is "missing" if they have been missing before
+        """
+        existing = {str(path) for path in existing_paths}
+        prefix = str(root_path).rstrip(os.sep) + os.sep
+
+        rows = self.connection.execute("SELECT path, last_result FROM parts WHERE substr(path, 1, ?) = ?",
+                                       (len(prefix), prefix))
+
+        return [(path, last_result) for path, last_result in rows if path not in existing]
+
+    def remove_parts(self, paths):
+        """Removes parts and the history of their results, e.g. of archives which have been deleted on purpose"""
+        with self.connection:
+            self.connection.executemany("DELETE FROM parts WHERE path = ?", [(str(path),) for path in paths])
+            self.connection.executemany("DELETE FROM checks WHERE path = ?", [(str(path),) for path in paths])
+
+    def record(self, path, result, checked_at, duration):
+        with self.connection:
+            self.connection.execute("INSERT INTO checks VALUES (?, ?, ?, ?)", (str(path), checked_at, result, duration))
+            self.connection.execute("""
+                UPDATE parts SET last_checked = ?, last_result = ?, nr_checks = nr_checks + 1,
+                    nr_failures = nr_failures + ?
+                WHERE path = ?""", (checked_at, result, 1 if result != "ok" else 0, str(path)))
+
+
+def find_archive_parts(root_path):
+    """
+    Returns the (archive file, hash file) of every part of all archives below root_path.
+
+    Like for check, encrypted archive files are preferred over unencrypted ones in the same directory.
+    """
+    parts = []
+
+    for directory, directories, files in os.walk(root_path):
+        directories.sort()
+        encrypted = sorted(f for f in files if f.endswith(ENCRYPTED_ARCHIVE_SUFFIX))
+        archive_files = encrypted if encrypted else sorted(f for f in files if f.endswith(COMPRESSED_ARCHIVE_SUFFIX))
+
+        parts.extend((Path(directory, f).absolute(), Path(directory, f + ".md5").absolute()) for f in archive_files)
+
+    return parts
+
+
+def scrub(root_path, ledger_path, workers=1, max_bytes=None, max_seconds=None, forget_missing=False):
+    """
+    Verifies the hashes of the archive parts below root_path, least recently verified parts first.
+
+    Parts are checked concurrently by `workers` threads until all parts are verified or the byte or
+    time budget is used up. The results are recorded in the ledger at ledger_path.
+
+    Parts in the ledger which don't exist anymore are recorded as missing and reported by the first run
+    noticing it. With forget_missing, they are removed from the ledger instead.
+
+    :return: True if all verified parts are intact and no parts have gone missing
+    """
+    helpers.terminate_if_directory_nonexistent(root_path)
+    root_path = root_path.absolute()
+
+    parts = find_archive_parts(root_path)
+    hash_files = dict(parts)
+    logging.info(f"Found {len(parts)} archive parts below {root_path}")
+
+    start = time.monotonic()
+
+    with ScrubLedger(ledger_path) as ledger:
+        ledger.update_parts([(archive_file, archive_file.stat().st_size) for archive_file, _ in parts])
+
+        missing_parts = []
+        missing_before = []
+        for missing_part, last_result in ledger.get_missing_parts(root_path, hash_files.keys()):
+            (missing_before if last_result == "missing" else missing_parts).append(missing_part)
+
+        if forget_missing:
+            if missing_parts or missing_before:
+                logging.info(f"Removing {len(missing_parts) + len(missing_before)} archive parts which don't exist "
+                             f"anymore from the ledger")
+                ledger.remove_parts(missing_parts + missing_before)
+            missing_parts = []
+        else:
+            for missing_part in missing_parts:
+                logging.error(f"Archive part {missing_part} was verified before, but does not exist anymore.")
+                ledger.record(missing_part, "missing", int(time.time()), 0.0)
+            if missing_before:
+                logging.info(f"{len(missing_before)} archive parts have been missing since earlier runs, "
+                             f"use --forget-missing to remove them from the ledger")
+
+        queue = ledger.get_least_recently_checked(hash_files.keys())
+        results = {}
+        scheduled_bytes = 0
+
+        with ThreadPoolExecutor(workers) as executor:
+            pending = {}
+            while queue or pending:
+                while queue and len(pending) < workers:
+                    archive_file, size = queue[0]
+                    if max_seconds is not None and time.monotonic() - start >= max_seconds:
+                        break
+                    # the first part is always verified, s.t. parts larger than the budget are not skipped forever
+                    if max_bytes is not None and results.keys() | pending.values() and scheduled_bytes + size > max_bytes:
+                        break
+
+                    queue.pop(0)
+                    scheduled_bytes += size
+                    pending[executor.submit(_verify_part, archive_file, hash_files[archive_file])] = archive_file
+
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    archive_file = pending.pop(future)
+                    result, checked_at, duration = future.result()
+                    ledger.record(archive_file, result, checked_at, duration)
+                    results[archive_file] = result
+
+    _log_scrub_summary(results, scheduled_bytes, len(queue), time.monotonic() - start)
+
+    return not missing_parts and all(result == "ok" for result in results.values())
+
+
+def _verify_part(archive_file, hash_file):
+    checked_at = int(time.time())
+    start = time.monotonic()
+
+    if not hash_file.is_file():
+        logging.error(f"Hash file {hash_file} of archive part {archive_file} is missing.")
+        result = "missing-hash"
+    else:
+        try:
+            result = "ok" if shallow_integrity_check([(archive_file, hash_file)]) else "failed"
+        except OSError as error:
+            # e.g. the archive has been removed or became unreadable while scrubbing
+            logging.error(f"Reading archive part {archive_file} failed: {error}")
+            result = "unreadable"
+
+    return result, checked_at, time.monotonic() - start
+
+
+def _log_scrub_summary(results, nr_bytes, nr_remaining, duration):
+    # avoid division by zero for empty or very fast runs
+    duration = max(duration, 1e-6)
+    failed = sorted(str(path) for path, result in results.items() if result != "ok")
+
+    logging.info(f"Verified {len(results)} archive parts ({nr_bytes / 1000**3:.3f} GB) in {duration:.1f}s "
+                 f"({nr_bytes / 1000**2 / duration:.1f} MB/s), {nr_remaining} parts left for later runs")
+    for path in failed:
+        logging.error(f"Verification of archive part {path} failed.")
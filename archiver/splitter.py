@@ -1,41 +1,154 @@
+import bisect
+import itertools
+import logging
+import lzma
+import math
 import os
-from pathlib import Path
+import stat
 
-from . import helpers
+from .constants import COMPRESSION_SAMPLE_BYTE_SIZE, COMPRESSION_SAMPLE_CHUNK_BYTE_SIZE, \
+    COMPRESSION_SAMPLE_MIN_BYTE_SIZE, TAR_BLOCK_BYTE_SIZE
 
 
-def split_directory(directory_path, max_package_size):
+class SizeTreeNode:
+    """
+    Entry of a directory tree together with its lstat result.
+
+    The size of a directory is the sum of the sizes of all entries below it, including the
+    directories themselves, as reported by `du -sb`. Hard linked files are only counted once.
+    The number of files of a directory counts all entries below it which are not directories.
+    """
+    __slots__ = ["name", "stat", "size", "nr_files", "children"]
+
+    def __init__(self, name, stat_result):
+        self.name = name
+        self.stat = stat_result
+        self.size = stat_result.st_size
+        # symlinks to directories are not followed, hence have no children
+        self.children = {} if stat.S_ISDIR(stat_result.st_mode) else None
+        self.nr_files = 0 if self.children is not None else 1
+
+    def is_dir(self):
+        return self.children is not None
+
+    def find(self, relative_path):
+        node = self
+        for name in relative_path.parts:
+            node = node.children[name]
+        return node
+
+    def iter_files(self, path):
+        """
+        Yields (path, lstat result) of all entries below this node which are not directories.
+
+        Symlinks to directories are skipped, as helpers.get_files_in_folder does.
+        """
+        if not _is_dir(self, path):
+            yield path, self.stat
+            return
+
+        stack = [(path, self)] if self.is_dir() else []
+        while stack:
+            dir_path, node = stack.pop()
+            for child in node.children.values():
+                child_path = dir_path / child.name
+                if child.is_dir():
+                    stack.append((child_path, child))
+                elif not _is_dir(child, child_path):
+                    yield child_path, child.stat
+
+
+def build_size_tree(directory_path):
+    """Collects the lstat results of all entries below directory_path in a single scandir traversal"""
+    root = SizeTreeNode(directory_path.name, os.lstat(directory_path))
+    seen_inodes = set()
+
+    directories = []
+    stack = [(root, directory_path)]
+    while stack:
+        node, path = stack.pop()
+        directories.append(node)
+
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    child = SizeTreeNode(entry.name, entry.stat(follow_symlinks=False))
+
+                    if not child.is_dir() and child.stat.st_nlink > 1:
+                        inode = (child.stat.st_dev, child.stat.st_ino)
+                        if inode in seen_inodes:
+                            child.size = 0
+                        seen_inodes.add(inode)
+
+                    node.children[entry.name] = child
+                    if child.is_dir():
+                        stack.append((child, entry.path))
+        except OSError:
+            # skipping unreadable directories like os.walk does
+            pass
+
+    # parents are always visited before their children, so sizes can be summed up in reverse order
+    for node in reversed(directories):
+        node.size += sum(child.size for child in node.children.values())
+        node.nr_files = sum(child.nr_files for child in node.children.values())
+
+    return root
+
+
+def get_files_with_stats(size_tree, source_path, path_list):
+    """Lists the files below the given paths together with their lstat results, as gathered in the size tree"""
+    files = []
+    file_stats = []
+
+    for path in path_list:
+        node = size_tree.find(path.relative_to(source_path))
+        for file_path, file_stat in node.iter_files(path):
+            files.append(file_path)
+            file_stats.append(file_stat)
+
+    return files, file_stats
+
+
+def split_directory(directory_path, max_package_size, size_tree=None):
     # all file sizes are in bytes
+    if size_tree is None:
+        size_tree = build_size_tree(directory_path)
+
     current_archive = []
     archive_size = 0
 
-    for root, dirs, files in os.walk(directory_path):
-        # removing path for directory index will exclude directory content from os.walk
-        # See: https://docs.python.org/3/library/os.html#os.walk
-        excluded_dirs = []
+    # traversing top-down in the same order as os.walk
+    stack = [(directory_path, size_tree)]
+    while stack:
+        root, node = stack.pop()
 
-        for directory in dirs:
-            # if the folder fits into an archive package, the content of the folder not be looked at
-            dir_path = Path(root).joinpath(directory)
-            dir_size = helpers.get_size_of_path(dir_path)
+        dirs = []
+        files = []
+        for child in node.children.values():
+            child_path = root / child.name
+            if _is_dir(child, child_path):
+                dirs.append((child_path, child))
+            else:
+                files.append((child_path, child))
 
-            if archive_size + dir_size < max_package_size:
-                current_archive.append(dir_path)
-                archive_size += dir_size
+        # directories which don't fit into the current package are descended into
+        remaining_dirs = []
 
-                excluded_dirs.append(directory)
+        for dir_path, child in dirs:
+            # if the folder fits into an archive package, the content of the folder not be looked at
+            if archive_size + child.size < max_package_size:
+                current_archive.append(dir_path)
+                archive_size += child.size
+            elif child.is_dir():
+                remaining_dirs.append((dir_path, child))
+            else:
+                # symlink to a directory, which can't be descended into
+                files.append((dir_path, child))
             # for creating new package for directory that doesn't fit in current directory
             # See commit: #22d5fb7
 
-        dirs[:] = [dir_path for dir_path in dirs if dir_path not in excluded_dirs]
-
-        for file in files:
-            file_path = Path(root).joinpath(file)
-            file_size = 0
-
-            # Handle broken symlinks by not calculating file sizes for them
-            if file_path.exists():
-                file_size = file_path.stat().st_size
+        for file_path, child in files:
+            file_size = _get_file_size(child, file_path)
 
             if archive_size + file_size < max_package_size:
                 current_archive.append(file_path)
@@ -49,4 +162,233 @@ def split_directory(directory_path, max_package_size):
                 raise ValueError(f"File {file_path.as_posix()} with {file_size} bytes "
                                  f"is larger than the maximum package size of {max_package_size} bytes")
 
+        stack.extend(reversed(remaining_dirs))
+
     yield current_archive
+
+
+def _is_dir(node, path):
+    # like os.walk, symlinks to directories are listed as directories
+    if stat.S_ISLNK(node.stat.st_mode):
+        return os.path.isdir(path)
+
+    return node.is_dir()
+
+
+def _get_file_size(node, path):
+    if not stat.S_ISLNK(node.stat.st_mode):
+        return node.stat.st_size
+
+    # size of the target, broken symlinks are ignored
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+def split_directory_into_parts(directory_path, max_package_size, max_files=None, balanced=False, size_tree=None,
+                               compression=None):
+    """
+    Splits the directory into parts, using the planner if a file limit, balancing or a compressed part size
+    (i.e. a compression level) is requested and the greedy split_directory otherwise.
+    """
+    if max_files or balanced or compression is not None:
+        return plan_parts(directory_path, max_package_size, max_files, balanced, size_tree, compression)
+
+    return list(split_directory(directory_path, max_package_size, size_tree))
+
+
+def plan_parts(directory_path, max_package_size, max_files=None, balanced=True, size_tree=None, compression=None):
+    """
+    Splits the directory into as few parts as possible, s.t. every part has at most max_package_size
+    bytes and max_files files. If a compression level is given, max_package_size is the maximum
+    estimated size of the compressed part, see CompressedSizeEstimator.
+
+    The directory is first cut into units: directories which fit into a part as a whole, otherwise
+    single files. Units keep the order of split_directory, s.t. directories stay contiguous. They are
+    then packed into the minimal number of parts. With `balanced`, the largest part is made as small as
+    possible for that number of parts, s.t. parallel stages processing the parts finish at the same time.
+
+    :return: list of parts, where each part is a list of paths
+    """
+    if size_tree is None:
+        size_tree = build_size_tree(directory_path)
+
+    max_files = max_files if max_files else float("inf")
+    estimator = CompressedSizeEstimator(directory_path, size_tree, compression) if compression is not None else None
+
+    units = list(_get_units(directory_path, size_tree, max_package_size, max_files, estimator))
+    if not units:
+        return [[]]
+
+    prefix_bytes = list(itertools.accumulate((unit_size for _, unit_size, _ in units), initial=0))
+    prefix_files = list(itertools.accumulate((unit_files for _, _, unit_files in units), initial=0))
+
+    boundaries = _pack_units(prefix_bytes, prefix_files, max_package_size, max_files)
+
+    if balanced and len(boundaries) > 2:
+        nr_parts = len(boundaries) - 1
+
+        # binary search for the smallest maximum part size which doesn't need more parts
+        lower = max(max(unit_size for _, unit_size, _ in units), -(-prefix_bytes[-1] // nr_parts))
+        upper = max_package_size
+        while lower < upper:
+            middle = (lower + upper) // 2
+            if len(_pack_units(prefix_bytes, prefix_files, middle, max_files)) - 1 <= nr_parts:
+                upper = middle
+            else:
+                lower = middle + 1
+
+        boundaries = _pack_units(prefix_bytes, prefix_files, lower, max_files)
+
+    parts = [[path for path, _, _ in units[start:end]] for start, end in zip(boundaries, boundaries[1:])]
+
+    _log_plan_summary(prefix_bytes, prefix_files, boundaries, estimated=estimator is not None)
+
+    return parts
+
+
+def _get_units(directory_path, size_tree, max_package_size, max_files, estimator=None):
+    stack = [(directory_path, size_tree)]
+    while stack:
+        root, node = stack.pop()
+
+        dirs = []
+        files = []
+        for child in node.children.values():
+            child_path = root / child.name
+            if child.is_dir():
+                dirs.append((child_path, child))
+            else:
+                files.append((child_path, child))
+
+        remaining_dirs = []
+        for dir_path, child in dirs:
+            dir_size = estimator.get_directory_size(child) if estimator else child.size
+
+            if dir_size <= max_package_size and child.nr_files <= max_files:
+                yield dir_path, dir_size, child.nr_files
+            else:
+                remaining_dirs.append((dir_path, child))
+
+        for file_path, child in files:
+            file_size = estimator.get_file_size(node, child, file_path) if estimator else _get_file_size(child, file_path)
+
+            if file_size > max_package_size:
+                raise ValueError(f"File {file_path.as_posix()} with {file_size} bytes "
+                                 f"is larger than the maximum package size of {max_package_size} bytes")
+
+            yield file_path, file_size, 1
+
+        stack.extend(reversed(remaining_dirs))
+
+
+def _pack_units(prefix_bytes, prefix_files, max_bytes, max_files):
+    """Greedily packs consecutive units into parts, returns the unit indices where parts start (and the end)"""
+    boundaries = [0]
+    nr_units = len(prefix_bytes) - 1
+
+    while boundaries[-1] < nr_units:
+        start = boundaries[-1]
+        end = min(bisect.bisect_right(prefix_bytes, prefix_bytes[start] + max_bytes),
+                  bisect.bisect_right(prefix_files, prefix_files[start] + max_files)) - 1
+        # a part holds at least one unit
+        boundaries.append(max(end, start + 1))
+
+    return boundaries
+
+
+def _log_plan_summary(prefix_bytes, prefix_files, boundaries, estimated=False):
+    part_bytes = [prefix_bytes[end] - prefix_bytes[start] for start, end in zip(boundaries, boundaries[1:])]
+    part_files = [prefix_files[end] - prefix_files[start] for start, end in zip(boundaries, boundaries[1:])]
+
+    mean_bytes = prefix_bytes[-1] / len(part_bytes)
+    imbalance = max(part_bytes) / mean_bytes if mean_bytes else 1.0
+
+    unit = "estimated compressed bytes" if estimated else "bytes"
+
+    logging.info(f"Split plan: {len(part_bytes)} parts, {prefix_bytes[-1]} {unit} and {prefix_files[-1]} files in total, "
+                 f"imbalance (largest / mean part size) of {imbalance:.3f}")
+    for index, (nr_bytes, nr_files) in enumerate(zip(part_bytes, part_files)):
+        logging.info(f"Part {index + 1}: {nr_bytes} {unit} ({nr_bytes / 1024**3:.3f}GB), {nr_files} files")
+
+
+class CompressedSizeEstimator:
+    """
+    Estimates the size of directories and files of a size tree after tar and compression with lzip.
+
+    The compression ratio of a directory is measured by compressing samples of the files directly
+    in it using LZMA, the algorithm used by lzip, at the same compression level. Directories with
+    too little data of their own inherit the ratio of their parent. Tar headers are accounted for.
+    """
+    def __init__(self, directory_path, size_tree, compression):
+        self.ratios = {}
+        self.sizes = {}
+
+        nr_sampled = 0
+        directories = []
+        # path, node, ratio of the parent, whether any ancestor was sampled
+        stack = [(directory_path, size_tree, 1.0, False)]
+        while stack:
+            path, node, ratio, ancestor_sampled = stack.pop()
+            directories.append((path, node))
+
+            files = [(path / child.name, child) for child in node.children.values()
+                     if stat.S_ISREG(child.stat.st_mode)]
+            direct_bytes = sum(child.stat.st_size for _, child in files)
+
+            sampled = False
+            if direct_bytes >= COMPRESSION_SAMPLE_MIN_BYTE_SIZE or (direct_bytes and not ancestor_sampled):
+                ratio = _sample_compression_ratio([file_path for file_path, _ in files], compression)
+                sampled = True
+                nr_sampled += 1
+
+            self.ratios[node] = ratio
+            stack.extend((path / child.name, child, ratio, ancestor_sampled or sampled)
+                         for child in node.children.values() if child.is_dir())
+
+        # children are summed up before their parents
+        for path, node in reversed(directories):
+            self.sizes[node] = math.ceil(self.ratios[node] * TAR_BLOCK_BYTE_SIZE) + sum(
+                self.sizes[child] if child.is_dir() else self.get_file_size(node, child, path / child.name)
+                for child in node.children.values())
+
+        logging.info(f"Estimated compressed size of {self.sizes[size_tree]} bytes for {size_tree.size} bytes, "
+                     f"sampled {nr_sampled} directories at compression level {compression}")
+
+    def get_directory_size(self, node):
+        return self.sizes[node]
+
+    def get_file_size(self, parent_node, node, path):
+        # content padded to full blocks plus header
+        tar_size = math.ceil(_get_file_size(node, path) / TAR_BLOCK_BYTE_SIZE + 1) * TAR_BLOCK_BYTE_SIZE
+        return math.ceil(self.ratios[parent_node] * tar_size)
+
+
+def _sample_compression_ratio(file_paths, compression):
+    """Compression ratio of chunks from the beginning and middle of the given files"""
+    compressor = lzma.LZMACompressor(format=lzma.FORMAT_ALONE, preset=compression)
+    sampled_bytes = 0
+    compressed_bytes = 0
+
+    for file_path in file_paths:
+        try:
+            with open(file_path, "rb") as file:
+                file_size = os.fstat(file.fileno()).st_size
+                offsets = [0, file_size // 2] if file_size > 2 * COMPRESSION_SAMPLE_CHUNK_BYTE_SIZE else [0]
+
+                for offset in offsets:
+                    file.seek(offset)
+                    chunk = file.read(COMPRESSION_SAMPLE_CHUNK_BYTE_SIZE)
+                    compressed_bytes += len(compressor.compress(chunk))
+                    sampled_bytes += len(chunk)
+        except OSError:
+            # unreadable files are reported later on
+            continue
+
+        if sampled_bytes >= COMPRESSION_SAMPLE_BYTE_SIZE:
+            break
+
+    compressed_bytes += len(compressor.flush())
+
+    return compressed_bytes / sampled_bytes if sampled_bytes else 1.0
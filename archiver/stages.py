@@ -0,0 +1,57 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+IO = "io"
+CPU = "cpu"
+
+
+def run_stages(items, stages, worker_limits):
+    """
+    Runs a sequence of stages for every item, s.t. different items can be in different stages at the
+    same time, e.g. part N is compressed while part N+1 is archived and part N-1 is encrypted.
+
+    Every stage is bound to a resource and at most `worker_limits[resource]` stages bound to the same
+    resource run at the same time, which lets I/O bound and CPU bound stages overlap. Items enter the
+    first stage in the given order. At most sum(worker_limits.values()) items are in progress at once,
+    which bounds the number of intermediate files. Once a stage fails, no further stages are started.
+
+    :param items: items to process, e.g. part names
+    :param stages: list of (name, function, resource), every function is called with a single item
+    :param worker_limits: maximum number of concurrently running stages per resource
+    """
+    semaphores = {resource: threading.BoundedSemaphore(limit) for resource, limit in worker_limits.items()}
+    busy_seconds = {name: 0.0 for name, _, _ in stages}
+    busy_lock = threading.Lock()
+    failed = threading.Event()
+
+    def run_item(item):
+        for name, function, resource in stages:
+            with semaphores[resource]:
+                if failed.is_set():
+                    return
+
+                stage_start = time.monotonic()
+                try:
+                    function(item)
+                except BaseException:
+                    failed.set()
+                    raise
+
+                with busy_lock:
+                    busy_seconds[name] += time.monotonic() - stage_start
+
+    start = time.monotonic()
+
+    with ThreadPoolExecutor(sum(worker_limits.values())) as executor:
+        futures = [executor.submit(run_item, item) for item in items]
+        for future in futures:
+            future.result()
+
+    _log_stage_times(len(items), busy_seconds, time.monotonic() - start)
+
+
+def _log_stage_times(nr_items, busy_seconds, duration):
+    stage_times = ", ".join(f"{name} {seconds:.1f}s" for name, seconds in busy_seconds.items())
+    logging.info(f"Processed {nr_items} parts in {duration:.1f}s, summed up time per stage: {stage_times}")
@@ -0,0 +1,159 @@
+import contextlib
+import logging
+import subprocess
+import tarfile
+import unicodedata
+
+from .constants import READ_CHUNK_BYTE_SIZE, STREAM_CHUNK_BYTE_SIZE, DEFAULT_HASH_ALGORITHM, ENCRYPTED_ARCHIVE_SUFFIX
+from .encryption import get_stream_decryption_command
+from .hashing import get_hasher
+
+
+class HashingReader:
+    """
+    Read-only file-like wrapper around a binary stream.
+
+    All data passing through is hashed and copied to the given sinks, s.t. a stream
+    can be parsed (e.g. by tarfile) while it is written to disk at the same time.
+    With algorithm None, the data is only copied.
+    """
+    def __init__(self, stream, sinks=None, algorithm=DEFAULT_HASH_ALGORITHM):
+        self.stream = stream
+        self.sinks = sinks if sinks else []
+        self.hasher = get_hasher(algorithm) if algorithm else None
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+
+        if data:
+            if self.hasher:
+                self.hasher.update(data)
+            for sink in self.sinks:
+                sink.write(data)
+            self.bytes_read += len(data)
+
+        return data
+
+    def drain(self):
+        """Consume the remainder of the stream, e.g. the end-of-archive blocks of a tar stream"""
+        for _ in iter(lambda: self.read(STREAM_CHUNK_BYTE_SIZE), b""):
+            pass
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+def hash_tar_members(fileobj, algorithm=DEFAULT_HASH_ALGORITHM, known_hashes=None, select=None, on_member=None,
+                     is_directory_link=None):
+    """
+    Parses a tar stream and yields (path, hash, tarinfo) for every file and symlink.
+
+    Hashes follow the same rules as helpers.hash_files_and_check_symlinks: file content for
+    regular files, the link target for symlinks. Hard links get the hash of the file they point to.
+    Other member types (directories, FIFOs etc) are skipped.
+
+    Hash listings created from the filesystem don't contain symlinks to directories, since os.walk lists them
+    as directories (see helpers.get_files_in_folder). To follow the same rule, is_directory_link(path, tarinfo)
+    tells which symlinks point to directories, these are skipped as well. The path is normalized to NFC, the name
+    and link target of the tarinfo are given as in the archive.
+
+    Regular files in known_hashes (by path) are not hashed again, their hash is taken from there.
+    If select is given, only members for whose path select(path) is true are hashed and yielded.
+    Hard links to a file that hasn't been selected get the hash None then.
+    If on_member is given, it is called with the tarinfo of every member, including those not yielded.
+    """
+    hashes_by_name = {}
+    known_hashes = known_hashes if known_hashes else {}
+
+    with tarfile.open(fileobj=fileobj, mode="r|", bufsize=STREAM_CHUNK_BYTE_SIZE) as tar:
+        for member in iter_tar_members(tar):
+            if on_member:
+                on_member(member)
+
+            path = unicodedata.normalize('NFC', member.name)
+            if select and not select(path):
+                continue
+
+            if member.isreg() and path in known_hashes:
+                # the content is skipped by the tar stream
+                member_hash = known_hashes[path]
+            elif member.isreg():
+                hasher = get_hasher(algorithm)
+                member_file = tar.extractfile(member)
+                for chunk in iter(lambda: member_file.read(READ_CHUNK_BYTE_SIZE), b""):
+                    hasher.update(chunk)
+                member_hash = hasher.hexdigest()
+            elif member.issym():
+                if is_directory_link and is_directory_link(path, member):
+                    continue
+                hasher = get_hasher(algorithm)
+                hasher.update(member.linkname.encode("utf-8"))
+                member_hash = hasher.hexdigest()
+            elif member.islnk():
+                member_hash = hashes_by_name[member.linkname] if not select else hashes_by_name.get(member.linkname)
+            else:
+                continue
+
+            hashes_by_name[member.name] = member_hash
+            yield path, member_hash, member
+
+
+def iter_tar_members(tar):
+    """
+    Yields the members of an open tarfile like iterating it, but doesn't keep them in its list of members,
+    which would grow with every member of archives with millions of files
+    """
+    while True:
+        member = tar.next()
+        if member is None:
+            return
+
+        yield member
+        tar.members.clear()
+
+
+@contextlib.contextmanager
+def open_decompressed_stream(archive_path, threads=None):
+    """
+    Context manager yielding the tar stream of a .tar.lz or .tar.lz.gpg archive.
+
+    The archive is decrypted by gpg (if encrypted) and decompressed by plzip through pipes,
+    nothing is written to disk. Data left unread in the stream is consumed on exit.
+
+    :raises subprocess.CalledProcessError: if gpg or plzip fail, e.g. due to a corrupted archive
+    """
+    plzip_cmd = ["plzip", "--decompress", "--stdout"]
+    if threads:
+        plzip_cmd.extend(["--threads", str(threads)])
+
+    processes = []
+    if archive_path.name.endswith(ENCRYPTED_ARCHIVE_SUFFIX):
+        decryption_cmd = get_stream_decryption_command() + [archive_path]
+        decryption_process = subprocess.Popen(decryption_cmd, stdout=subprocess.PIPE)
+        processes.append((decryption_process, decryption_cmd))
+
+        plzip_process = subprocess.Popen(plzip_cmd, stdin=decryption_process.stdout, stdout=subprocess.PIPE)
+        # plzip holds the only reading end now, s.t. gpg gets SIGPIPE if plzip exits early
+        decryption_process.stdout.close()
+    else:
+        plzip_cmd.append(archive_path)
+        plzip_process = subprocess.Popen(plzip_cmd, stdout=subprocess.PIPE)
+    processes.append((plzip_process, plzip_cmd))
+
+    logging.debug(f"Executing pipeline: '{' | '.join(' '.join(str(e) for e in cmd) for _, cmd in processes)}'")
+
+    try:
+        yield plzip_process.stdout
+
+        # e.g. the zero blocks after the end-of-archive marker of tar
+        for _ in iter(lambda: plzip_process.stdout.read(STREAM_CHUNK_BYTE_SIZE), b""):
+            pass
+    finally:
+        plzip_process.stdout.close()
+
+        returncodes = [(process.wait(), cmd) for process, cmd in processes]
+
+    for returncode, cmd in returncodes:
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
@@ -20,13 +20,20 @@ SPLIT_ENCRYPTED_LISTINGS = [".part1.tar.lst", ".part1.tar.lz.md5", ".part1.md5",
 HASH_SUFFIX = [".md5"]
 SPLIT_HASH_SUFFIX = [".part1.md5", ".part2.md5"]
 
+MEMBER_INDEX = ".tar.lz.idx"
+# without the .tar.lz, the member index is named after the encrypted archive
+ENCRYPTED_MEMBER_INDEX = ".tar.lz.gpg.idx"
+
 CONTENT_LISTING = [".tar.lst"]
 SPLIT_CONTENT_LISTING = [".part1.tar.lst", ".part2.tar.lst"]
 
 
-def assert_successful_archive_creation(destination_path, archive_path, folder_name, split=None, encrypted=None, unencrypted=None):
+def assert_successful_archive_creation(destination_path, archive_path, folder_name, split=None, encrypted=None, unencrypted=None, member_index=False):
     # Specify which files are expected in the listing
     expected_listing_suffixes = get_required_listing_suffixes(encrypted, unencrypted)
+    if member_index:
+        expected_listing_suffixes = expected_listing_suffixes + [ENCRYPTED_MEMBER_INDEX if encrypted == "all"
+                                                                 else MEMBER_INDEX]
     # Will return unmodified given list if split is None
     expected_listing = add_split_prefix_to_file_suffixes(expected_listing_suffixes, split)
 
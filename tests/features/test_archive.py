@@ -1,9 +1,12 @@
+import os
+import shutil
 import tarfile
+import time
 
 import pytest
 
 import archiver
-from archiver import integrity
+from archiver import integrity, member_index
 from archiver.archive import create_archive
 from tests import helpers
 from tests.helpers import run_archiver_tool, generate_splitting_directory
@@ -19,7 +22,7 @@ def test_create_archive(tmp_path):
     destination_path = tmp_path / "name-of-destination-folder"
 
     create_archive(folder_path, destination_path, compression=5)
-    assert_successful_archive_creation(destination_path, archive_path, folder_name, unencrypted="all")
+    assert_successful_archive_creation(destination_path, archive_path, folder_name, unencrypted="all", member_index=True)
 
 
 @pytest.mark.parametrize("workers", [2, 1])
@@ -32,7 +35,226 @@ def test_create_archive_split(tmp_path, generate_splitting_directory, workers):
     destination_path = tmp_path / "name-of-destination-folder"
 
     create_archive(source_path, destination_path, compression=6, splitting=max_size, threads=workers)
-    assert_successful_archive_creation(destination_path, archive_path, folder_name, split=2, unencrypted="all")
+    assert_successful_archive_creation(destination_path, archive_path, folder_name, split=2, unencrypted="all", member_index=True)
+
+
+@pytest.mark.parametrize("single_pass", [False, True])
+def test_create_archive_split_balanced(tmp_path, generate_splitting_directory, caplog, single_pass):
+    source_path = generate_splitting_directory
+    destination_path = tmp_path / "name-of-destination-folder"
+
+    create_archive(source_path, destination_path, compression=1, splitting=1000 * 1000 * 50, threads=2,
+                   single_pass=single_pass, max_files_per_part=3, balanced_parts=True)
+
+    assert "Split plan: 3 parts" in caplog.text
+    assert (destination_path / "large-test-folder.parts.txt").read_text() == "3\n"
+    assert integrity.check_integrity(destination_path, deep_flag=True, threads=2)
+
+
+@pytest.mark.parametrize("io_workers,expected_io_workers", [(None, 2), (1, 1)])
+def test_create_archive_split_io_workers(tmp_path, generate_splitting_directory, caplog, io_workers,
+                                         expected_io_workers):
+    source_path = generate_splitting_directory
+    destination_path = tmp_path / "name-of-destination-folder"
+
+    create_archive(source_path, destination_path, compression=1, splitting=1000 * 1000 * 50, threads=2,
+                   io_workers=io_workers)
+
+    # by default, as many tar archives are created at the same time as there are threads
+    assert f"Processing 2 parts in stages tar, compress, hash using 1 CPU workers and {expected_io_workers} I/O workers." \
+        in caplog.messages
+    assert integrity.check_integrity(destination_path, deep_flag=True, threads=2)
+
+
+def test_create_archive_split_compressed_size(tmp_path, generate_splitting_directory, caplog):
+    source_path = generate_splitting_directory
+    destination_path = tmp_path / "name-of-destination-folder"
+
+    # the raw size of ~80MB would require several parts, but the test files consist of zeros only
+    create_archive(source_path, destination_path, compression=1, splitting=1000 * 1000 * 10, threads=2,
+                   split_compression=1)
+
+    assert "Split plan: 1 parts" in caplog.text
+    assert (destination_path / "large-test-folder.parts.txt").read_text() == "1\n"
+    assert integrity.check_integrity(destination_path, deep_flag=True, threads=2)
+
+
+def test_create_archive_with_chunk_hashes(tmp_path, generate_splitting_directory, caplog):
+    source_path = generate_splitting_directory
+    destination_path = tmp_path / "name-of-destination-folder"
+
+    create_archive(source_path, destination_path, compression=1, splitting=1000 * 1000 * 50, threads=2,
+                   chunk_hashes=True)
+
+    for part in [1, 2]:
+        assert (destination_path / f"large-test-folder.part{part}.tar.lz.chunks").is_file()
+    assert integrity.check_integrity(destination_path, threads=2)
+    assert "Verifying chunk hashes of " + str(destination_path / "large-test-folder.part2.tar.lz") + " using 2 threads" \
+        in caplog.messages
+
+    with open(destination_path / "large-test-folder.part2.tar.lz", "r+b") as archive_file:
+        archive_file.seek(100)
+        archive_file.write(b"corrupted")
+
+    assert not integrity.check_integrity(destination_path, threads=2)
+    assert any(message.startswith("Chunk hashes of file large-test-folder.part2.tar.lz have changed in byte ranges 0-")
+               for message in caplog.messages)
+
+
+@pytest.mark.parametrize("splitting,workers", [(None, 1), (1000 * 1000 * 50, 2)])
+def test_create_archive_single_pass(tmp_path, generate_splitting_directory, splitting, workers):
+    folder_name = "large-test-folder"
+    source_path = generate_splitting_directory
+
+    archive_path = helpers.get_directory_with_name("split-archive-ressources")
+    destination_path = tmp_path / "name-of-destination-folder"
+
+    create_archive(source_path, destination_path, compression=6, splitting=splitting, threads=workers, single_pass=True)
+
+    if splitting:
+        assert_successful_archive_creation(destination_path, archive_path, folder_name, split=2, unencrypted="all", member_index=True)
+    else:
+        two_pass_destination_path = tmp_path / "two-pass-destination-folder"
+        create_archive(source_path, two_pass_destination_path, compression=6, threads=workers)
+        # the hash listing and the listing are the same as if the files were hashed from the filesystem
+        for file_name in [f"{folder_name}.md5", f"{folder_name}.tar.lst"]:
+            assert (destination_path / file_name).read_bytes() == (two_pass_destination_path / file_name).read_bytes()
+    assert integrity.check_integrity(destination_path, deep_flag=True, threads=workers)
+
+
+def test_create_symlink_archive_single_pass(tmp_path, caplog):
+    folder_name = "symlink-folder"
+
+    folder_path = helpers.get_directory_with_name(folder_name)
+    archive_path = helpers.get_directory_with_name("symlink-archive")
+    destination_path = tmp_path / "name-of-destination-folder"
+
+    create_archive(folder_path, destination_path, compression=5, single_pass=True)
+    assert_successful_archive_creation(destination_path, archive_path, folder_name, unencrypted="all", member_index=True)
+
+    assert "Broken symlink symlink-folder/invalid_link found pointing to a non-existing file " in caplog.text
+
+
+@pytest.mark.parametrize("single_pass", [False, True])
+def test_create_archive_records_tar_members(tmp_path, monkeypatch, single_pass):
+    folder_name = "test-folder"
+    folder_path = helpers.get_directory_with_name(folder_name)
+    archive_path = helpers.get_directory_with_name("normal-archive")
+    destination_path = tmp_path / "name-of-destination-folder"
+
+    # the ranges of the tar members are recorded while the tar archive is hashed, it isn't read again for the index
+    def get_tar_members(tar_path):
+        raise AssertionError(f"{tar_path} read again")
+
+    monkeypatch.setattr(member_index, "get_tar_members", get_tar_members)
+    create_archive(folder_path, destination_path, compression=5, single_pass=single_pass)
+
+    assert_successful_archive_creation(destination_path, archive_path, folder_name, unencrypted="all", member_index=True)
+    assert [path for _, _, path in member_index.load_member_index(destination_path / f"{folder_name}.tar.lz").tar_members]
+
+
+@pytest.mark.parametrize("splitting", [None, 1000 ** 5])
+def test_create_archive_modes_directory_symlink(tmp_path, splitting):
+    source_path = tmp_path / "source"
+    (source_path / "folder").mkdir(parents=True)
+    (source_path / "folder" / "file.txt").write_text("content")
+    (source_path / "link-to-folder").symlink_to("folder")
+    (source_path / "link-to-file").symlink_to("folder/file.txt")
+    # decomposed (NFD), as created on macOS, whereas the paths of the hash listings are normalized to NFC
+    (source_path / "u\u0308mlaut" / "sub-folder").mkdir(parents=True)
+    (source_path / "u\u0308mlaut" / "link-to-sub-folder").symlink_to("sub-folder")
+
+    hash_listings = {}
+    for mode in ["default", "single_pass", "pipeline"]:
+        destination_path = tmp_path / mode
+        create_archive(source_path, destination_path, compression=1, splitting=splitting,
+                       single_pass=(mode == "single_pass"), pipeline=(mode == "pipeline"))
+        hash_listings[mode] = sorted(line for path in destination_path.glob("*.md5") if ".tar" not in path.name
+                                     for line in path.read_text().splitlines())
+
+    # hashes computed from the tar stream leave out symlinks to directories, like those from the filesystem
+    assert hash_listings["single_pass"] == hash_listings["default"]
+    assert hash_listings["pipeline"] == hash_listings["default"]
+    assert any(line.endswith(" source/link-to-file") for line in hash_listings["default"])
+    assert not any("link-to-folder" in line or "link-to-sub-folder" in line for line in hash_listings["default"])
+
+
+def test_create_archive_with_hash_cache(tmp_path, caplog):
+    folder_name = "test-folder"
+
+    source_path = tmp_path / folder_name
+    shutil.copytree(helpers.get_directory_with_name(folder_name), source_path, symlinks=True)
+    # files modified just now are not cached
+    one_hour_ago = time.time() - 3600
+    for path in source_path.rglob("*"):
+        os.utime(path, (one_hour_ago, one_hour_ago), follow_symlinks=False)
+
+    archive_path = helpers.get_directory_with_name("normal-archive")
+    hash_cache_path = tmp_path / "hash-cache.sqlite"
+
+    for run in ["first", "second"]:
+        destination_path = tmp_path / f"{run}-destination-folder"
+        create_archive(source_path, destination_path, compression=5, hash_cache_path=hash_cache_path)
+        assert_successful_archive_creation(destination_path, archive_path, folder_name, unencrypted="all", member_index=True)
+
+    assert "Hash cache: 0 hits, 2 misses" in caplog.text
+    assert "Hash cache: 2 hits, 0 misses" in caplog.text
+
+
+@pytest.mark.parametrize("hash_algorithm", ["sha256", "blake2b"])
+@pytest.mark.parametrize("mode", ["default", "single_pass", "pipeline"])
+def test_create_archive_with_hash_algorithm(tmp_path, generate_splitting_directory, hash_algorithm, mode):
+    source_path = generate_splitting_directory
+    destination_path = tmp_path / "name-of-destination-folder"
+
+    create_archive(source_path, destination_path, compression=1, splitting=1000 * 1000 * 50, threads=2,
+                   single_pass=(mode == "single_pass"), pipeline=(mode == "pipeline"), hash_algorithm=hash_algorithm)
+
+    for hash_file in destination_path.glob("*.md5"):
+        assert archiver.helpers.get_hash_algorithm_from_file(hash_file) == hash_algorithm
+
+    assert integrity.check_integrity(destination_path, deep_flag=False, threads=2)
+    assert integrity.check_integrity(destination_path, deep_flag=True, threads=2)
+
+
+@pytest.mark.parametrize("encrypted", [False, True])
+def test_create_archive_pipeline(tmp_path, setup_gpg, encrypted):
+    folder_name = "test-folder"
+
+    folder_path = helpers.get_directory_with_name(folder_name)
+    archive_path = helpers.get_directory_with_name("encrypted-archive" if encrypted else "normal-archive")
+    destination_path = tmp_path / "name-of-destination-folder"
+    keys = get_public_key_paths() if encrypted else None
+
+    create_archive(folder_path, destination_path, encryption_keys=keys, compression=5, remove_unencrypted=True,
+                   pipeline=True)
+
+    if encrypted:
+        assert_successful_archive_creation(destination_path, archive_path, folder_name, encrypted="all", member_index=True)
+    else:
+        assert_successful_archive_creation(destination_path, archive_path, folder_name, unencrypted="all", member_index=True)
+    assert integrity.check_integrity(destination_path, deep_flag=True, threads=1)
+
+
+@pytest.mark.parametrize("encrypted", [False, True])
+def test_create_archive_split_pipeline(tmp_path, generate_splitting_directory, setup_gpg, caplog, encrypted):
+    max_size = 1000 * 1000 * 50
+    folder_name = "large-test-folder"
+    source_path = generate_splitting_directory
+
+    archive_path = helpers.get_directory_with_name("split-archive-ressources")
+    destination_path = tmp_path / "name-of-destination-folder"
+    keys = get_public_key_paths() if encrypted else None
+
+    create_archive(source_path, destination_path, encryption_keys=keys, compression=6, remove_unencrypted=True,
+                   splitting=max_size, threads=8, pipeline=True)
+
+    assert "Creating 2 parts, 2 at a time" in caplog.messages
+    if encrypted:
+        assert_successful_archive_creation(destination_path, archive_path, folder_name, split=2, encrypted="all", member_index=True)
+    else:
+        assert_successful_archive_creation(destination_path, archive_path, folder_name, split=2, unencrypted="all", member_index=True)
+    assert integrity.check_integrity(destination_path, deep_flag=True, threads=2)
 
 
 def test_create_archive_split_granular(tmp_path, generate_splitting_directory):
@@ -56,7 +278,7 @@ def test_create_archive_split_granular(tmp_path, generate_splitting_directory):
                        destination_path])
 
     assert_successful_archive_creation(destination_path, archive_path,
-                                       folder_name, split=2, unencrypted="all")
+                                       folder_name, split=2, unencrypted="all", member_index=True)
 
     assert run_archiver_tool(['check', '--deep', destination_path]).returncode == 0
 
@@ -69,7 +291,7 @@ def test_create_symlink_archive(tmp_path, caplog):
     destination_path = tmp_path / "name-of-destination-folder"
 
     create_archive(folder_path, destination_path, compression=5)
-    assert_successful_archive_creation(destination_path, archive_path, folder_name, unencrypted="all")
+    assert_successful_archive_creation(destination_path, archive_path, folder_name, unencrypted="all", member_index=True)
 
     assert "Broken symlink symlink-folder/invalid_link found pointing to a non-existing file " in caplog.text
     assert "Symlink with outside target symlink-folder/invalid_link_abs found pointing to /not/existing which is outside the archiving directory" in caplog.text
@@ -96,7 +318,7 @@ def test_create_encrypted_archive(tmp_path):
     keys = get_public_key_paths()
 
     create_archive(folder_path, destination_path, encryption_keys=keys, compression=5, remove_unencrypted=True)
-    assert_successful_archive_creation(destination_path, archive_path, folder_name, encrypted="all")
+    assert_successful_archive_creation(destination_path, archive_path, folder_name, encrypted="all", member_index=True)
 
 
 def test_create_archive_split_encrypted(tmp_path, generate_splitting_directory):
@@ -109,11 +331,11 @@ def test_create_archive_split_encrypted(tmp_path, generate_splitting_directory):
     keys = get_public_key_paths()
 
     create_archive(source_path, destination_path, encryption_keys=keys, compression=6, remove_unencrypted=True, splitting=max_size)
-    assert_successful_archive_creation(destination_path, archive_path, folder_name, split=2, encrypted="all")
+    assert_successful_archive_creation(destination_path, archive_path, folder_name, split=2, encrypted="all", member_index=True)
 
 
-@pytest.mark.parametrize('splitting_param', [None, 1000**5])
-def test_split_archive_with_exotic_filenames(tmp_path, splitting_param):
+@pytest.mark.parametrize('splitting_param,single_pass', [(None, False), (1000**5, False), (None, True), (1000**5, True)])
+def test_split_archive_with_exotic_filenames(tmp_path, splitting_param, single_pass):
     # file name with trailing \r
     back_slash_r = ('back_slash_r'.encode('UTF-8') + bytearray.fromhex('0D')).decode('utf-8')
 
@@ -136,7 +358,7 @@ def test_split_archive_with_exotic_filenames(tmp_path, splitting_param):
 
     dest = tmp_path/'myarchive'
     create_archive(file_dir, dest, encryption_keys=None,
-                   compression=6, remove_unencrypted=True, splitting=splitting_param)
+                   compression=6, remove_unencrypted=True, splitting=splitting_param, single_pass=single_pass)
 
     assert integrity.check_integrity(dest, deep_flag=True, threads=1)
 
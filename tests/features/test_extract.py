@@ -1,11 +1,20 @@
 import filecmp
 import os
+import shutil
+import subprocess
 from pathlib import Path
 
 import pytest
 
-from archiver.extract import extract_archive
+from archiver.archive import create_archive
+from archiver import extract
+from archiver.extract import extract_archive, get_extraction_kind, get_uncompressed_archive_size_in_bytes, RestoreReport
+from archiver.journal import ExtractionJournal, get_extraction_journal_path
+from archiver.listing import MemberSelection
+from archiver.encryption import get_stream_encryption_command
+from archiver.member_index import create_member_index, get_tar_members
 from tests import helpers
+from .archiving_helpers import get_public_key_paths
 
 
 def test_extract_archive(tmp_path):
@@ -95,6 +104,32 @@ def test_extract_split_partial(tmp_path):
     assert filecmp.cmp(folder_path.joinpath("file_b.txt"), extraction_path.joinpath(FOLDER_NAME + "/file_b.txt"))
 
 
+def test_extract_split_selection(tmp_path, caplog):
+    FOLDER_NAME = "large-folder"
+
+    archive_path = helpers.get_directory_with_name("split-archive")
+    folder_path = helpers.get_directory_with_name(FOLDER_NAME)
+    extraction_path = tmp_path / "extraction-folder"
+
+    selection = MemberSelection(["large-folder/file_a.txt", "./large-folder/missing.txt"], ["large-folder/sub*"])
+    extract_archive(archive_path, extraction_path, selection=selection)
+
+    assert "Files matching 2 paths and 1 patterns are contained in 2 parts: large-folder.part1, large-folder.part2" \
+        in caplog.messages
+    assert any(message.startswith("No files matching path large-folder/missing.txt") for message in caplog.messages)
+
+    assert sorted(os.listdir(extraction_path / FOLDER_NAME)) == ["file_a.txt", "subfolder"]
+    assert filecmp.cmp(folder_path.joinpath("file_a.txt"), extraction_path.joinpath(FOLDER_NAME + "/file_a.txt"))
+    assert filecmp.cmp(folder_path.joinpath("subfolder/file_c.txt"), extraction_path.joinpath(FOLDER_NAME + "/subfolder/file_c.txt"))
+
+
+def test_extract_selection_not_found(tmp_path):
+    archive_path = helpers.get_directory_with_name("split-archive")
+
+    with pytest.raises(SystemExit):
+        extract_archive(archive_path, tmp_path / "extraction-folder", selection=MemberSelection(None, ["*.csv"]))
+
+
 def test_extract_symlink(tmp_path):
     FOLDER_NAME = "symlink-folder"
 
@@ -139,9 +174,8 @@ def test_extract_encrypted_archive(tmp_path, setup_gpg):
     assert filecmp.cmp(folder_path.joinpath("file1.txt"), extraction_path.joinpath(FOLDER_NAME + "/file1.txt"))
     assert filecmp.cmp(folder_path.joinpath("folder-in-archive/file2.txt"), extraction_path.joinpath(FOLDER_NAME + "/folder-in-archive/file2.txt"))
 
-    # Cleanup
-    # Required because currently encryption leaves unencrypted archives in source archive
-    os.remove(archive_path / (FOLDER_NAME + ".tar.lz"))
+    # encrypted archives are decrypted in a stream, no decrypted copies are written
+    assert not list(archive_path.glob("*.tar.lz"))
 
 
 def test_extract_encrypted_split(tmp_path, setup_gpg):
@@ -165,8 +199,453 @@ def test_extract_encrypted_split(tmp_path, setup_gpg):
     assert filecmp.cmp(folder_path.joinpath("file_b.txt"), extraction_path.joinpath(FOLDER_NAME + "/file_b.txt"))
     assert filecmp.cmp(folder_path.joinpath("subfolder/file_c.txt"), extraction_path.joinpath(FOLDER_NAME + "/subfolder/file_c.txt"))
 
-    # Cleanup
-    # Required because currently encryption leaves unencrypted archives in source archive
-    os.remove(archive_path / (FOLDER_NAME + ".part1.tar.lz"))
-    os.remove(archive_path / (FOLDER_NAME + ".part2.tar.lz"))
-    os.remove(archive_path / (FOLDER_NAME + ".part3.tar.lz"))
+    # encrypted archives are decrypted in a stream, no decrypted copies are written
+    assert not list(archive_path.glob("*.tar.lz"))
+
+
+def test_extract_encrypted_split_selection(tmp_path, setup_gpg):
+    FOLDER_NAME = "large-folder"
+
+    archive_path = helpers.get_directory_with_name("split-encrypted-archive")
+    folder_path = helpers.get_directory_with_name(FOLDER_NAME)
+    extraction_path = tmp_path / "extraction-folder"
+
+    extract_archive(archive_path, extraction_path, selection=MemberSelection(["large-folder/file_b.txt"]))
+
+    assert os.listdir(extraction_path / FOLDER_NAME) == ["file_b.txt"]
+    assert filecmp.cmp(folder_path.joinpath("file_b.txt"), extraction_path.joinpath(FOLDER_NAME + "/file_b.txt"))
+
+    # encrypted archives are decrypted in a stream, no decrypted copies are written
+    assert not list(archive_path.glob("*.tar.lz"))
+
+
+def test_extract_split_concurrently(tmp_path, caplog):
+    FOLDER_NAME = "large-folder"
+
+    archive_path = helpers.get_directory_with_name("split-archive")
+    folder_path = helpers.get_directory_with_name(FOLDER_NAME)
+    extraction_path = tmp_path / "extraction-folder"
+
+    extract_archive(archive_path, extraction_path, threads=12)
+
+    assert "Extracting 3 archives, 3 at a time" in caplog.messages
+    assert sum(message.startswith("Extracted archive") and "of 3 archives after" in message
+               for message in caplog.messages) == 3
+
+    assert filecmp.cmp(folder_path.joinpath("file_a.txt"), extraction_path.joinpath(FOLDER_NAME + "/file_a.txt"))
+    assert filecmp.cmp(folder_path.joinpath("file_b.txt"), extraction_path.joinpath(FOLDER_NAME + "/file_b.txt"))
+    assert filecmp.cmp(folder_path.joinpath("subfolder/file_c.txt"), extraction_path.joinpath(FOLDER_NAME + "/subfolder/file_c.txt"))
+
+
+def test_extract_split_corrupted_part(tmp_path, caplog):
+    archive_path = tmp_path / "split-archive"
+    shutil.copytree(helpers.get_directory_with_name("split-archive"), archive_path)
+    # a valid lzip file, but not containing a tar archive
+    corrupted_part = archive_path / "large-folder.part2.tar.lz"
+    corrupted_part.write_bytes(subprocess.run(["plzip", "-c"], input=b"not a tar archive" * 100,
+                                              stdout=subprocess.PIPE, check=True).stdout)
+
+    with pytest.raises(SystemExit):
+        extract_archive(archive_path, tmp_path / "extraction-folder", threads=8)
+
+    assert any(message.startswith(f"Extraction of archive {corrupted_part} failed") for message in caplog.messages)
+    # the other parts are extracted nevertheless
+    assert (tmp_path / "extraction-folder" / "large-folder" / "file_b.txt").is_file()
+
+
+def test_extract_split_resume(tmp_path, caplog):
+    FOLDER_NAME = "large-folder"
+
+    archive_path = tmp_path / "split-archive"
+    shutil.copytree(helpers.get_directory_with_name("split-archive"), archive_path)
+    folder_path = helpers.get_directory_with_name(FOLDER_NAME)
+    extraction_path = tmp_path / "extraction-folder"
+
+    part2 = archive_path / "large-folder.part2.tar.lz"
+    part2_content = part2.read_bytes()
+    part2.write_bytes(subprocess.run(["plzip", "-c"], input=b"not a tar archive" * 100,
+                                     stdout=subprocess.PIPE, check=True).stdout)
+
+    with pytest.raises(SystemExit):
+        extract_archive(archive_path, extraction_path, threads=3)
+
+    assert get_extraction_journal_path(extraction_path).is_file()
+
+    # the destination is only reused with resume
+    with pytest.raises(SystemExit):
+        extract_archive(archive_path, extraction_path)
+
+    part2.write_bytes(part2_content)
+    (extraction_path / FOLDER_NAME / "file_b.txt").unlink()
+    caplog.clear()
+    extract_archive(archive_path, extraction_path, resume=True)
+
+    assert "Skipping 2 archives extracted before" in caplog.messages
+    assert sum(message.startswith("Extracting all from archive") for message in caplog.messages) == 1
+
+    # the part extracted before isn't extracted again
+    assert sorted(os.listdir(extraction_path / FOLDER_NAME)) == ["file_a.txt", "subfolder"]
+    assert filecmp.cmp(folder_path.joinpath("file_a.txt"), extraction_path.joinpath(FOLDER_NAME + "/file_a.txt"))
+    assert not get_extraction_journal_path(extraction_path).exists()
+
+
+@pytest.fixture
+def archive_with_member_index(tmp_path):
+    """Archive of two folders with files of random data (s.t. they take up several lzip members, if small ones are used)"""
+    source_path = tmp_path / "source"
+    for folder in ["folder-a", "folder-b"]:
+        (source_path / folder).mkdir(parents=True)
+        for index in range(3):
+            (source_path / folder / f"file{index}.bin").write_bytes(os.urandom(20 * 1000))
+
+    archive_path = tmp_path / "archive"
+    create_archive(source_path, archive_path)
+
+    return source_path, archive_path
+
+
+@pytest.mark.parametrize("data_size", [None, 8192])
+def test_extract_subpath_with_member_index(tmp_path, caplog, archive_with_member_index, data_size):
+    source_path, archive_path = archive_with_member_index
+    extraction_path = tmp_path / "extraction-folder"
+
+    if data_size:
+        # recompressed with small lzip members, s.t. only some of them have to be decompressed
+        compressed_path = archive_path / "source.tar.lz"
+        tar_path = tmp_path / "source.tar"
+        tar_path.write_bytes(subprocess.run(["plzip", "-d", "-c", compressed_path], stdout=subprocess.PIPE,
+                                            check=True).stdout)
+        compressed_path.write_bytes(subprocess.run(["plzip", "-c", f"--data-size={data_size}", tar_path],
+                                                   stdout=subprocess.PIPE, check=True).stdout)
+        create_member_index(compressed_path, get_tar_members(tar_path))
+
+    extract_archive(archive_path, extraction_path, "source/folder-b/file1.bin")
+
+    nr_decompressed, nr_members = next(map(int, message.split()[1:4:2]) for message in caplog.messages
+                                       if message.endswith("lzip members of source.tar.lz using its member index"))
+    assert nr_decompressed < nr_members if data_size else nr_decompressed == nr_members == 1
+
+    assert os.listdir(extraction_path / "source") == ["folder-b"]
+    assert os.listdir(extraction_path / "source" / "folder-b") == ["file1.bin"]
+    assert filecmp.cmp(source_path / "folder-b" / "file1.bin", extraction_path / "source" / "folder-b" / "file1.bin",
+                       shallow=False)
+
+
+def test_extract_subpath_with_outdated_member_index(tmp_path, caplog, archive_with_member_index):
+    source_path, archive_path = archive_with_member_index
+    extraction_path = tmp_path / "extraction-folder"
+
+    index_path = archive_path / "source.tar.lz.idx"
+    index_path.write_text(index_path.read_text().replace("compressed_size=", "compressed_size=1"))
+
+    extract_archive(archive_path, extraction_path, "source/folder-a")
+
+    assert any(message.startswith("Ignoring member index") for message in caplog.messages)
+    assert sorted(os.listdir(extraction_path / "source" / "folder-a")) == ["file0.bin", "file1.bin", "file2.bin"]
+
+
+def test_extract_subpath_with_member_index_corrupted(tmp_path, caplog, monkeypatch, archive_with_member_index):
+    _, archive_path = archive_with_member_index
+    compressed_path = archive_path / "source.tar.lz"
+    with open(compressed_path, "r+b") as compressed_file:
+        compressed_file.seek(compressed_path.stat().st_size // 2)
+        compressed_file.write(b"corrupted")
+    # the uncompressed size is taken from the trailer, which might have been corrupted as well
+    monkeypatch.setattr(extract, "ensure_sufficient_disk_capacity_for_extraction", lambda *args: None)
+
+    with pytest.raises(SystemExit):
+        extract_archive(archive_path, tmp_path / "extraction-folder", "source/folder-b")
+
+    # the failure of plzip is reported, not the one of tar reading the truncated stream
+    assert any(message.startswith(f"Extraction of archive {compressed_path} failed: Command '['plzip'")
+               for message in caplog.messages)
+
+
+def test_extract_selection_with_member_index(tmp_path, caplog, archive_with_member_index):
+    source_path, archive_path = archive_with_member_index
+    extraction_path = tmp_path / "extraction-folder"
+
+    extract_archive(archive_path, extraction_path,
+                    selection=MemberSelection(["source/folder-a/file0.bin"], ["source/*/file2.bin"]))
+
+    assert any(message.endswith("lzip members of source.tar.lz using its member index") for message in caplog.messages)
+
+    assert sorted(os.listdir(extraction_path / "source" / "folder-a")) == ["file0.bin", "file2.bin"]
+    assert os.listdir(extraction_path / "source" / "folder-b") == ["file2.bin"]
+    for path in ["folder-a/file0.bin", "folder-a/file2.bin", "folder-b/file2.bin"]:
+        assert filecmp.cmp(source_path / path, extraction_path / "source" / path, shallow=False)
+
+
+def test_extract_resume_with_member_index(tmp_path, caplog, monkeypatch, archive_with_member_index):
+    source_path, archive_path = archive_with_member_index
+    extraction_path = tmp_path / "extraction-folder"
+    archive_file = archive_path / "source.tar.lz"
+
+    # the last file extracted is recorded whenever tar starts extracting the next one
+    recorded_members = []
+    monkeypatch.setattr(extract, "EXTRACTION_JOURNAL_MEMBER_INTERVAL_SECONDS", 0)
+    monkeypatch.setattr(ExtractionJournal, "record_last_member",
+                        lambda journal, part_path, kind, member_path: recorded_members.append(member_path))
+    extract_archive(archive_path, extraction_path)
+
+    expected_members = [path for _, _, path in get_tar_members_of_archive(archive_file, tmp_path)]
+    assert recorded_members == expected_members[:-1]
+    # without a file extracted before, the archive is extracted from the stream of plzip directly
+    assert not any(message.endswith("using its member index") for message in caplog.messages)
+    monkeypatch.undo()
+
+    # an extraction interrupted in the middle of the archive
+    last_member = next(path for path in expected_members[len(expected_members) // 2:] if path.endswith(".bin"))
+    remaining_files = [path for path in expected_members[expected_members.index(last_member) + 1:] if path.endswith(".bin")]
+    for path in remaining_files:
+        (extraction_path / path).unlink()
+    (extraction_path / last_member).write_bytes(b"extracted before")
+
+    with ExtractionJournal(get_extraction_journal_path(extraction_path)) as journal:
+        journal.record_last_member(archive_file, get_extraction_kind(), last_member)
+    caplog.clear()
+
+    extract_archive(archive_path, extraction_path, resume=True)
+
+    assert f"Resuming extraction of source.tar.lz after {last_member}" in caplog.messages
+    assert remaining_files
+    for path in remaining_files:
+        assert filecmp.cmp(tmp_path / path, extraction_path / path, shallow=False)
+    # the files extracted before aren't extracted again
+    assert (extraction_path / last_member).read_bytes() == b"extracted before"
+    assert not get_extraction_journal_path(extraction_path).exists()
+
+
+@pytest.mark.parametrize("nr_extracted_before", [1, 2])
+def test_extract_resume_selection(tmp_path, caplog, archive_with_member_index, nr_extracted_before):
+    source_path, archive_path = archive_with_member_index
+    extraction_path = tmp_path / "extraction-folder"
+    archive_file = archive_path / "source.tar.lz"
+    members = [path for _, _, path in get_tar_members_of_archive(archive_file, tmp_path) if path.endswith(".bin")]
+    # as given with --files-from, in the order of the archive
+    selected_paths = [members[0], members[-2]]
+    selection = MemberSelection(selected_paths)
+    extract_archive(archive_path, extraction_path, selection=selection)
+
+    # an extraction interrupted after the first selected file, or after all of them
+    for path in selected_paths[nr_extracted_before:]:
+        (extraction_path / path).unlink()
+    with ExtractionJournal(get_extraction_journal_path(extraction_path)) as journal:
+        journal.record_last_member(archive_file, get_extraction_kind(selection), selected_paths[nr_extracted_before - 1])
+    caplog.clear()
+
+    # tar doesn't get the paths only matching files extracted before, which it wouldn't find in the stream
+    extract_archive(archive_path, extraction_path, selection=selection, resume=True)
+
+    assert f"Resuming extraction of source.tar.lz after {selected_paths[nr_extracted_before - 1]}" in caplog.messages
+    for path in selected_paths:
+        assert filecmp.cmp(tmp_path / path, extraction_path / path, shallow=False)
+    assert not get_extraction_journal_path(extraction_path).exists()
+
+
+@pytest.mark.parametrize("locale", ["C", "C.UTF-8"])
+def test_extract_records_members_by_name(tmp_path, monkeypatch, locale):
+    source_path = tmp_path / "source"
+    source_path.mkdir()
+    # tar lists these escaped, in the C locale the umlaut as octal numbers
+    for name in ["new\nline.txt", "back\\slash.txt", "\u00fcmlaut tab\t.txt", "plain.txt"]:
+        (source_path / name).write_text(name)
+    create_archive(source_path, tmp_path / "archive")
+
+    recorded_members = []
+    monkeypatch.setenv("LC_ALL", locale)
+    monkeypatch.setattr(extract, "EXTRACTION_JOURNAL_MEMBER_INTERVAL_SECONDS", 0)
+    monkeypatch.setattr(ExtractionJournal, "record_last_member",
+                        lambda journal, part_path, kind, member_path: recorded_members.append(member_path))
+    extract_archive(tmp_path / "archive", tmp_path / "extraction-folder")
+
+    expected_members = [path for _, _, path in get_tar_members_of_archive(tmp_path / "archive" / "source.tar.lz",
+                                                                          tmp_path)]
+    assert recorded_members == expected_members[:-1]
+
+
+def test_extract_recording_failure(tmp_path, caplog, monkeypatch, archive_with_member_index):
+    _, archive_path = archive_with_member_index
+
+    def record_last_member(journal, part_path, kind, member_path):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(extract, "EXTRACTION_JOURNAL_MEMBER_INTERVAL_SECONDS", 0)
+    monkeypatch.setattr(ExtractionJournal, "record_last_member", record_last_member)
+
+    # tar's output is closed instead of blocking it, the cause is reported
+    with pytest.raises(SystemExit):
+        extract_archive(archive_path, tmp_path / "extraction-folder")
+
+    assert f"Extraction of archive {archive_path / 'source.tar.lz'} failed: No space left on device" in caplog.messages
+
+
+def test_extract_resume_without_member_index(tmp_path, caplog, archive_with_member_index):
+    _, archive_path = archive_with_member_index
+    (archive_path / "source.tar.lz.idx").unlink()
+
+    extract_archive(archive_path, tmp_path / "extraction-folder")
+
+    assert "source.tar.lz has no member index, an interrupted extraction will extract it again as a whole" \
+        in caplog.messages
+
+
+def get_tar_members_of_archive(archive_file, tmp_path):
+    tar_path = tmp_path / "archive.tar"
+    tar_path.write_bytes(subprocess.run(["plzip", "-d", "-c", archive_file], stdout=subprocess.PIPE, check=True).stdout)
+
+    return get_tar_members(tar_path)
+
+
+def test_extract_split_verify(tmp_path):
+    archive_path = helpers.get_directory_with_name("split-archive")
+    report = RestoreReport()
+
+    extract_archive(archive_path, tmp_path / "extraction-folder", threads=3, report=report)
+
+    assert report.success
+    assert report.get_lines() == [
+        "large-folder.part1.tar.lz: 1 files verified, 0 corrupted, 0 missing, 0 not in hash listing, 0 unverified",
+        "large-folder.part2.tar.lz: 1 files verified, 0 corrupted, 0 missing, 0 not in hash listing, 0 unverified",
+        "large-folder.part3.tar.lz: 1 files verified, 0 corrupted, 0 missing, 0 not in hash listing, 0 unverified",
+        "Restore verified: 3 files verified in 3 archives, 0 problems found"]
+
+
+def test_extract_selection_verify(tmp_path):
+    archive_path = helpers.get_directory_with_name("split-archive")
+    report = RestoreReport()
+
+    extract_archive(archive_path, tmp_path / "extraction-folder", selection=MemberSelection(None, ["*/sub*"]),
+                    report=report)
+
+    assert report.success
+    assert report.get_lines()[-1] == "Restore verified: 1 files verified in 1 archives, 0 problems found"
+
+
+def test_extract_verify_directory_symlink(tmp_path):
+    source_path = tmp_path / "source"
+    (source_path / "folder").mkdir(parents=True)
+    (source_path / "folder" / "file.txt").write_text("content")
+    (source_path / "link-to-folder").symlink_to("folder")
+    create_archive(source_path, tmp_path / "archive", compression=1)
+    report = RestoreReport()
+
+    extract_archive(tmp_path / "archive", tmp_path / "extraction-folder", report=report)
+
+    # the symlink to the directory isn't in the hash listing and isn't verified either
+    assert report.success
+    assert report.get_lines()[0] == \
+        "source.tar.lz: 1 files verified, 0 corrupted, 0 missing, 0 not in hash listing, 0 unverified"
+
+
+@pytest.mark.parametrize("hash_algorithm", ["md5", "sha256"])
+def test_extract_verify_detects_corruption(tmp_path, hash_algorithm, archive_with_member_index):
+    source_path, _ = archive_with_member_index
+    archive_path = tmp_path / f"archive-{hash_algorithm}"
+    create_archive(source_path, archive_path, hash_algorithm=hash_algorithm)
+
+    # the hash listing doesn't match the archive content anymore
+    hash_listing_path = archive_path / "source.md5"
+    lines = hash_listing_path.read_text().splitlines(keepends=True)
+    changed_lines = []
+    for line in lines:
+        if line.rstrip().endswith("folder-a/file0.bin"):
+            line = ("0" if line[0] != "0" else "1") + line[1:]
+        elif line.rstrip().endswith("folder-b/file1.bin"):
+            continue
+        changed_lines.append(line)
+    changed_lines.append(changed_lines[-1].replace("file", "missing-file"))
+    hash_listing_path.write_text("".join(changed_lines))
+
+    report = RestoreReport()
+    extract_archive(archive_path, tmp_path / "extraction-folder", report=report)
+
+    assert not report.success
+    lines = report.get_lines()
+    assert lines[0] == "source.tar.lz: 4 files verified, 1 corrupted, 1 missing, 1 not in hash listing, 0 unverified"
+    assert "CORRUPTED: source/folder-a/file0.bin" in lines
+    assert "NOT IN HASH LISTING: source/folder-b/file1.bin" in lines
+    assert sum(line.startswith("MISSING: ") and "missing-file" in line for line in lines) == 1
+    assert lines[-1] == "Restore verification failed: 4 files verified in 1 archives, 3 problems found"
+    # the files are extracted nevertheless
+    assert filecmp.cmp(source_path / "folder-a" / "file0.bin", tmp_path / "extraction-folder" / "source" / "folder-a" / "file0.bin",
+                       shallow=False)
+
+
+def test_extract_resume_verify(tmp_path, archive_with_member_index):
+    source_path, archive_path = archive_with_member_index
+    extraction_path = tmp_path / "extraction-folder"
+    extract_archive(archive_path, extraction_path)
+
+    members = [path for _, _, path in get_tar_members_of_archive(archive_path / "source.tar.lz", tmp_path)
+               if path.endswith(".bin")]
+    with ExtractionJournal(get_extraction_journal_path(extraction_path)) as journal:
+        journal.record_last_member(archive_path / "source.tar.lz", get_extraction_kind(), members[1])
+
+    report = RestoreReport()
+    extract_archive(archive_path, extraction_path, resume=True, report=report)
+
+    # the files extracted before aren't expected in the stream
+    assert report.success
+    assert report.get_lines()[-1] == f"Restore verified: {len(members) - 2} files verified in 1 archives, 0 problems found"
+
+
+@pytest.fixture
+def encrypted_archive_with_member_index(tmp_path, setup_gpg, archive_with_member_index):
+    """The archive with small lzip members and its member index, encrypted without keeping the .tar.lz"""
+    source_path, archive_path = archive_with_member_index
+    compressed_path = archive_path / "source.tar.lz"
+    tar_path = tmp_path / "source.tar"
+    tar_path.write_bytes(subprocess.run(["plzip", "-d", "-c", compressed_path], stdout=subprocess.PIPE,
+                                        check=True).stdout)
+    compressed_path.write_bytes(subprocess.run(["plzip", "-c", "--data-size=8192", tar_path],
+                                               stdout=subprocess.PIPE, check=True).stdout)
+    create_member_index(compressed_path, get_tar_members(tar_path))
+
+    with open(compressed_path, "rb") as compressed_file:
+        encrypted = subprocess.run(get_stream_encryption_command(get_public_key_paths()), stdin=compressed_file,
+                                   stdout=subprocess.PIPE, check=True).stdout
+    (archive_path / "source.tar.lz.gpg").write_bytes(encrypted)
+    compressed_path.unlink()
+
+    return source_path, archive_path
+
+
+def test_extract_encrypted_subpath_with_member_index(tmp_path, caplog, encrypted_archive_with_member_index):
+    source_path, archive_path = encrypted_archive_with_member_index
+    extraction_path = tmp_path / "extraction-folder"
+
+    extract_archive(archive_path, extraction_path, "source/folder-b/file1.bin")
+
+    # decrypted in a stream, but only the lzip members needed are decompressed
+    nr_decompressed, nr_members = next(map(int, message.split()[1:4:2]) for message in caplog.messages
+                                       if message.endswith("lzip members of source.tar.lz.gpg using its member index"))
+    assert nr_decompressed < nr_members
+
+    assert os.listdir(extraction_path / "source" / "folder-b") == ["file1.bin"]
+    assert filecmp.cmp(source_path / "folder-b" / "file1.bin", extraction_path / "source" / "folder-b" / "file1.bin",
+                       shallow=False)
+    assert not list(archive_path.glob("*.tar.lz"))
+
+
+def test_extract_encrypted_with_mismatching_member_index(tmp_path, caplog, encrypted_archive_with_member_index):
+    _, archive_path = encrypted_archive_with_member_index
+
+    index_path = archive_path / "source.tar.lz.idx"
+    index_path.write_text(index_path.read_text().replace("compressed_size=", "compressed_size=1"))
+
+    with pytest.raises(SystemExit):
+        extract_archive(archive_path, tmp_path / "extraction-folder", "source/folder-a/file0.bin")
+
+    assert any("bytes after decryption" in message for message in caplog.messages)
+
+
+def test_uncompressed_size_of_encrypted_archive(tmp_path, encrypted_archive_with_member_index):
+    _, archive_path = encrypted_archive_with_member_index
+    encrypted_path = archive_path / "source.tar.lz.gpg"
+
+    assert get_uncompressed_archive_size_in_bytes(encrypted_path) == (tmp_path / "source.tar").stat().st_size
+
+    # without a member index, the size of the files in the listing is used
+    (archive_path / "source.tar.lz.idx").unlink()
+    assert get_uncompressed_archive_size_in_bytes(encrypted_path) == 6 * 20 * 1000
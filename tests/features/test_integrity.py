@@ -1,4 +1,12 @@
-from archiver.integrity import check_integrity, verify_relative_symbolic_links, get_archives_with_hashes_from_path
+import shutil
+
+import pytest
+
+from archiver.archive import create_archive
+from archiver.integrity import check_integrity, verify_relative_symbolic_links, get_archives_with_hashes_from_path, \
+    path_is_in_subpath, get_subpath_check
+from archiver.helpers import get_sample_size_from_string
+from archiver.journal import CheckJournal, get_check_journal_path
 from tests.helpers import get_directory_with_name
 
 DEEP = True
@@ -161,6 +169,318 @@ def test_integrity_check_deep_symlink(caplog):
     assert "Symlink symlink-folder/invalid_link pointing to not_existing is broken in archive" in caplog.messages
 
 
+@pytest.mark.parametrize("archive_dir_name,archive_file_name", [
+    ("normal-archive", "test-folder.tar.lz"),
+    ("encrypted-archive", None),
+    ("encrypted-archive", "test-folder.tar.lz.gpg"),
+    ("split-archive", "large-folder.part1.tar.lz"),
+    ("split-encrypted-archive", "large-folder.part1.tar.lz.gpg"),
+])
+def test_integrity_check_deep_stream(caplog, setup_gpg, archive_dir_name, archive_file_name):
+    archive_dir = get_directory_with_name(archive_dir_name)
+    archive_path = archive_dir.joinpath(archive_file_name) if archive_file_name else archive_dir
+
+    assert_successful_deep_check(archive_path, caplog, stream=True)
+
+
+def test_integrity_check_deep_stream_corrupted(caplog):
+    archive_dir = get_directory_with_name("normal-archive-corrupted-deep")
+
+    expected_messages = [
+        "Missing file test-folder/folder-in-archive/big file3.txt in archive!",
+        'File test-folder/folder-in-archive/file2.txt in archive does not appear in list of md5sums!',
+        "Hash of test-folder/file1.txt has changed: Expected 49dbcfb5e7ae8ca55cab5b0e4674d9fd but got 49dbcfb5e7ae8ca55cab6b0e4674d9fd",
+        "Deep integrity check unsuccessful. Archive has been changed since creation."]
+
+    check_integrity_and_validate_output_contains(archive_dir, caplog, expected_messages, False, DEEP, stream=True)
+
+
+def test_integrity_check_deep_stream_corrupted_encrypted(caplog, setup_gpg):
+    archive_dir = get_directory_with_name("encrypted-archive-corrupted-deep")
+
+    expected_messages = ["Hash of test-folder/folder-in-archive/file2.txt has changed: Expected 5762a5694bf3cb3dp59bf864ed71a4a8 but got 5762a5694bf3cb3df59bf864ed71a4a8",
+                         "Deep integrity check unsuccessful. Archive has been changed since creation."]
+
+    check_integrity_and_validate_output_contains(archive_dir, caplog, expected_messages, False, DEEP, stream=True)
+
+
+def test_integrity_check_deep_stream_truncated(caplog, tmp_path):
+    archive_dir = tmp_path / "normal-archive"
+    shutil.copytree(get_directory_with_name("normal-archive"), archive_dir)
+    archive_file = archive_dir / "test-folder.tar.lz"
+    archive_file.write_bytes(archive_file.read_bytes()[:-100])
+
+    assert not check_integrity(archive_file, DEEP, threads=2, stream=True)
+
+    assert any(message.startswith(f"Decompressing archive {archive_file} failed") for message in caplog.messages)
+    assert caplog.messages[-1] == "Deep integrity check unsuccessful. Archive has been changed since creation."
+
+
+@pytest.mark.parametrize("io_workers,concurrent", [(None, 2), (1, 1)])
+def test_integrity_check_deep_stream_parts_concurrently(caplog, io_workers, concurrent):
+    archive_dir = get_directory_with_name("split-archive")
+
+    assert check_integrity(archive_dir, DEEP, threads=8, stream=True, io_workers=io_workers)
+
+    assert (f"Checking 3 archives, {concurrent} at a time" in caplog.messages) == (concurrent > 1)
+    for part in range(1, 4):
+        assert any(message.startswith("Verified") and f"of large-folder.part{part}.tar.lz in" in message
+                   for message in caplog.messages)
+    assert caplog.messages[-1] == "Deep integrity check successful."
+
+
+def test_integrity_check_deep_stream_reports_failed_parts(caplog):
+    archive_dir = get_directory_with_name("normal-archive-corrupted-deep")
+
+    assert not check_integrity(archive_dir, DEEP, threads=8, stream=True)
+
+    assert "Deep check failed for 1 of 1 archives: test-folder.tar.lz" in caplog.messages
+
+
+def test_integrity_check_deep_stream_symlink(caplog):
+    archive_dir = get_directory_with_name("symlink-archive")
+    archive_file = archive_dir.joinpath("symlink-folder.tar.lz")
+
+    assert_successful_deep_check(archive_file, caplog, stream=True)
+
+    assert "Symlink symlink-folder/invalid_link_abs found pointing to /not/existing . The archive contains the link itself, but possibly not the file it points to." in caplog.messages
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_integrity_check_deep_directory_symlink(caplog, tmp_path, stream):
+    source_path = tmp_path / "dir-link-folder"
+    (source_path / "folder").mkdir(parents=True)
+    (source_path / "folder" / "file.txt").write_text("content")
+    (source_path / "link-to-folder").symlink_to("folder")
+    (source_path / "folder" / "link-to-parent").symlink_to("..")
+    (source_path / "link-to-file").symlink_to("folder/file.txt")
+    destination_path = tmp_path / "archive"
+
+    create_archive(source_path, destination_path, compression=1)
+
+    # like the listing created from the filesystem, the deep check skips symlinks to directories in both modes
+    assert check_integrity(destination_path, DEEP, threads=2, stream=stream)
+    assert check_integrity(destination_path, DEEP, threads=2, subpath="dir-link-folder")
+    assert "does not appear in list of md5sums" not in caplog.text
+
+
+@pytest.mark.parametrize("archive_dir_name,archive_file_name", [
+    ("normal-archive", "test-folder.tar.lz"),
+    ("encrypted-archive", None),
+    ("split-archive", None),
+    ("split-encrypted-archive", "large-folder.part1.tar.lz.gpg"),
+])
+def test_integrity_check_medium(caplog, setup_gpg, archive_dir_name, archive_file_name):
+    archive_dir = get_directory_with_name(archive_dir_name)
+    archive_path = archive_dir.joinpath(archive_file_name) if archive_file_name else archive_dir
+
+    assert check_integrity(archive_path, threads=8, medium_flag=True)
+
+    assert caplog.messages[-1] == "Medium integrity check successful."
+
+
+def test_integrity_check_medium_changed_tar_hash(caplog, tmp_path):
+    archive_dir = tmp_path / "split-archive"
+    shutil.copytree(get_directory_with_name("split-archive"), archive_dir)
+    tar_hash_file = archive_dir / "large-folder.part2.tar.md5"
+    tar_hash_file.write_text("0" * 32 + "\n")
+
+    assert not check_integrity(archive_dir, threads=8, medium_flag=True)
+
+    assert "Hash of the tar archive in large-folder.part2.tar.lz has changed." in caplog.messages
+    assert "Medium check failed for 1 of 3 archives: large-folder.part2.tar.lz" in caplog.messages
+    assert caplog.messages[-1] == "Medium integrity check unsuccessful. Archive has been changed since creation."
+
+
+def test_integrity_check_medium_truncated(caplog, tmp_path):
+    archive_dir = tmp_path / "normal-archive"
+    shutil.copytree(get_directory_with_name("normal-archive"), archive_dir)
+    archive_file = archive_dir / "test-folder.tar.lz"
+    archive_file.write_bytes(archive_file.read_bytes()[:-100])
+
+    assert not check_integrity(archive_file, threads=2, medium_flag=True)
+
+    assert any(message.startswith(f"Decompressing archive {archive_file} failed") for message in caplog.messages)
+    assert caplog.messages[-1] == "Medium integrity check unsuccessful. Archive has been changed since creation."
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_integrity_check_deep_resume(caplog, tmp_path, stream):
+    archive_dir = get_directory_with_name("split-archive")
+
+    assert check_integrity(archive_dir, DEEP, threads=2, work_dir=tmp_path, stream=stream)
+    assert check_integrity(archive_dir, DEEP, threads=2, work_dir=tmp_path, stream=stream, resume=True)
+
+    for part in range(1, 4):
+        assert f"Skipping archive large-folder.part{part}.tar.lz, it has been verified by a previous check" in caplog.messages
+    assert caplog.messages[-1] == "Deep integrity check successful."
+
+
+def test_integrity_check_deep_stream_resume_files(caplog, tmp_path):
+    archive_dir = get_directory_with_name("split-archive")
+    archive_file = archive_dir / "large-folder.part1.tar.lz"
+
+    # as if the check was interrupted after hashing file_c.txt, with a wrong hash to see it isn't hashed again
+    with CheckJournal(get_check_journal_path(tmp_path, archive_dir)) as journal:
+        journal.record_members(archive_file, "deep", [["large-folder/subfolder/file_c.txt", "0" * 32]])
+
+    assert not check_integrity(archive_dir, DEEP, threads=2, work_dir=tmp_path, stream=True, resume=True)
+
+    assert "Skipping 1 files of large-folder.part1.tar.lz hashed by a previous check" in caplog.messages
+    assert "Hash of large-folder/subfolder/file_c.txt has changed: Expected d1dd210d6b1312cb342b56d02bd5e651 " \
+           f"but got {'0' * 32}" in caplog.messages
+    assert "Deep check failed for 1 of 3 archives: large-folder.part1.tar.lz" in caplog.messages
+
+
+def test_integrity_check_medium_resume_retries_failed_parts(caplog, tmp_path):
+    archive_dir = tmp_path / "split-archive"
+    shutil.copytree(get_directory_with_name("split-archive"), archive_dir)
+    tar_hash_file = archive_dir / "large-folder.part2.tar.md5"
+    tar_hash = tar_hash_file.read_text()
+    tar_hash_file.write_text("0" * 32 + "\n")
+
+    assert not check_integrity(archive_dir, threads=8, work_dir=tmp_path, medium_flag=True)
+    assert f"Results are recorded in {get_check_journal_path(tmp_path, archive_dir)}, check again with --resume " \
+           "to retry the failed archives only" in caplog.messages
+
+    caplog.clear()
+    tar_hash_file.write_text(tar_hash)
+    assert check_integrity(archive_dir, threads=8, work_dir=tmp_path, medium_flag=True, resume=True)
+
+    assert "Skipping archive large-folder.part1.tar.lz, it has been verified by a previous check" in caplog.messages
+    assert "Checking archive large-folder.part2.tar.lz again, it failed a previous check" in caplog.messages
+    assert "Skipping archive large-folder.part3.tar.lz, it has been verified by a previous check" in caplog.messages
+    assert caplog.messages[-1] == "Medium integrity check successful."
+
+
+@pytest.mark.parametrize("archive_dir_name,sample,expected_message", [
+    ("normal-archive", "1", "All 1 sampled of 2 files match their hashes: with 95% confidence, less than 95.00% "
+                            "of the files are missing or have been changed."),
+    ("encrypted-archive", "50%", "All 1 sampled of 2 files match their hashes: with 95% confidence, less than 95.00% "
+                                 "of the files are missing or have been changed."),
+    ("split-archive", "1K", "All 3 files have been verified."),
+])
+def test_integrity_check_sample(caplog, setup_gpg, archive_dir_name, sample, expected_message):
+    archive_dir = get_directory_with_name(archive_dir_name)
+
+    assert check_integrity(archive_dir, threads=2, sample_size=get_sample_size_from_string(sample), seed=42)
+
+    assert "Sampling files with seed 42, use --seed 42 to check the same files again" in caplog.messages
+    assert expected_message in caplog.messages
+    assert caplog.messages[-1] == "Sampled integrity check successful."
+
+
+def test_integrity_check_sample_bytes_escaped_names(caplog, tmp_path, monkeypatch):
+    source_path = tmp_path / "source"
+    source_path.mkdir()
+    for name in ["back\\slash.bin", "\u00fcmlaut.bin", "with space.bin", "plain.bin"]:
+        (source_path / name).write_bytes(b"x" * 1000)
+    # tar escapes the backslash and, in the C locale, the umlaut as octal numbers in the listing
+    monkeypatch.setenv("LC_ALL", "C")
+    create_archive(source_path, tmp_path / "archive")
+    assert "\\303\\274mlaut.bin" in (tmp_path / "archive" / "source.tar.lst").read_text()
+
+    assert check_integrity(tmp_path / "archive", sample_size=("bytes", 2048), seed=42)
+
+    # the sizes of all files are known, so three files make up the sample
+    assert any(message.startswith("Hashing 3 of 4 files") for message in caplog.messages)
+
+
+def test_integrity_check_sample_corrupted(caplog):
+    archive_dir = get_directory_with_name("normal-archive-corrupted-deep")
+
+    assert not check_integrity(archive_dir, threads=2, sample_size=("fraction", 1.0))
+
+    assert "Missing file test-folder/folder-in-archive/big file3.txt in archive!" in caplog.messages
+    assert "Hash of test-folder/file1.txt has changed: Expected 49dbcfb5e7ae8ca55cab5b0e4674d9fd but got " \
+           "49dbcfb5e7ae8ca55cab6b0e4674d9fd" in caplog.messages
+    assert "2 of 2 sampled files are missing or have been changed." in caplog.messages
+    assert caplog.messages[-1] == "Sampled integrity check unsuccessful. Archive has been changed since creation."
+
+
+@pytest.mark.parametrize("archive_dir_name,archive_file_name", [
+    ("split-archive", "large-folder.part1.tar.lz"),
+    ("split-encrypted-archive", "large-folder.part1.tar.lz.gpg"),
+])
+def test_integrity_check_deep_subpath(caplog, setup_gpg, archive_dir_name, archive_file_name):
+    archive_dir = get_directory_with_name(archive_dir_name)
+
+    assert check_integrity(archive_dir, DEEP, threads=2, subpath="large-folder/subfolder/")
+
+    assert f"Files below large-folder/subfolder/ are contained in 1 of 3 archives: {archive_file_name}" in caplog.messages
+    assert not any("part2" in message or "part3" in message for message in caplog.messages
+                   if not message.startswith("Found 3 parts"))
+    assert any(message.startswith(f"Verified 1 files") and f"of {archive_file_name} in" in message
+               for message in caplog.messages)
+    assert caplog.messages[-1] == "Deep integrity check successful."
+
+
+def test_integrity_check_deep_subpath_with_member_index(tmp_path, caplog):
+    source_path = tmp_path / "source"
+    (source_path / "folder").mkdir(parents=True)
+    (source_path / "folder" / "file.txt").write_text("content")
+    (source_path / "other.txt").write_text("other content")
+    create_archive(source_path, tmp_path / "archive")
+
+    assert check_integrity(tmp_path / "archive", DEEP, subpath="source/folder")
+
+    assert "Decompressing 1 of 1 lzip members of source.tar.lz using its member index" in caplog.messages
+    assert any(message.startswith("Verified 1 files") for message in caplog.messages)
+
+
+def test_integrity_check_deep_subpath_corrupted(caplog):
+    archive_dir = get_directory_with_name("normal-archive-corrupted-deep")
+
+    assert not check_integrity(archive_dir, DEEP, threads=2, subpath="test-folder/folder-in-archive")
+
+    assert "Missing file test-folder/folder-in-archive/big file3.txt in archive!" in caplog.messages
+    assert "File test-folder/folder-in-archive/file2.txt in archive does not appear in list of md5sums!" in caplog.messages
+    # file1.txt has changed as well, but isn't below the subpath
+    assert not any("file1.txt" in message for message in caplog.messages)
+    assert "Deep check of test-folder/folder-in-archive failed for 1 of 1 archives: test-folder.tar.lz" in caplog.messages
+
+
+def test_integrity_check_deep_subpath_resume(caplog, tmp_path):
+    archive_dir = get_directory_with_name("split-archive")
+    archive_file = archive_dir / "large-folder.part1.tar.lz"
+
+    assert check_integrity(archive_dir, DEEP, threads=2, work_dir=tmp_path, subpath="large-folder/subfolder/")
+    assert check_integrity(archive_dir, DEEP, threads=2, work_dir=tmp_path, subpath="large-folder/subfolder",
+                           resume=True)
+    assert "Skipping archive large-folder.part1.tar.lz, it has been verified by a previous check" in caplog.messages
+
+    # the whole archive hasn't been verified by checking the subpath
+    caplog.clear()
+    assert check_integrity(archive_dir, DEEP, threads=2, work_dir=tmp_path, stream=True, resume=True)
+    assert not any(message.startswith("Skipping archive") for message in caplog.messages)
+
+    # as if the check was interrupted after hashing file_c.txt, with a wrong hash to see it isn't hashed again
+    with CheckJournal(get_check_journal_path(tmp_path, archive_dir)) as journal:
+        journal.record_members(archive_file, get_subpath_check("large-folder/subfolder"),
+                               [["large-folder/subfolder/file_c.txt", "0" * 32]])
+
+    assert not check_integrity(archive_dir, DEEP, threads=2, work_dir=tmp_path, subpath="large-folder/subfolder",
+                               resume=True)
+    assert "Skipping 1 files of large-folder.part1.tar.lz hashed by a previous check" in caplog.messages
+    assert "Deep check of large-folder/subfolder failed for 1 of 1 archives: large-folder.part1.tar.lz" \
+        in caplog.messages
+
+
+def test_integrity_check_deep_subpath_not_in_archive():
+    with pytest.raises(SystemExit):
+        check_integrity(get_directory_with_name("split-archive"), DEEP, threads=2, subpath="large-folder/missing")
+
+
+@pytest.mark.parametrize("path,subpath,expected", [
+    ("folder/sub/file.txt", "folder/sub", True),
+    ("folder/sub/file.txt", "./folder/sub/", True),
+    ("folder/sub", "folder/sub", True),
+    ("folder/subfolder/file.txt", "folder/sub", False),
+])
+def test_path_is_in_subpath(path, subpath, expected):
+    assert path_is_in_subpath(path, subpath) == expected
+
+
 def test_verify_relative_symbolic_links():
     archive_dir = get_directory_with_name("symlink-archive")
 
@@ -174,9 +494,9 @@ def test_verify_relative_symbolic_links():
 
 # MARK: Helpers
 
-def assert_successful_deep_check(archive_path, caplog):
+def assert_successful_deep_check(archive_path, caplog, stream=False):
     expected_output = "Deep integrity check successful."
-    assert_integrity_check_with_output(archive_path, expected_output, True, caplog, DEEP)
+    assert_integrity_check_with_output(archive_path, expected_output, True, caplog, DEEP, stream)
 
 
 def assert_successful_shallow_check(archive_path, caplog):
@@ -184,14 +504,15 @@ def assert_successful_shallow_check(archive_path, caplog):
     assert_integrity_check_with_output(archive_path, expected_output, True, caplog)
 
 
-def assert_integrity_check_with_output(archive_path, expected_output, expected_return, caplog, deep=False):
-    assert check_integrity(archive_path, deep, threads=2) == expected_return
+def assert_integrity_check_with_output(archive_path, expected_output, expected_return, caplog, deep=False, stream=False):
+    assert check_integrity(archive_path, deep, threads=2, stream=stream) == expected_return
 
     assert caplog.messages[-1] == expected_output
 
 
-def check_integrity_and_validate_output_contains(archive_path, caplog, expected_messages, expected_return, deep=False):
-    assert check_integrity(archive_path, deep, threads=2) == expected_return
+def check_integrity_and_validate_output_contains(archive_path, caplog, expected_messages, expected_return, deep=False,
+                                                 stream=False):
+    assert check_integrity(archive_path, deep, threads=2, stream=stream) == expected_return
 
     for message in expected_messages:
         assert message in caplog.messages
@@ -1,6 +1,10 @@
+import shutil
+import subprocess
+
 import pytest
 
 from archiver.listing import create_listing, parse_tar_listing
+from archiver.member_index import create_member_index, get_tar_members
 from tests.helpers import get_directory_with_name, get_listing_with_name, \
     compare_list_content_ignoring_order
 
@@ -140,6 +144,19 @@ def test_list_archive_content_deep_subpath(capsys):
     create_file_listing_and_assert_output_equals(archive_file, expected_listing, capsys, "test-folder/folder-in-archive", DEEP)
 
 
+def test_list_archive_content_deep_subpath_with_member_index(tmp_path, capsys, caplog):
+    archive_dir = tmp_path / "normal-archive"
+    shutil.copytree(get_directory_with_name("normal-archive"), archive_dir)
+    archive_file = archive_dir / "test-folder.tar.lz"
+    tar_file = tmp_path / "test-folder.tar"
+    tar_file.write_bytes(subprocess.run(["plzip", "-d", "-c", archive_file], stdout=subprocess.PIPE, check=True).stdout)
+    create_member_index(archive_file, get_tar_members(tar_file))
+    expected_listing = get_listing_with_name("listing-partial-deep.lst")
+
+    create_file_listing_and_assert_output_equals(archive_file, expected_listing, capsys, "test-folder/folder-in-archive", DEEP)
+    assert "Decompressing 1 of 1 lzip members of test-folder.tar.lz using its member index" in caplog.messages
+
+
 def test_list_archive_content_deep_encrypted_subpath(capsys, setup_gpg):
     archive_file = get_directory_with_name("encrypted-archive") / "test-folder.tar.lz.gpg"
     expected_listing = get_listing_with_name("listing-partial-deep.lst")
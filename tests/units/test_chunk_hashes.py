@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from archiver.chunk_hashes import create_chunk_hash_file, verify_chunk_hashes, get_chunk_hash_path, merge_ranges, \
+    read_chunk_hash_file
+
+
+@pytest.fixture
+def file_with_chunk_hashes(tmp_path):
+    file_path = tmp_path / "archive.tar.lz"
+    file_path.write_bytes(os.urandom(1050))
+    create_chunk_hash_file(file_path, chunk_size=100, algorithm="sha256", workers=3)
+
+    return file_path
+
+
+def overwrite_byte(file_path, offset):
+    with open(file_path, "r+b") as file:
+        file.seek(offset)
+        value = file.read(1)[0]
+        file.seek(offset)
+        file.write(bytes([value ^ 0xff]))
+
+
+def test_chunk_hash_file(file_with_chunk_hashes):
+    algorithm, file_size, _, chunk_ranges, chunk_hashes = read_chunk_hash_file(get_chunk_hash_path(file_with_chunk_hashes))
+
+    assert algorithm == "sha256"
+    assert file_size == 1050
+    assert len(chunk_ranges) == len(chunk_hashes) == 11
+    assert chunk_ranges[-1] == (1000, 50)
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_verify_chunk_hashes(file_with_chunk_hashes, workers):
+    assert verify_chunk_hashes(file_with_chunk_hashes, workers) == []
+
+
+def test_verify_chunk_hashes_corrupted(file_with_chunk_hashes):
+    overwrite_byte(file_with_chunk_hashes, 250)
+    overwrite_byte(file_with_chunk_hashes, 600)
+    overwrite_byte(file_with_chunk_hashes, 799)
+
+    assert verify_chunk_hashes(file_with_chunk_hashes, workers=4) == [(200, 300), (600, 800)]
+
+
+def test_verify_chunk_hashes_truncated(file_with_chunk_hashes):
+    os.truncate(file_with_chunk_hashes, 920)
+
+    assert verify_chunk_hashes(file_with_chunk_hashes, workers=4) == [(900, 1050)]
+
+
+def test_verify_chunk_hashes_appended(file_with_chunk_hashes):
+    with open(file_with_chunk_hashes, "ab") as file:
+        file.write(b"appended")
+
+    assert verify_chunk_hashes(file_with_chunk_hashes, workers=4) == [(1050, 1058)]
+
+
+def test_verify_chunk_hashes_corrupted_sidecar(file_with_chunk_hashes, caplog):
+    chunk_hash_path = get_chunk_hash_path(file_with_chunk_hashes)
+    lines = chunk_hash_path.read_text().splitlines()
+    offset, length, _ = lines[3].split()
+    lines[3] = f"{offset} {length} {'0' * 64}"
+    chunk_hash_path.write_text("\n".join(lines) + "\n")
+
+    assert verify_chunk_hashes(file_with_chunk_hashes) == [(0, 1050)]
+    assert f"Root hash of chunk hash file {chunk_hash_path} does not match its chunk hashes." in caplog.messages
+
+
+def test_merge_ranges():
+    assert merge_ranges([(5, 6), (0, 2), (2, 3), (7, 9), (8, 10)]) == [(0, 3), (5, 6), (7, 10)]
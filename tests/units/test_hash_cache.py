@@ -0,0 +1,85 @@
+import hashlib
+import os
+import time
+
+from archiver import hash_cache
+from archiver.hash_cache import HashCache
+
+
+def _make_old_file(path, content):
+    path.write_bytes(content)
+    # make sure the file isn't considered as recently modified
+    one_hour_ago = time.time() - 3600
+    os.utime(path, (one_hour_ago, one_hour_ago))
+    return path
+
+
+def _hash_with_cache(cache, paths):
+    return cache.hash_files(paths, [p.lstat() for p in paths])
+
+
+def test_hash_cache_hit_and_persistence(tmp_path):
+    db_path = tmp_path / "cache.sqlite"
+    file_path = _make_old_file(tmp_path / "file", b"content")
+
+    with HashCache(db_path) as cache:
+        assert cache.lookup([file_path.lstat()]) == [None]
+        assert _hash_with_cache(cache, [file_path]) == [hashlib.md5(b"content").hexdigest()]
+
+    with HashCache(db_path) as cache:
+        assert cache.lookup([file_path.lstat()]) == [hashlib.md5(b"content").hexdigest()]
+
+
+def test_hash_cache_invalidated_by_modification(tmp_path):
+    file_path = _make_old_file(tmp_path / "file", b"content")
+
+    with HashCache(tmp_path / "cache.sqlite") as cache:
+        _hash_with_cache(cache, [file_path])
+
+        # same size and mtime, but ctime changes
+        stat_before = file_path.lstat()
+        file_path.write_bytes(b"CONTENT")
+        os.utime(file_path, ns=(stat_before.st_atime_ns, stat_before.st_mtime_ns))
+
+        assert cache.lookup([file_path.lstat()]) == [None]
+        assert _hash_with_cache(cache, [file_path]) == [hashlib.md5(b"CONTENT").hexdigest()]
+
+
+def test_hash_cache_skips_racy_files(tmp_path):
+    file_path = tmp_path / "file"
+    file_path.write_bytes(b"content")
+
+    with HashCache(tmp_path / "cache.sqlite") as cache:
+        assert _hash_with_cache(cache, [file_path]) == [hashlib.md5(b"content").hexdigest()]
+        assert cache.lookup([file_path.lstat()]) == [None]
+
+
+def test_hash_cache_evicts_least_recently_used(tmp_path):
+    paths = [_make_old_file(tmp_path / f"file_{i}", f"content {i}".encode()) for i in range(3)]
+
+    with HashCache(tmp_path / "cache.sqlite", max_entries=2) as cache:
+        _hash_with_cache(cache, paths[:2])
+        time.sleep(0.01)
+        cache.lookup([paths[0].lstat()])
+        time.sleep(0.01)
+        _hash_with_cache(cache, paths[2:])
+
+    with HashCache(tmp_path / "cache.sqlite") as cache:
+        hits = [h is not None for h in cache.lookup([p.lstat() for p in paths])]
+
+    assert hits == [True, False, True]
+
+
+def test_hash_cache_lookup_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(hash_cache, "HASH_CACHE_LOOKUP_BATCH", 2)
+    paths = [_make_old_file(tmp_path / f"file_{i}", f"content {i}".encode()) for i in range(5)]
+
+    with HashCache(tmp_path / "cache.sqlite") as cache:
+        _hash_with_cache(cache, paths[1:4])
+        # entries of other algorithms and the same file given twice
+        with HashCache(tmp_path / "cache.sqlite", algorithm="sha256") as other_cache:
+            _hash_with_cache(other_cache, paths)
+
+        assert cache.lookup([p.lstat() for p in paths + paths[1:2]]) == \
+            [None] + [hashlib.md5(f"content {i}".encode()).hexdigest() for i in range(1, 4)] + [None] + \
+            [hashlib.md5(b"content 1").hexdigest()]
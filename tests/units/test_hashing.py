@@ -0,0 +1,98 @@
+import hashlib
+import os
+import time
+
+import pytest
+
+from archiver import hashing
+from archiver.hashing import hash_files
+
+
+@pytest.fixture
+def files_of_mixed_sizes(tmp_path):
+    paths = []
+    contents = []
+
+    for i in range(50):
+        contents.append(f"small file {i}".encode())
+    for i in range(2):
+        contents.append(os.urandom(hashing.SMALL_FILE_BYTE_SIZE + i))
+
+    for i, content in enumerate(contents):
+        path = tmp_path / f"file_{i}"
+        path.write_bytes(content)
+        paths.append(path)
+
+    link = tmp_path / "link"
+    link.symlink_to("file_0")
+    paths.append(link)
+    contents.append(b"file_0")
+
+    sizes = [p.lstat().st_size for p in paths]
+    expected = [hashlib.md5(c).hexdigest() for c in contents]
+
+    return paths, sizes, expected
+
+
+@pytest.mark.parametrize("max_workers", [1, 3])
+def test_hash_files(files_of_mixed_sizes, max_workers):
+    paths, sizes, expected = files_of_mixed_sizes
+
+    assert hash_files(paths, sizes, max_workers) == expected
+
+
+def test_hash_files_in_batches(files_of_mixed_sizes, monkeypatch):
+    paths, sizes, expected = files_of_mixed_sizes
+
+    # force several batches s.t. small files are hashed by the process pool
+    monkeypatch.setattr(hashing, "HASH_BATCH_FILE_COUNT", 7)
+
+    assert hash_files(paths, sizes, max_workers=3) == expected
+
+
+def test_hash_files_small_and_large_files_concurrently(files_of_mixed_sizes, monkeypatch, tmp_path):
+    paths, sizes, expected = files_of_mixed_sizes
+    small_file_hashed = tmp_path / "small-file-hashed"
+    get_file_hash_from_path = hashing.get_file_hash_from_path
+    seen_by_large_files = []
+
+    def wait_for_small_files(file_path, algorithm):
+        # small files are hashed in the pool's processes, large files in threads of this process
+        if file_path.lstat().st_size < hashing.SMALL_FILE_BYTE_SIZE:
+            small_file_hashed.touch()
+        else:
+            deadline = time.monotonic() + 10
+            while not small_file_hashed.exists() and time.monotonic() < deadline:
+                time.sleep(0.01)
+            seen_by_large_files.append(small_file_hashed.exists())
+
+        return get_file_hash_from_path(file_path, algorithm)
+
+    monkeypatch.setattr(hashing, "HASH_BATCH_FILE_COUNT", 7)
+    monkeypatch.setattr(hashing, "get_file_hash_from_path", wait_for_small_files)
+
+    assert hash_files(paths, sizes, max_workers=3) == expected
+    assert seen_by_large_files == [True, True]
+
+
+def test_split_into_batches(monkeypatch):
+    monkeypatch.setattr(hashing, "HASH_BATCH_FILE_COUNT", 3)
+    monkeypatch.setattr(hashing, "HASH_BATCH_BYTE_SIZE", 100)
+
+    sizes = [10, 10, 10, 10, 60, 50, 1000, 1]
+
+    assert hashing._split_into_batches(range(len(sizes)), sizes) == [[0, 1, 2], [3, 4], [5], [6], [7]]
+
+
+@pytest.mark.parametrize("algorithm", ["sha256", "blake2b"])
+def test_hash_files_with_algorithm(files_of_mixed_sizes, algorithm):
+    paths, sizes, _ = files_of_mixed_sizes
+    expected = [hashlib.new(algorithm, p.read_bytes() if not p.is_symlink() else os.readlink(p).encode()).hexdigest()
+                for p in paths]
+
+    assert hash_files(paths, sizes, max_workers=3, algorithm=algorithm) == expected
+
+
+def test_get_hasher_unknown_algorithm():
+    with pytest.raises(ValueError):
+        hashing.get_hasher("crc32")
@@ -0,0 +1,72 @@
+import os
+
+from archiver.journal import CheckJournal, ExtractionJournal, get_check_journal_path, get_extraction_journal_path
+
+
+def test_check_journal_resume(tmp_path):
+    journal_path = get_check_journal_path(tmp_path, tmp_path / "archive")
+    part1, part2 = tmp_path / "archive.part1.tar.lz", tmp_path / "archive.part2.tar.lz"
+    part1.write_bytes(b"part1")
+    part2.write_bytes(b"part2")
+
+    with CheckJournal(journal_path) as journal:
+        journal.record_part(part1, "deep", True)
+        journal.record_part(part2, "deep", False)
+        journal.record_members(part2, "deep", [["a.txt", "hash-a"]])
+        journal.record_members(part2, "deep", [["b.txt", "hash-b"]])
+
+    with CheckJournal(journal_path, resume=True) as journal:
+        assert journal.get_part_result(part1, "deep") is True
+        assert journal.get_part_result(part2, "deep") is False
+        assert journal.get_part_result(part1, "medium") is None
+        assert journal.get_member_hashes(part2, "deep") == {"a.txt": "hash-a", "b.txt": "hash-b"}
+
+    # without resume, a new check starts from the beginning
+    with CheckJournal(journal_path) as journal:
+        assert journal.get_part_result(part1, "deep") is None
+
+    with CheckJournal(journal_path, resume=True) as journal:
+        assert journal.get_part_result(part1, "deep") is None
+
+
+def test_check_journal_ignores_modified_parts_and_truncated_lines(tmp_path):
+    journal_path = tmp_path / "journal.jsonl"
+    part = tmp_path / "archive.tar.lz"
+    part.write_bytes(b"part")
+
+    with CheckJournal(journal_path) as journal:
+        journal.record_part(part, "deep", True)
+
+    # the process was killed while writing a line
+    with open(journal_path, "a") as file:
+        file.write('{"part": "')
+
+    with CheckJournal(journal_path, resume=True) as journal:
+        assert journal.get_part_result(part, "deep") is True
+        journal.record_part(part, "medium", True)
+
+    with CheckJournal(journal_path, resume=True) as journal:
+        assert journal.get_part_result(part, "medium") is True
+
+    os.utime(part, ns=(0, 0))
+    with CheckJournal(journal_path, resume=True) as journal:
+        assert journal.get_part_result(part, "deep") is None
+
+
+def test_extraction_journal_resume(tmp_path):
+    journal_path = get_extraction_journal_path(tmp_path)
+    part1, part2 = tmp_path / "archive.part1.tar.lz", tmp_path / "archive.part2.tar.lz"
+    part1.write_bytes(b"part1")
+    part2.write_bytes(b"part2")
+
+    with ExtractionJournal(journal_path) as journal:
+        journal.record_part_done(part1, "all")
+        journal.record_last_member(part2, "all", "folder/a.txt")
+        journal.record_last_member(part2, "all", "folder/b.txt")
+
+    with ExtractionJournal(journal_path, resume=True) as journal:
+        assert journal.is_part_done(part1, "all")
+        assert not journal.is_part_done(part2, "all")
+        assert not journal.is_part_done(part1, "selection-0123456789abcdef")
+        assert journal.get_last_member(part2, "all") == "folder/b.txt"
+        assert journal.get_last_member(part1, "all") is None
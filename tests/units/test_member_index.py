@@ -0,0 +1,160 @@
+import io
+import struct
+import tarfile
+
+import pytest
+
+from archiver.member_index import LzipMemberScanner, read_lzip_members, get_tar_members, get_selected_ranges, \
+    create_member_index, read_member_index, get_member_index_path, load_member_index, _get_decoding_jobs, MemberIndex, \
+    find_member_index_path, record_tar_members, pop_tar_members
+from archiver.streaming import hash_tar_members
+
+
+def fake_lzip_member(data_size, member_size):
+    """Header and trailer of an lzip member, the compressed data in between is just filler"""
+    header = b"LZIP\x01\x0c"
+    trailer = struct.pack("<IQQ", 0, data_size, member_size)
+
+    return header + b"\xaa" * (member_size - len(header) - len(trailer)) + trailer
+
+
+@pytest.fixture
+def lzip_file(tmp_path):
+    path = tmp_path / "archive.tar.lz"
+    # the filler of the second member contains a magic, which isn't the start of a member
+    path.write_bytes(fake_lzip_member(5000, 100) + fake_lzip_member(5000, 60).replace(b"\xaa" * 6, b"LZIP\x01\x0c", 1) +
+                     fake_lzip_member(2000, 40))
+
+    return path
+
+
+def test_read_lzip_members(lzip_file):
+    assert read_lzip_members(lzip_file) == ([(0, 0), (100, 5000), (160, 10000)], 12000)
+
+
+@pytest.mark.parametrize("write_size", [1, 3, 7, 1000])
+def test_lzip_member_scanner(lzip_file, write_size):
+    data = lzip_file.read_bytes()
+    scanner = LzipMemberScanner()
+    for offset in range(0, len(data), write_size):
+        scanner.write(data[offset:offset + write_size])
+
+    assert scanner.get_lzip_members() == read_lzip_members(lzip_file)
+
+
+def test_read_lzip_members_invalid(lzip_file):
+    with open(lzip_file, "ab") as file:
+        file.write(b"trailing garbage")
+
+    with pytest.raises(ValueError):
+        read_lzip_members(lzip_file)
+
+
+@pytest.fixture
+def tar_file(tmp_path):
+    path = tmp_path / "archive.tar"
+
+    with tarfile.open(path, "w", format=tarfile.PAX_FORMAT) as tar:
+        for name, content in [("folder/a.txt", b"a" * 700), ("folder/" + "long-name" * 20, b"b"),
+                              ("other/new\nline.txt", b""), ("folder/c.txt", b"c" * 1024)]:
+            member = tarfile.TarInfo(name)
+            member.size = len(content)
+            tar.addfile(member, io.BytesIO(content))
+
+    return path
+
+
+def test_tar_member_ranges_contain_members(tar_file):
+    data = tar_file.read_bytes()
+    tar_members = get_tar_members(tar_file)
+
+    assert [path for _, _, path in tar_members] == \
+           ["folder/a.txt", "folder/" + "long-name" * 20, "other/new\nline.txt", "folder/c.txt"]
+
+    # a range and the end-of-archive blocks are a tar archive on their own
+    for offset, end, path in tar_members:
+        with tarfile.open(fileobj=io.BytesIO(data[offset:end] + b"\0" * 1024)) as tar:
+            assert tar.getnames() == [path]
+
+
+def test_recorded_tar_members(tar_file):
+    with open(tar_file, "rb") as stream, record_tar_members(tar_file) as record_member:
+        for _ in hash_tar_members(stream, on_member=record_member):
+            pass
+    members_path = tar_file.parent / "archive.tar.members"
+    assert members_path.is_file()
+
+    assert pop_tar_members(tar_file) == get_tar_members(tar_file)
+    assert not members_path.exists()
+    # without members recorded, the archive is read
+    assert pop_tar_members(tar_file) == get_tar_members(tar_file)
+
+
+def test_member_index_roundtrip(tar_file, lzip_file):
+    tar_members = get_tar_members(tar_file)
+    create_member_index(lzip_file, tar_members)
+
+    index = read_member_index(get_member_index_path(lzip_file))
+
+    assert index.tar_size == 12000
+    assert index.compressed_size == lzip_file.stat().st_size
+    assert index.lzip_members == [(0, 0), (100, 5000), (160, 10000)]
+    assert index.tar_members == tar_members
+
+
+def test_member_index_of_encrypted_archive(tar_file, lzip_file):
+    encrypted_path = lzip_file.parent / "archive.tar.lz.gpg"
+    assert get_member_index_path(encrypted_path) == lzip_file.parent / "archive.tar.lz.gpg.idx"
+
+    # the index of the .tar.lz next to it is used, unless there is one named after the encrypted archive
+    create_member_index(lzip_file, get_tar_members(tar_file))
+    assert find_member_index_path(encrypted_path) == lzip_file.parent / "archive.tar.lz.idx"
+
+    create_member_index(lzip_file, get_tar_members(tar_file), archive_path=encrypted_path)
+    assert find_member_index_path(encrypted_path) == lzip_file.parent / "archive.tar.lz.gpg.idx"
+    assert find_member_index_path(lzip_file.parent / "other.tar.lz.gpg") is None
+
+
+def test_member_index_outdated(tar_file, lzip_file, caplog):
+    create_member_index(lzip_file, get_tar_members(tar_file))
+    with open(lzip_file, "ab") as file:
+        file.write(fake_lzip_member(10, 30))
+
+    assert load_member_index(lzip_file) is None
+    assert any(message.startswith("Ignoring member index") for message in caplog.messages)
+
+
+def test_selected_ranges_and_decoding_jobs(tar_file, lzip_file):
+    tar_members = get_tar_members(tar_file)
+    create_member_index(lzip_file, tar_members)
+    index = read_member_index(get_member_index_path(lzip_file))
+
+    # adjacent members are merged into one range
+    ranges = get_selected_ranges(index, lambda path: path.startswith("folder/"))
+    assert ranges == [(tar_members[0][0], tar_members[1][1]), (tar_members[3][0], tar_members[3][1])]
+
+    # ranges within the same or adjacent lzip members are decompressed together
+    assert _get_decoding_jobs(index, [(0, 10), (4900, 5100)]) == [[0, 1, [(0, 10), (4900, 5100)]]]
+    assert _get_decoding_jobs(index, [(0, 10), (10100, 10200)]) == [[0, 0, [(0, 10)]], [2, 2, [(10100, 10200)]]]
+
+
+def test_selected_ranges_include_global_headers(tmp_path):
+    tar_path = tmp_path / "global-headers.tar"
+    with tarfile.open(tar_path, "w", format=tarfile.PAX_FORMAT, pax_headers={"comment": "global"}) as tar:
+        for name in ["a.txt", "b.txt"]:
+            info = tarfile.TarInfo(name)
+            info.size = 4
+            tar.addfile(info, io.BytesIO(b"data"))
+    tar_members = get_tar_members(tar_path)
+    index = MemberIndex(tar_path.stat().st_size, 0, [(0, 0)], tar_members)
+
+    # the global header precedes the first member, but isn't part of its range
+    ranges = get_selected_ranges(index, {"b.txt"}.__contains__)
+    assert ranges == [(0, tar_members[0][0]), tar_members[1][:2]]
+    assert get_selected_ranges(index, lambda path: False) == []
+
+    tar_data = tar_path.read_bytes()
+    with tarfile.open(fileobj=io.BytesIO(b"".join(tar_data[start:end] for start, end in ranges) + b"\0" * 1024)) as tar:
+        member = tar.next()
+        assert member.name == "b.txt"
+        assert member.pax_headers == {"comment": "global"}
@@ -0,0 +1,62 @@
+import pytest
+
+from archiver.listing import MemberSelection, plan_extraction
+from tests import helpers
+
+
+def test_member_selection_matches_paths_and_parents():
+    selection = MemberSelection(["./folder/sub/", "file.txt"])
+
+    assert selection.matches("folder/sub")
+    assert selection.matches("folder/sub/nested/file.txt")
+    assert selection.matches("file.txt")
+    assert not selection.matches("folder")
+    assert not selection.matches("folder/sub-other")
+    assert not selection.matches("other/file.txt")
+
+
+def test_member_selection_matches_patterns_like_tar():
+    selection = MemberSelection(None, ["folder/*.csv", "data[0-9]"])
+
+    # as with tar, * matches / and a directory selects its contents
+    assert selection.matches("folder/a.csv")
+    assert selection.matches("folder/nested/a.csv")
+    assert selection.matches("data1/file.txt")
+    assert not selection.matches("folder/a.csv.gz")
+    assert not selection.matches("other/folder/a.csv")
+
+
+def test_member_selection_matching_selectors():
+    selection = MemberSelection(["folder", "folder"], ["*.txt", "folder/*"])
+
+    assert selection.paths == ["folder"]
+    assert selection.get_matching_selectors("folder/file.txt") == \
+        [("pattern", "*.txt"), ("pattern", "folder/*"), ("path", "folder")]
+    assert str(selection.restricted_to({("pattern", "*.txt")})) == "*.txt"
+
+
+def test_member_selection_tar_arguments(tmp_path):
+    selection = MemberSelection(["-folder", "a\\b*"], ["*.txt"])
+
+    arguments = selection.write_tar_arguments(tmp_path)
+
+    assert arguments == ["--no-wildcards", "--verbatim-files-from", "--files-from", tmp_path / "paths.txt",
+                         "--wildcards", "--verbatim-files-from", "--files-from", tmp_path / "patterns.txt"]
+    assert (tmp_path / "paths.txt").read_text() == "-folder\na\\b*\n"
+    assert (tmp_path / "patterns.txt").read_text() == "*.txt\n"
+
+
+def test_plan_extraction():
+    archive_path = helpers.get_directory_with_name("split-archive")
+
+    plan = plan_extraction(archive_path, MemberSelection(["large-folder/file_b.txt"], ["*/sub*", "large-*"]))
+
+    assert sorted(plan) == ["large-folder.part1", "large-folder.part2", "large-folder.part3"]
+    assert plan["large-folder.part1"].patterns == ["*/sub*", "large-*"]
+    assert plan["large-folder.part2"].get_selectors() == [("pattern", "large-*")]
+    assert plan["large-folder.part3"].get_selectors() == [("path", "large-folder/file_b.txt"), ("pattern", "large-*")]
+
+
+def test_plan_extraction_nothing_found():
+    with pytest.raises(SystemExit):
+        plan_extraction(helpers.get_directory_with_name("split-archive"), MemberSelection(["missing"]))
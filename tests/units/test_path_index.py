@@ -0,0 +1,93 @@
+from array import array
+
+import pytest
+
+from archiver.path_index import ArchivePathIndex
+
+
+@pytest.fixture
+def path_index():
+    # small runs, s.t. merging of several runs is tested as well
+    index = ArchivePathIndex(run_length=3)
+
+    for path, link_target in [
+        ("root/", None),
+        ("root/data/raw/file.txt", None),
+        ("root/data/raw/other.txt", None),
+        ("root/link-to-file", "data/raw/file.txt"),
+        ("root/link-to-link", "link-to-file"),
+        ("root/link-to-dir", "data/raw"),
+        ("root/data/up", "../link-to-dir/../raw/other.txt"),
+        ("root/loop-a", "loop-b"),
+        ("root/loop-b", "loop-a"),
+        ("./root/dotted.txt", None),
+    ]:
+        index.add(path, link_target)
+    index.freeze()
+
+    return index
+
+
+def test_path_index_contains(path_index):
+    assert "root/data/raw/file.txt" in path_index
+    assert "root/dotted.txt" in path_index
+    # parent directories are added implicitly
+    assert "root/data/raw" in path_index
+    assert "root/data/" in path_index
+    assert "root/data/cooked" not in path_index
+    assert len(path_index.keys) == len(set(path_index.keys))
+
+
+@pytest.mark.parametrize("link_path,link_target,expected", [
+    ("root/link-to-file", "data/raw/file.txt", "root/data/raw/file.txt"),
+    ("root/link-to-link", "link-to-file", "root/data/raw/file.txt"),
+    ("root/new-link", "link-to-dir/other.txt", "root/data/raw/other.txt"),
+    ("root/data/up", "../link-to-dir/../raw/other.txt", "root/data/raw/other.txt"),
+    ("root/data/raw/escape", "../../../../outside", None),
+    ("root/loop-a", "loop-b", None),
+    ("root/absolute", "/etc/passwd", None),
+])
+def test_path_index_resolve_link(path_index, link_path, link_target, expected):
+    assert path_index.resolve_link(link_path, link_target) == expected
+
+
+@pytest.mark.parametrize("link_path,link_target,expected", [
+    ("root/link-to-dir", "data/raw", True),
+    ("root/broken", "data/raw/missing.txt", False),
+    ("root/broken-through-dir", "link-to-dir/missing.txt", False),
+    ("root/loop-a", "loop-b", False),
+])
+def test_path_index_link_target_exists(path_index, link_path, link_target, expected):
+    assert path_index.link_target_exists(link_path, link_target) == expected
+
+
+def test_path_index_packs_link_targets(path_index):
+    # the targets of the 6 links are merged from several runs into sorted arrays and a single blob
+    link_targets = path_index.symlink_targets
+    assert isinstance(link_targets.keys, array) and list(link_targets.keys) == sorted(link_targets.keys)
+    assert len(link_targets.keys) == 6
+    assert len(link_targets.targets) == link_targets.offsets[-1]
+    assert path_index.resolve_link("root/new-link", "link-to-link") == "root/data/raw/file.txt"
+
+
+@pytest.mark.parametrize("link_path,link_target,expected", [
+    ("root/link-to-dir", "data/raw", True),
+    ("root/link-to-link-to-dir", "link-to-dir", True),
+    ("root/link-to-root", "..", True),
+    ("root/link-to-file", "data/raw/file.txt", False),
+    ("root/broken", "data/raw/missing", False),
+    ("root/absolute", "/etc", False),
+])
+def test_path_index_link_points_to_directory(path_index, link_path, link_target, expected):
+    assert path_index.link_points_to_directory(link_path, link_target) == expected
+
+
+def test_path_index_explicit_directories():
+    index = ArchivePathIndex(run_length=2)
+    index.add("root/empty-dir/", is_directory=True)
+    index.add("root/file.txt")
+    index.freeze()
+
+    assert index.is_directory("root/empty-dir")
+    assert index.is_directory("root")
+    assert not index.is_directory("root/file.txt")
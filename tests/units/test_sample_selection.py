@@ -0,0 +1,43 @@
+import random
+
+import pytest
+
+from archiver.helpers import get_sample_size_from_string
+from archiver.integrity import select_sample
+
+PATHS = [f"folder/file{i}.txt" for i in range(100)]
+
+
+def test_select_sample_reproducible():
+    sample = select_sample(PATHS, ("files", 10), random.Random("seed"))
+
+    assert len(sample) == len(set(sample)) == 10
+    assert select_sample(reversed(PATHS), ("files", 10), random.Random("seed")) == sample
+    assert select_sample(PATHS, ("files", 10), random.Random("other seed")) != sample
+
+
+@pytest.mark.parametrize("sample_size,expected_length", [
+    (("files", 1000), 100),
+    (("fraction", 0.05), 5),
+    (("fraction", 0.001), 1),
+    (("bytes", 250), 3),
+])
+def test_select_sample_size(sample_size, expected_length):
+    file_sizes = {path: 100 for path in PATHS}
+
+    assert len(select_sample(PATHS, sample_size, random.Random(0), file_sizes)) == expected_length
+
+
+@pytest.mark.parametrize("sample_string,expected", [
+    ("100", ("files", 100)),
+    ("5%", ("fraction", 0.05)),
+    ("2K", ("bytes", 2048)),
+])
+def test_get_sample_size_from_string(sample_string, expected):
+    assert get_sample_size_from_string(sample_string) == expected
+
+
+@pytest.mark.parametrize("sample_string", ["0", "0%", "120%", "many"])
+def test_get_sample_size_from_string_invalid(sample_string):
+    with pytest.raises(ValueError):
+        get_sample_size_from_string(sample_string)
@@ -0,0 +1,105 @@
+import sqlite3
+
+import pytest
+
+from archiver.helpers import create_and_write_file_hash
+from archiver.scrub import scrub, find_archive_parts
+
+
+@pytest.fixture
+def archive_store(tmp_path):
+    """Three archive directories with fake archive files of 100 bytes each, one of them split in two parts"""
+    root_path = tmp_path / "store"
+
+    for archive_files in [["a.tar.lz"], ["b.part1.tar.lz", "b.part2.tar.lz"], ["c.tar.lz"]]:
+        archive_dir = root_path / archive_files[0].split(".")[0]
+        archive_dir.mkdir(parents=True)
+        for archive_file in archive_files:
+            (archive_dir / archive_file).write_bytes(archive_file.encode().ljust(100, b"\0"))
+            create_and_write_file_hash(archive_dir / archive_file)
+
+    return root_path
+
+
+def get_checked_parts(ledger_path):
+    with sqlite3.connect(ledger_path) as connection:
+        return {row[0].split("/")[-1]: row[1:] for row in
+                connection.execute("SELECT path, nr_checks, last_result FROM parts WHERE nr_checks > 0")}
+
+
+def test_find_archive_parts_prefers_encrypted(archive_store):
+    (archive_store / "a" / "a.tar.lz.gpg").write_bytes(b"encrypted")
+
+    assert [p[0].name for p in find_archive_parts(archive_store)] == \
+           ["a.tar.lz.gpg", "b.part1.tar.lz", "b.part2.tar.lz", "c.tar.lz"]
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_scrub_all_parts(archive_store, tmp_path, workers):
+    ledger_path = tmp_path / "ledger.sqlite"
+
+    assert scrub(archive_store, ledger_path, workers)
+    assert get_checked_parts(ledger_path) == {name: (1, "ok") for name in
+                                              ["a.tar.lz", "b.part1.tar.lz", "b.part2.tar.lz", "c.tar.lz"]}
+
+
+def test_scrub_byte_budget_least_recently_checked_first(archive_store, tmp_path):
+    ledger_path = tmp_path / "ledger.sqlite"
+
+    assert scrub(archive_store, ledger_path, max_bytes=250)
+    assert set(get_checked_parts(ledger_path)) == {"a.tar.lz", "b.part1.tar.lz"}
+
+    assert scrub(archive_store, ledger_path, max_bytes=250)
+    assert get_checked_parts(ledger_path) == {name: (1, "ok") for name in
+                                              ["a.tar.lz", "b.part1.tar.lz", "b.part2.tar.lz", "c.tar.lz"]}
+
+    # the budget is smaller than a single part, but at least one part is always checked
+    assert scrub(archive_store, ledger_path, max_bytes=10)
+    assert get_checked_parts(ledger_path)["a.tar.lz"] == (2, "ok")
+
+
+def test_scrub_time_budget(archive_store, tmp_path):
+    ledger_path = tmp_path / "ledger.sqlite"
+
+    assert scrub(archive_store, ledger_path, max_seconds=0)
+    assert get_checked_parts(ledger_path) == {}
+
+
+def test_scrub_corrupted_and_missing_parts(archive_store, tmp_path, caplog):
+    ledger_path = tmp_path / "ledger.sqlite"
+    assert scrub(archive_store, ledger_path)
+
+    (archive_store / "b" / "b.part2.tar.lz").write_bytes(b"corrupted")
+    (archive_store / "c" / "c.tar.lz.md5").unlink()
+    (archive_store / "a" / "a.tar.lz").unlink()
+    (archive_store / "a" / "a.tar.lz.md5").unlink()
+
+    assert not scrub(archive_store, ledger_path)
+
+    checked_parts = get_checked_parts(ledger_path)
+    assert checked_parts["b.part1.tar.lz"] == (2, "ok")
+    assert checked_parts["b.part2.tar.lz"] == (2, "failed")
+    assert checked_parts["c.tar.lz"] == (2, "missing-hash")
+    assert checked_parts["a.tar.lz"] == (2, "missing")
+    assert f"Archive part {archive_store.absolute() / 'a' / 'a.tar.lz'} was verified before, but does not exist anymore." \
+           in caplog.messages
+
+
+def test_scrub_missing_parts_reported_once(archive_store, tmp_path, caplog):
+    ledger_path = tmp_path / "ledger.sqlite"
+    assert scrub(archive_store, ledger_path)
+
+    for path in (archive_store / "a").iterdir():
+        path.unlink()
+    assert not scrub(archive_store, ledger_path)
+
+    # the part is recorded as missing, later runs don't fail because of it
+    caplog.clear()
+    assert scrub(archive_store, ledger_path)
+    assert "1 archive parts have been missing since earlier runs, use --forget-missing to remove them from the ledger" \
+           in caplog.messages
+    assert get_checked_parts(ledger_path)["a.tar.lz"] == (2, "missing")
+
+    assert scrub(archive_store, ledger_path, forget_missing=True)
+    assert "Removing 1 archive parts which don't exist anymore from the ledger" in caplog.messages
+    assert "a.tar.lz" not in get_checked_parts(ledger_path)
@@ -2,9 +2,11 @@ import pytest
 import os
 from pathlib import Path
 
-from archiver.splitter import split_directory
-from archiver.helpers import get_size_of_path
-from tests.helpers import generate_splitting_directory, flatten_nested_list, compare_list_content_ignoring_order
+from archiver.splitter import split_directory, build_size_tree, get_files_with_stats, plan_parts, \
+    CompressedSizeEstimator, _sample_compression_ratio
+from archiver.helpers import get_size_of_path, get_files_in_folder
+from tests.helpers import generate_splitting_directory, flatten_nested_list, compare_list_content_ignoring_order, \
+    create_file_with_size
 
 
 def test_split_archive(generate_splitting_directory):
@@ -35,6 +37,102 @@ def test_split_archive_invalid_inputs(generate_splitting_directory):
         split_directory()
 
 
+def test_size_tree_sizes_match_du(generate_splitting_directory):
+    size_tree = build_size_tree(generate_splitting_directory)
+
+    assert size_tree.size == get_size_of_path(generate_splitting_directory)
+    for name in ["subfolder-large", "subfolder-small"]:
+        assert size_tree.children[name].size == get_size_of_path(generate_splitting_directory / name)
+
+
+def test_get_files_with_stats(generate_splitting_directory):
+    size_tree = build_size_tree(generate_splitting_directory)
+    paths = [generate_splitting_directory / "subfolder-large", generate_splitting_directory / "file_a.txt"]
+
+    files, file_stats = get_files_with_stats(size_tree, generate_splitting_directory, paths)
+
+    expected_files = get_files_in_folder(paths[0]) + [paths[1]]
+    compare_list_content_ignoring_order(files, expected_files)
+    assert [s.st_size for s in file_stats] == [f.stat().st_size for f in files]
+
+
+@pytest.fixture
+def directory_with_equal_files(tmp_path):
+    source_path = tmp_path / "equal-files"
+    (source_path / "folder").mkdir(parents=True)
+    for index in range(10):
+        create_file_with_size(source_path / "folder" / f"file_{index}.txt", 1000 * 10)
+
+    return source_path
+
+
+def test_plan_parts_balanced(directory_with_equal_files):
+    # greedy packing would yield parts with 9 and 1 files
+    max_size = 1000 * 10 * 9
+
+    parts = plan_parts(directory_with_equal_files, max_size, balanced=True)
+
+    assert len(parts) == 2
+    assert sorted(len(part) for part in parts) == [5, 5]
+    assert size_of_all_parts_below_maximum(parts, max_size)
+
+
+def test_plan_parts_keeps_directories(directory_with_equal_files):
+    parts = plan_parts(directory_with_equal_files, 1000 * 1000, balanced=True)
+
+    assert relative_strings_from_archives_list(parts, directory_with_equal_files) == [["folder"]]
+
+
+def test_plan_parts_max_files(directory_with_equal_files):
+    parts = plan_parts(directory_with_equal_files, 1000 * 1000, max_files=3, balanced=True)
+
+    files_per_part = [len(get_files_with_stats(build_size_tree(directory_with_equal_files), directory_with_equal_files, part)[0])
+                      for part in parts]
+    assert len(parts) == 4
+    assert max(files_per_part) <= 3
+    assert sum(files_per_part) == 10
+
+
+def test_plan_parts_same_content_as_greedy(generate_splitting_directory):
+    max_size = 1000 * 1000 * 50
+    size_tree = build_size_tree(generate_splitting_directory)
+    greedy_parts = split_directory(generate_splitting_directory, max_size)
+    greedy_files = get_files_with_stats(size_tree, generate_splitting_directory, flatten_nested_list(greedy_parts))[0]
+
+    parts = plan_parts(generate_splitting_directory, max_size, balanced=True)
+    planned_files = get_files_with_stats(size_tree, generate_splitting_directory, flatten_nested_list(parts))[0]
+
+    assert len(parts) == 2
+    assert size_of_all_parts_below_maximum(parts, max_size)
+    compare_list_content_ignoring_order(planned_files, greedy_files)
+
+
+def test_plan_parts_compressed_size(generate_splitting_directory):
+    max_size = 1000 * 1000 * 50
+    size_tree = build_size_tree(generate_splitting_directory)
+
+    # the zero-filled test files compress extremely well
+    estimator = CompressedSizeEstimator(generate_splitting_directory, size_tree, 6)
+    assert estimator.get_directory_size(size_tree) < size_tree.size / 100
+
+    raw_parts = plan_parts(generate_splitting_directory, max_size, size_tree=size_tree)
+    compressed_parts = plan_parts(generate_splitting_directory, max_size, size_tree=size_tree, compression=6)
+
+    assert len(raw_parts) == 2
+    assert len(compressed_parts) == 1
+
+
+def test_sample_compression_ratio(tmp_path):
+    random_file = tmp_path / "random"
+    random_file.write_bytes(os.urandom(1000 * 100))
+    zero_file = tmp_path / "zeros"
+    create_file_with_size(zero_file, 1000 * 100)
+
+    assert _sample_compression_ratio([random_file], 6) > 0.95
+    assert _sample_compression_ratio([zero_file], 6) < 0.05
+    assert _sample_compression_ratio([], 6) == 1.0
+
+
 # MARK: Test helpers
 
 def assert_archiving_splitting(path, max_size, expected_result):
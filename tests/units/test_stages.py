@@ -0,0 +1,68 @@
+import threading
+import time
+
+import pytest
+
+from archiver.stages import run_stages, IO, CPU
+
+
+def test_run_stages_runs_stages_in_order():
+    done = []
+    lock = threading.Lock()
+
+    def record(name):
+        def stage(item):
+            with lock:
+                done.append((item, name))
+        return stage
+
+    stages = [("a", record("a"), IO), ("b", record("b"), CPU), ("c", record("c"), IO)]
+    run_stages(range(5), stages, {IO: 2, CPU: 1})
+
+    assert len(done) == 15
+    for item in range(5):
+        assert [name for i, name in done if i == item] == ["a", "b", "c"]
+
+
+def test_run_stages_respects_worker_limits_and_overlaps():
+    running = {IO: 0, CPU: 0}
+    max_running = {IO: 0, CPU: 0}
+    overlapped = threading.Event()
+    lock = threading.Lock()
+
+    def make_stage(resource):
+        def stage(item):
+            with lock:
+                running[resource] += 1
+                max_running[resource] = max(max_running[resource], running[resource])
+                if running[IO] and running[CPU]:
+                    overlapped.set()
+            time.sleep(0.02)
+            with lock:
+                running[resource] -= 1
+        return stage
+
+    stages = [("read", make_stage(IO), IO), ("compute", make_stage(CPU), CPU)]
+    run_stages(range(6), stages, {IO: 1, CPU: 2})
+
+    assert max_running[IO] == 1
+    assert max_running[CPU] <= 2
+    assert overlapped.is_set()
+
+
+def test_run_stages_stops_after_failure():
+    second_stage_items = []
+
+    def fail_on_first(item):
+        if item == 0:
+            raise RuntimeError("stage failed")
+        # give the failure time to be noticed before the next stages start
+        time.sleep(0.05)
+
+    stages = [("fail", fail_on_first, IO), ("record", second_stage_items.append, CPU)]
+
+    with pytest.raises(RuntimeError):
+        run_stages(range(4), stages, {IO: 1, CPU: 1})
+
+    assert 0 not in second_stage_items
+    assert len(second_stage_items) < 3
@@ -0,0 +1,82 @@
+import hashlib
+import io
+import tarfile
+
+from archiver.streaming import HashingReader, hash_tar_members
+
+
+def _add_member(tar, name, data=None, **kwargs):
+    info = tarfile.TarInfo(name)
+    for key, value in kwargs.items():
+        setattr(info, key, value)
+
+    if data is None:
+        tar.addfile(info)
+    else:
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+
+def test_hash_tar_members():
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.PAX_FORMAT) as tar:
+        _add_member(tar, "folder", type=tarfile.DIRTYPE)
+        _add_member(tar, "folder/file.txt", b"some content")
+        _add_member(tar, "folder/link.txt", type=tarfile.SYMTYPE, linkname="file.txt")
+        _add_member(tar, "folder/hardlink.txt", type=tarfile.LNKTYPE, linkname="folder/file.txt")
+
+    tar_bytes = buffer.getvalue()
+    sink = io.BytesIO()
+    reader = HashingReader(io.BytesIO(tar_bytes), [sink])
+
+    hashes = {path: file_hash for path, file_hash, _ in hash_tar_members(reader)}
+    reader.drain()
+
+    content_hash = hashlib.md5(b"some content").hexdigest()
+    assert hashes == {"folder/file.txt": content_hash,
+                      "folder/link.txt": hashlib.md5(b"file.txt").hexdigest(),
+                      "folder/hardlink.txt": content_hash}
+
+    assert sink.getvalue() == tar_bytes
+    assert reader.hexdigest() == hashlib.md5(tar_bytes).hexdigest()
+
+
+def test_hash_tar_members_selected_paths():
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.PAX_FORMAT) as tar:
+        _add_member(tar, "folder/file.txt", b"some content")
+        _add_member(tar, "folder/other.txt", b"other content")
+        _add_member(tar, "folder/hardlink.txt", type=tarfile.LNKTYPE, linkname="folder/file.txt")
+
+    buffer.seek(0)
+    hashes = {path: file_hash for path, file_hash, _ in
+              hash_tar_members(buffer, select={"folder/other.txt", "folder/hardlink.txt"}.__contains__)}
+
+    # the file the hard link points to hasn't been hashed
+    assert hashes == {"folder/other.txt": hashlib.md5(b"other content").hexdigest(),
+                      "folder/hardlink.txt": None}
+
+
+def test_hash_tar_members_skips_directory_links():
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.PAX_FORMAT) as tar:
+        _add_member(tar, "folder/dir", type=tarfile.DIRTYPE)
+        _add_member(tar, "folder/dir-link", type=tarfile.SYMTYPE, linkname="dir")
+        _add_member(tar, "folder/file-link", type=tarfile.SYMTYPE, linkname="missing.txt")
+
+    buffer.seek(0)
+    paths = [path for path, _, _ in
+             hash_tar_members(buffer, is_directory_link=lambda path, member: member.linkname == "dir")]
+
+    assert paths == ["folder/file-link"]
+
+
+def test_hashing_reader_without_algorithm():
+    sink = io.BytesIO()
+    reader = HashingReader(io.BytesIO(b"some content"), [sink], algorithm=None)
+
+    reader.drain()
+
+    assert sink.getvalue() == b"some content"
+    assert reader.bytes_read == len(b"some content")
+    assert reader.hasher is None
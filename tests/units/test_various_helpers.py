@@ -2,7 +2,8 @@ from pathlib import Path
 
 import pytest
 
-from archiver.helpers import read_hash_file, sort_paths_with_part
+from archiver.helpers import read_hash_file, sort_paths_with_part, write_file_hash, \
+    get_hash_algorithm_from_file, get_lzip_job_threads, get_seconds_in_string_with_unit
 
 special_file_name = (
             'special_file'.encode('utf-8') + bytearray.fromhex('0D')).decode(
@@ -33,6 +34,23 @@ def test_read_hash_file(example_hash_file):
     assert special_file_name in file_names
 
 
+@pytest.mark.parametrize("algorithm", ["md5", "sha256"])
+def test_write_and_read_hash_file_with_algorithm(tmp_path, algorithm):
+    file_path = tmp_path / "archive.tar"
+    write_file_hash(file_path, "abcdef", algorithm)
+
+    hash_file_path = tmp_path / "archive.tar.md5"
+    assert get_hash_algorithm_from_file(hash_file_path) == algorithm
+    assert read_hash_file(hash_file_path) == {"archive.tar": "abcdef"}
+
+    # md5 hash files stay compatible with md5sum
+    assert hash_file_path.read_text().startswith("#") == (algorithm != "md5")
+
+
+def test_get_hash_algorithm_from_legacy_file(example_hash_file):
+    assert get_hash_algorithm_from_file(example_hash_file) == "md5"
+
+
 @pytest.mark.parametrize('lst,expected', [
     ([], []),
     ([Path('/tmp/hello.part10.world'), Path('/tmp/hello.part2.world')],
@@ -42,3 +60,29 @@ def test_read_hash_file(example_hash_file):
 ])
 def test_sort_paths_with_part(lst, expected):
     assert sort_paths_with_part(lst) == expected
+
+
+@pytest.mark.parametrize("threads,nr_parts,max_jobs,expected", [
+    (None, 3, None, [None]),
+    (1, 3, None, [1]),
+    (8, 1, None, [8]),
+    (8, 3, None, [4, 4]),
+    (10, 2, None, [5, 5]),
+    (14, 5, None, [5, 5, 4]),
+    (16, 5, 2, [8, 8]),
+])
+def test_get_lzip_job_threads(threads, nr_parts, max_jobs, expected):
+    assert get_lzip_job_threads(threads, nr_parts, max_jobs) == expected
+
+
+@pytest.mark.parametrize("duration_string,expected", [
+    ("90", 90), ("90s", 90), ("30m", 1800), ("1.5H", 5400), ("2 d", 172800),
+])
+def test_get_seconds_in_string_with_unit(duration_string, expected):
+    assert get_seconds_in_string_with_unit(duration_string) == expected
+
+
+@pytest.mark.parametrize("duration_string", ["", "m", "-5m", "5w"])
+def test_get_seconds_in_string_with_unit_invalid(duration_string):
+    with pytest.raises(ValueError):
+        get_seconds_in_string_with_unit(duration_string)